@@ -4,7 +4,6 @@ import tempfile
 import time
 import DockerProxy
 import constants
-import installSoftware
 from collections import OrderedDict
 from DockerSSH import DockerSSH
 from constants import Constants
@@ -21,6 +20,7 @@ class DockerBase(ProviderBase):
 
     SSH_KEY_EXTENSION = ".pem"
     PROVIDER_TYPE = 'Docker'
+    STATUS_POLL_CONCURRENCY = 4
 
     def __init__(self, name, config=None, config_dir=None, **kwargs):
         ProviderBase.__init__(self, name, config, config_dir, **kwargs)
@@ -32,7 +32,7 @@ class DockerBase(ProviderBase):
 
     def start_instance(self, num=1):
         """ Start given number of (or 1) containers. """
-        started_containers = []
+        created_containers = []
         for i in range(num):
             container_id = self.docker.create_container(self.provider.config["molns_image_name"], name=self.name,
                                                         port_bindings={
@@ -41,11 +41,9 @@ class DockerBase(ProviderBase):
                                                         Constants.DEFAULT_PRIVATE_NOTEBOOK_PORT:
                                                             ('127.0.0.1', self.config['notebook_port'])},
                                                         working_directory=self.config["working_directory"])
-            stored_container = self.datastore.get_instance(provider_instance_identifier=container_id,
-                                                           ip_address=self.docker.get_container_ip_address(container_id)
-                                                           , provider_id=self.provider.id, controller_id=self.id,
-                                                           provider_type=constants.Constants.DockerProvider)
-            started_containers.append(stored_container)
+            created_containers.append((container_id, self.docker.get_container_ip_address(container_id)))
+        started_containers = self.datastore.register_instances(created_containers, provider_id=self.provider.id,
+                                                               controller_id=self.id)
         if num == 1:
             return started_containers[0]
         return started_containers
@@ -76,6 +74,7 @@ class DockerBase(ProviderBase):
         else:
             instance_ids.append(instances.provider_instance_identifier)
         self.docker.terminate_containers(instance_ids)
+        self.datastore.delete_instances(instances if isinstance(instances, list) else [instances])
 
     def exec_command(self, container_id, command):
         self.docker.execute_command(container_id, command)
@@ -132,6 +131,7 @@ class DockerProvider(DockerBase):
 
     def create_molns_image(self):
         """ Create a molns image, save it on localhost and return DockerImage ID of created image. """
+        import installSoftware
         file_to_remove = None
         try:
             dockerfile, file_to_remove = self._create_dockerfile(installSoftware.InstallSW.get_command_list())
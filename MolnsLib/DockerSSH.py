@@ -11,9 +11,11 @@ class DockerSSH(object):
         self.docker = docker
         self.container_id = None
 
-    def exec_command(self, command, verbose=None):
+    def exec_command(self, command, verbose=None, timeout=None, output_callback=None):
         cmd = re.sub("\"", "\\\"", command)  # Escape all occurrences of ".
         ret_val, response = self.docker.execute_command(self.container_id, cmd)
+        if output_callback is not None:
+            output_callback('stdout', response)
         return response
 
     def exec_multi_command(self, command, verbose=None):
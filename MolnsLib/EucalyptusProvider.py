@@ -9,9 +9,7 @@ import sys
 import logging
 from urlparse import urlparse
 from collections import OrderedDict
-import installSoftware
-import ssh_deploy
-from molns_provider import ProviderBase, ProviderException
+from molns_provider import ProviderBase, ProviderException, wait_for_instance_states
 
 #logging.getLogger('boto').setLevel(logging.ERROR)
 logging.getLogger('boto').setLevel(logging.CRITICAL)
@@ -155,6 +153,7 @@ class EucalyptusProvider(EucalyptusBase):
         # get login ip
         ip = instance.public_dns_name
         # install software
+        import installSoftware
         try:
             logging.debug("installing software on server (ip={0})".format(ip))
             install_vm_instance = installSoftware.InstallSW(ip, config=self)
@@ -216,11 +215,7 @@ class EucalyptusController(EucalyptusBase):
         try:
             self._connect()
             instances = self.eucalyptus.start_eucalyptus_instances(image_id=self.provider.config["molns_image_name"], num=int(num), instance_type=self.config["instance_type"])
-            ret = []
-            for instance in instances:
-                ip = instance.public_dns_name
-                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id)
-                ret.append(i)
+            ret = self.datastore.register_instances([(instance.id, instance.public_dns_name) for instance in instances], provider_id=self.provider.id, controller_id=self.id)
             if num == 1:
                 return ret[0]
             else:
@@ -232,10 +227,7 @@ class EucalyptusController(EucalyptusBase):
     def resume_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
-            eucalyptus_instances = []
-            for instance in instances:
-                eucalyptus_instance = self.eucalyptus.get_instance(instance.provider_instance_identifier)
-                eucalyptus_instances.append(eucalyptus_instance)
+            eucalyptus_instances = self._get_eucalyptus_instances(instances)
             new_eucalyptus_instances = self.eucalyptus.resume_eucalyptus_instances(eucalyptus_instances)
             instances_to_update = list(instances)
             while len(instances_to_update) > 0:
@@ -249,19 +241,18 @@ class EucalyptusController(EucalyptusBase):
                         break
                 if not success:
                     raise ProviderException("Could not update the IP of id={0} after resume".format(instance.provider_instance_identifier))
+            self.datastore.update_instances(instances)
         else:
             eucalyptus_instance = self.eucalyptus.get_instance(instances.provider_instance_identifier)
             new_instance = self.eucalyptus.resume_eucalyptus_instances([eucalyptus_instance])
             instances.ip_address = new_instance[0].public_dns_name
             logging.debug("instance.id={0} updated with ip={1}".format(instances.provider_instance_identifier, instances.ip_address))
+            self.datastore.update_instances(instances)
 
     def stop_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
-            eucalyptus_instances = []
-            for instance in instances:
-                eucalyptus_instance = self.eucalyptus.get_instance(instance.provider_instance_identifier)
-                eucalyptus_instances.append(eucalyptus_instance)
+            eucalyptus_instances = self._get_eucalyptus_instances(instances)
             self.eucalyptus.stop_eucalyptus_instances(eucalyptus_instances)
         else:
             eucalyptus_instance = self.eucalyptus.get_instance(instances.provider_instance_identifier)
@@ -270,17 +261,23 @@ class EucalyptusController(EucalyptusBase):
     def terminate_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
-            eucalyptus_instances = []
-            for instance in instances:
-                eucalyptus_instance = self.eucalyptus.get_instance(instances.provider_instance_identifier)
-                eucalyptus_instances.append(eucalyptus_instance)
-                self.datastore.delete_instance(instance)
+            eucalyptus_instances = self._get_eucalyptus_instances(instances)
+            self.datastore.delete_instances(instances)
             self.eucalyptus.terminate_eucalyptus_instances(eucalyptus_instances)
         else:
             eucalyptus_instance = self.eucalyptus.get_instance(instances.provider_instance_identifier)
             self.eucalyptus.terminate_eucalyptus_instances([eucalyptus_instance])
             self.datastore.delete_instance(instances)
     
+    def _get_eucalyptus_instances(self, instances):
+        """ Look up the Eucalyptus instances backing 'instances' with a single describe call. """
+        ids = [instance.provider_instance_identifier for instance in instances]
+        found = self.eucalyptus.get_instances(ids)
+        missing = [i for i in ids if i not in found]
+        if len(missing) > 0:
+            raise ProviderException("instance not found {0}".format(", ".join(missing)))
+        return [found[i] for i in ids]
+
     def get_instance_status(self, instance):
         self._connect()
         try:
@@ -288,6 +285,20 @@ class EucalyptusController(EucalyptusBase):
         except Exception as e:
             #logging.exception(e)
             return self.STATUS_TERMINATED
+        return self._translate_status(status)
+
+    def get_instance_statuses(self, instances):
+        """ Get the status of many instances with a single describe call. """
+        self._connect()
+        try:
+            states = self.eucalyptus.get_instance_statuses([i.provider_instance_identifier for i in instances])
+        except Exception as e:
+            #logging.exception(e)
+            return [self.STATUS_TERMINATED for i in instances]
+        return [self._translate_status(states[i.provider_instance_identifier])
+                if i.provider_instance_identifier in states else self.STATUS_TERMINATED for i in instances]
+
+    def _translate_status(self, status):
         if status == 'running' or status == 'pending':
             return self.STATUS_RUNNING
         if status == 'stopped' or status == 'stopping':
@@ -316,11 +327,7 @@ class EucalyptusWorkerGroup(EucalyptusController):
         try:
             self._connect()
             instances = self.eucalyptus.start_eucalyptus_instances(image_id=self.provider.config["molns_image_name"], num=int(num), instance_type=self.config["instance_type"])
-            ret = []
-            for instance in instances:
-                ip = instance.public_dns_name
-                i  = self.datastore.get_instance(provider_instance_identifier=instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id,  worker_group_id=self.id)
-                ret.append(i)
+            ret = self.datastore.register_instances([(instance.id, instance.public_dns_name) for instance in instances], provider_id=self.provider.id, controller_id=self.controller.id, worker_group_id=self.id)
             if num == 1:
                 return ret[0]
             else:
@@ -332,11 +339,8 @@ class EucalyptusWorkerGroup(EucalyptusController):
     def terminate_instance(self, instances):
         self._connect()
         if isinstance(instances, list):
-            eucalyptus_instances = []
-            for instance in instances:
-                eucalyptus_instance = self.eucalyptus.get_instance(instance.provider_instance_identifier)
-                eucalyptus_instances.append(eucalyptus_instance)
-                self.datastore.delete_instance(instance)
+            eucalyptus_instances = self._get_eucalyptus_instances(instances)
+            self.datastore.delete_instances(instances)
             self.eucalyptus.terminate_eucalyptus_instances(eucalyptus_instances)
         else:
             eucalyptus_instance = self.eucalyptus.get_instance(instances.provider_instance_identifier)
@@ -350,8 +354,13 @@ class CreateVM:
     This class is used to create VMs for Eucalyptus
     '''
     PENDING_IMAGE_WAITTIME = 60
+    # Seconds a described instance is reused before it is looked up again.
+    STATUS_CACHE_TTL = 5
+    # Maximum number of instance ids sent in one describe request.
+    DESCRIBE_BATCH_SIZE = 200
 
     def __init__(self, config=None, connect=True):
+        self._instance_cache = {}
         if config is not None:
             self.config = config
         if self.config['aws_access_key'] is None or self.config['aws_secret_key'] is None:
@@ -381,23 +390,71 @@ class CreateVM:
                                     path=ec2_path)
 
 
+    def get_instances(self, instance_ids, use_cache=True):
+        """ Describe many instances with as few API calls as possible. Returns a dict mapping instance id to
+        instance; ids unknown to Eucalyptus are left out. Results are cached for STATUS_CACHE_TTL seconds. """
+        now = time.time()
+        ret = {}
+        to_fetch = []
+        for instance_id in instance_ids:
+            cached = self._instance_cache.get(instance_id)
+            if use_cache and cached is not None and now - cached[0] < self.STATUS_CACHE_TTL:
+                ret[instance_id] = cached[1]
+            elif instance_id not in ret and instance_id not in to_fetch:
+                to_fetch.append(instance_id)
+        for start in range(0, len(to_fetch), self.DESCRIBE_BATCH_SIZE):
+            batch = to_fetch[start:start + self.DESCRIBE_BATCH_SIZE]
+            try:
+                reservations = self.conn.get_all_reservations(instance_ids=batch)
+            except EC2ResponseError:
+                # A single unknown id fails the whole request, look the ids up one by one instead.
+                if len(batch) > 1:
+                    for instance_id in batch:
+                        ret.update(self.get_instances([instance_id], use_cache=False))
+                continue
+            batch = set(batch)
+            for reservation in reservations:
+                for instance in reservation.instances:
+                    if instance.id in batch:
+                        self._instance_cache[instance.id] = (now, instance)
+                        ret[instance.id] = instance
+        return ret
+
+    def _forget_instances(self, instances):
+        for instance in instances:
+            self._instance_cache.pop(instance.id, None)
+
     def get_instance(self, instance_id):
-        #logging.debug("get_instance(instance_id={0})".format(instance_id))
-        try:
-            reservations = self.conn.get_all_reservations(instance_ids=[instance_id])
-        except EC2ResponseError:
+        instance = self.get_instances([instance_id]).get(instance_id)
+        if instance is None:
             raise ProviderException("instance not found {0}".format(instance_id))
-        #logging.debug("get_instance()  reservations:{0}".format(reservations))
-        for reservation in reservations:
-            #logging.debug("get_instance()  reservation.instances:{0}".format(reservation.instances))
-            for instance in reservation.instances:
-                if instance.id == instance_id:
-                    return instance
-        raise ProviderException("instance not found {0}".format(instance_id))
+        return instance
 
     def get_instance_status(self, instance_id):
         return self.get_instance(instance_id).state
 
+    def _wait_for_state(self, instances, state, fail_states=()):
+        """ Wait until all 'instances' reach 'state', refreshing them with one describe call per poll.
+        Returns up to date copies of 'instances'. """
+        ids = [instance.id for instance in instances]
+
+        def get_states(pending):
+            found = self.get_instances(pending, use_cache=False)
+            states = dict((i, found[i].state) for i in pending if i in found)
+            if state == 'terminated':
+                # Instances that are no longer described have been terminated.
+                states.update((i, 'terminated') for i in pending if i not in found)
+            # Otherwise a missing instance is still pending: describe calls lag behind a run or start request.
+            return states
+
+        wait_for_instance_states(ids, get_states, [state], fail_states=fail_states)
+        found = self.get_instances(ids)
+        return [found.get(instance.id, instance) for instance in instances]
+
+    def get_instance_statuses(self, instance_ids):
+        """ Returns a dict mapping instance id to state, ids unknown to Eucalyptus are left out. """
+        return dict((instance_id, instance.state) for instance_id, instance in self.get_instances(instance_ids).iteritems())
+
     
     def get_vm_status(self, key_name=None, verbose=False, show_all=False):
         if key_name is None:
@@ -477,16 +534,7 @@ class CreateVM:
         reservation = self.conn.run_instances(self.image_id, min_count=num, max_count=num, key_name=key_name, security_groups=group_list, instance_type=instance_type)
 
         instances = reservation.instances
-        num_instance = len(instances) 
-        num_running = 0
-        while num_running < num_instance:
-            num_running = 0
-            for instance in instances:
-                instance.update()
-                if instance.state == 'running':
-                    num_running += 1
-                if num_running < num_instance: 
-                    time.sleep(5)
+        instances = self._wait_for_state(instances, 'running', fail_states=['shutting-down', 'terminated'])
         print "Eucalyptus instances started."
         return sorted(instances, key=lambda vm: vm.id)
 
@@ -513,16 +561,7 @@ class CreateVM:
         print "Starting {0} Eucalyptus instance(s). This will take a minute...".format(num)
         reservation = self.conn.run_instances(image_id, min_count=num, max_count=num, key_name=key_name, security_groups=[group_name], instance_type=instance_type)
         instances = reservation.instances
-        num_instance = len(instances) 
-        num_running = 0
-        while num_running < num_instance:
-            num_running = 0
-            for instance in instances:
-                instance.update()
-                if instance.state == 'running':
-                    num_running += 1
-                if num_running < num_instance: 
-                    time.sleep(5)
+        instances = self._wait_for_state(instances, 'running', fail_states=['shutting-down', 'terminated'])
         print "Eucalyptus instances started."
         return sorted(instances, key=lambda vm: vm.id)
 
@@ -543,16 +582,10 @@ class CreateVM:
         print "Resuming Eucalyptus instance(s). This will take a minute..."
         for instance in instances:
             print "\t{0}.".format(instance.id)
-            instance.start()
-        num_running = 0
-        while num_running < num_instance:
-            num_running = 0
-            for instance in instances:
-                instance.update()
-                if instance.state == 'running':
-                    num_running += 1
-                if num_running < num_instance: 
-                    time.sleep(5)
+        if num_instance > 0:
+            self.conn.start_instances(instance_ids=[instance.id for instance in instances])
+            self._forget_instances(instances)
+        instances = self._wait_for_state(instances, 'running', fail_states=['shutting-down', 'terminated'])
         print "Eucalyptus instances resumed."
         return instances
 
@@ -561,16 +594,10 @@ class CreateVM:
         print "Stopping Eucalyptus instance(s). This will take a minute..."
         for instance in instances:
             print "\t{0}.".format(instance.id)
-            instance.stop()
-        num_stopped = 0
-        while num_stopped < num_instance:
-            num_stopped = 0
-            for instance in instances:
-                instance.update()
-                if instance.state == 'stopped':
-                    num_stopped += 1
-                if num_stopped < num_instance: 
-                    time.sleep(5)
+        if num_instance > 0:
+            self.conn.stop_instances(instance_ids=[instance.id for instance in instances])
+            self._forget_instances(instances)
+        self._wait_for_state(instances, 'stopped', fail_states=['shutting-down', 'terminated'])
         print "Eucalyptus instances stopped."
 
     def terminate_eucalyptus_instances(self, instances):
@@ -578,16 +605,10 @@ class CreateVM:
         print "Terminating Eucalyptus instance(s). This will take a minute..."
         for instance in instances:
             print "\t{0}.".format(instance.id)
-            instance.terminate()
-        num_terminated = 0
-        while num_terminated < num_instance:
-            num_terminated = 0
-            for instance in instances:
-                instance.update()
-                if instance.state == 'terminated':
-                    num_terminated += 1
-                if num_terminated < num_instance: 
-                    time.sleep(5)
+        if num_instance > 0:
+            self.conn.terminate_instances(instance_ids=[instance.id for instance in instances])
+            self._forget_instances(instances)
+        self._wait_for_state(instances, 'terminated')
         print "Eucalyptus instance terminated."
 
     def create_vm_image(self, image_name=None, key_name=None):
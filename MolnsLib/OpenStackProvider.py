@@ -5,8 +5,7 @@ import logging
 from novaclient import client as novaclient
 from collections import OrderedDict
 import collections
-import installSoftware
-from molns_provider import ProviderBase, ProviderException
+from molns_provider import ProviderBase, ProviderException, wait_for_instance_states
 
 # quite the logging of 'requests.packages.urllib3.connectionpool'
 logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(logging.ERROR)
@@ -155,6 +154,7 @@ class OpenStackProvider(OpenStackBase):
         # get login ip
         ip = self._attach_floating_ip(instance)
         # install software
+        import installSoftware
         try:
             logging.debug("installing software on server (ip={0})".format(ip))
             install_vm_instance = installSoftware.InstallSW(ip, config=self)
@@ -213,6 +213,24 @@ class OpenStackProvider(OpenStackBase):
         instance = self.nova.servers.get(instance_id)
         return instance.status
 
+    def _get_instance_statuses(self, instance_ids):
+        """ Get the status of many servers with one list call, limited to the servers booted by this object (by name,
+        see __boot_vm()); the others are looked up one by one. Servers that no longer exist are 'DELETED'. """
+        import re
+        self._connect()
+        statuses = {}
+        wanted = set(instance_ids)
+        for server in self.nova.servers.list(search_opts={'name': "^molns_vm_{0}$".format(re.escape(self.name))}):
+            if server.id in wanted:
+                statuses[server.id] = server.status
+        for instance_id in instance_ids:
+            if instance_id not in statuses:
+                try:
+                    statuses[instance_id] = self.nova.servers.get(instance_id).status
+                except novaclient.exceptions.NotFound:
+                    statuses[instance_id] = 'DELETED'
+        return statuses
+
     def _stop_instances(self, instance_ids):
         self._connect()
         instances = []
@@ -222,50 +240,33 @@ class OpenStackProvider(OpenStackBase):
 
     def _resume_instances(self, instance_ids):
         self._connect()
-        for instance_id in instance_ids:
-            try:
+        try:
+            for instance_id in instance_ids:
                 instance = self.nova.servers.get(instance_id)
                 instance.start()
                 logging.debug("instance={0}".format(instance))
-                # wait for boot to complete
-                while instance.status == 'BUILD':
-                    logging.debug("Launching node, status '{0}'".format(instance.status))
-                    time.sleep(5)
-                    # Retrieve the instance again so the status field updates
-                    instance = self.nova.servers.get(instance.id)
-                    #instance.update()
-                logging.debug("status: {0}".format(instance.status))
-                return instance
-            except Exception as e:
-                logging.exception(e)
-                logging.debug("terminating instance {0}".format(instance))
-                instance.delete()
-                raise ProviderException("Failed to boot vm\n{0}".format(e))
+            # wait for boot to complete
+            wait_for_instance_states(instance_ids, self._get_instance_statuses, ['ACTIVE'],
+                                     fail_states=['ERROR', 'DELETED'])
+        except Exception as e:
+            # Stopped servers hold the user's data, leave them alone (they may still come up).
+            logging.exception(e)
+            try:
+                statuses = self._get_instance_statuses(instance_ids)
+                not_active = [i for i in instance_ids if statuses.get(i) != 'ACTIVE']
+            except Exception:
+                not_active = instance_ids
+            raise ProviderException("Failed to resume vm(s) {0}\n{1}".format(not_active, e))
 
     def _terminate_instances(self, instance_ids):
         self._connect()
         if not isinstance(instance_ids, list):
             instance_ids = [instance_ids]
         try:
-            instances = []
             for instance_id in instance_ids:
                 instance = self.nova.servers.get(instance_id)
-                instances.append(instance)
                 instance.delete()
-            inst_to_check = instances
-            while len(inst_to_check) > 0:
-                time.sleep(5)
-                inst_still_stopping = []
-                for instance in inst_to_check:
-                    # Retrieve the instance again so the status field updates
-                    try:
-                        instance = self.nova.servers.get(instance.id)
-                        logging.debug("Terminating node, status '{0}'  [{1}]".format(instance.status, instance.id))
-                        if instance.status != 'SHUTOFF':
-                            inst_still_stopping.append(instance)
-                    except novaclient.exceptions.NotFound as e:
-                        pass
-                inst_to_check = inst_still_stopping
+            wait_for_instance_states(instance_ids, self._get_instance_statuses, ['SHUTOFF', 'DELETED'])
         except Exception as e:
             logging.exception(e)
             raise ProviderException("Failed to terminate vm(s)\n{0}".format(e))
@@ -278,20 +279,8 @@ class OpenStackProvider(OpenStackBase):
         try:
             for instance in instances:
                 instance.stop()
-            inst_to_check = instances
-            while len(inst_to_check) > 0:
-                time.sleep(5)
-                inst_still_stopping = []
-                for instance in inst_to_check:
-                    # Retrieve the instance again so the status field updates
-                    try:
-                        instance = self.nova.servers.get(instance.id)
-                        logging.debug("Stopping node, status '{0}'  [{1}]".format(instance.status, instance.id))
-                        if instance.status != 'SHUTOFF':
-                            inst_still_stopping.append(instance)
-                    except novaclient.exceptions.NotFound as e:
-                        pass
-                inst_to_check = inst_still_stopping
+            wait_for_instance_states([instance.id for instance in instances], self._get_instance_statuses,
+                                     ['SHUTOFF', 'DELETED'])
         except Exception as e:
             logging.exception(e)
             raise ProviderException("Failed to stop vm(s)\n{0}".format(e))
@@ -321,17 +310,8 @@ class OpenStackProvider(OpenStackBase):
                 instances.append(inst)
                 #logging.debug("instance={0}".format(inst))
             # wait for boot to complete
-            inst_to_check = instances
-            while len(inst_to_check) > 0:
-                time.sleep(5)
-                inst_still_building = []
-                for instance in inst_to_check:
-                    # Retrieve the instance again so the status field updates
-                    instance = self.nova.servers.get(instance.id)
-                    logging.debug("Launching node, status '{0}'  [{1}]".format(instance.status, instance.id))
-                    if instance.status == 'BUILD':
-                        inst_still_building.append(instance)
-                inst_to_check = inst_still_building
+            wait_for_instance_states([instance.id for instance in instances], self._get_instance_statuses,
+                                     ['ACTIVE'], fail_states=['ERROR', 'DELETED'])
             if num == 1:
                 return instances[0]
             else:
@@ -382,12 +362,11 @@ class OpenStackController(OpenStackBase):
         #print "nova_instance = self.provider._boot_molns_vm(self, instance_type={0})".format(self.config['instance_type'])
         nova_instance = self.provider._boot_molns_vm(instance_type=self.config['instance_type'], num=num)
         if isinstance(nova_instance, list):
-            ret = []
+            booted = []
             for i in nova_instance:
                 ip = self.provider._attach_floating_ip(i)
-                i  = self.datastore.get_instance(provider_instance_identifier=i.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id)
-                ret.append(i)
-            return ret
+                booted.append((i.id, ip))
+            return self.datastore.register_instances(booted, provider_id=self.provider.id, controller_id=self.id)
         else:
             ip = self.provider._attach_floating_ip(nova_instance)
             i  = self.datastore.get_instance(provider_instance_identifier=nova_instance.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.id)
@@ -411,9 +390,9 @@ class OpenStackController(OpenStackBase):
         if isinstance(instances, list):
             pids = []
             for instance in instances:
-                self.provider._delete_floating_ip(instances.ip_address)
-                self.datastore.delete_instance(instances)
+                self.provider._delete_floating_ip(instance.ip_address)
                 pids.append(instance.provider_instance_identifier)
+            self.datastore.delete_instances(instances)
             self.provider._terminate_instances(pids)
         else:
             self.provider._terminate_instances([instances.provider_instance_identifier])
@@ -453,7 +432,7 @@ class OpenStackWorkerGroup(OpenStackController):
         #print "nova_instance = self.provider._boot_molns_vm(self, instance_type={0})".format(self.config['instance_type'])
         nova_instance = self.provider._boot_molns_vm(instance_type=self.config['instance_type'], num=num)
         if isinstance(nova_instance, list):
-            ret = []
+            booted = []
             for i in nova_instance:
                 try:
                     ip = self.provider._attach_floating_ip(i)
@@ -461,9 +440,9 @@ class OpenStackWorkerGroup(OpenStackController):
                     logging.exception(e)
                     logging.debug("Terminating instance {0}".format(i.id))
                     i.delete()
-                inst  = self.datastore.get_instance(provider_instance_identifier=i.id, ip_address=ip, provider_id=self.provider.id, controller_id=self.controller.id, worker_group_id=self.id)
-                ret.append(inst)
-            return ret
+                    continue
+                booted.append((i.id, ip))
+            return self.datastore.register_instances(booted, provider_id=self.provider.id, controller_id=self.controller.id, worker_group_id=self.id)
         else:
             try:
                 ip = self.provider._attach_floating_ip(nova_instance)
@@ -482,7 +461,7 @@ class OpenStackWorkerGroup(OpenStackController):
             for instance in instances:
                 self.provider._delete_floating_ip(instance.ip_address)
                 pids.append(instance.provider_instance_identifier)
-                self.datastore.delete_instance(instance)
+            self.datastore.delete_instances(instances)
             self.provider._terminate_instances(pids)
         else:
             self.provider._terminate_instances([instances.provider_instance_identifier])
@@ -29,6 +29,48 @@ def ensure_sudo_mode(some_function):
     return some_function
 
 
+def parallel_map(func, items, max_workers=8):
+    """ Apply func to every item on a bounded pool of threads; returns the results in the order of items.
+    'items' may be a generator, it is consumed lazily so work starts as soon as the first item is produced.
+    The first exception raised by func is re-raised in the caller once all threads have finished. """
+    import sys
+    import threading
+    if isinstance(items, (list, tuple)):
+        num_threads = max(1, min(max_workers, len(items)))
+    else:
+        num_threads = max(1, max_workers)
+    work = enumerate(items)
+    lock = threading.Lock()
+    results = {}
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                try:
+                    ndx, item = next(work)
+                except StopIteration:
+                    return
+                except Exception:
+                    errors.append(sys.exc_info())
+                    return
+            try:
+                results[ndx] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+                results[ndx] = None
+
+    threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return [results[ndx] for ndx in range(len(results))]
+
+
 class Log:
     verbose = True
 
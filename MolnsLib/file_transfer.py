@@ -0,0 +1,602 @@
+import hashlib
+import json
+import os
+import pipes
+import re
+import tarfile
+import threading
+import time
+import zlib
+
+from DockerSSH import DockerSSH
+
+
+class TransferException(Exception):
+    pass
+
+
+# Size of the SFTP write requests; 32k is the largest payload most sftp servers accept in one packet.
+CHUNK_SIZE = 32768
+# Suffix of the remote file while the upload is in progress.
+PARTIAL_SUFFIX = ".part"
+# Number of parallel SFTP channels used by sync_directory.
+SYNC_STREAMS = 4
+# Maximum number of paths passed to one remote md5sum/mkdir/rm command.
+REMOTE_BATCH_SIZE = 200
+# Number of parallel SFTP channels used by fetch_file for large files.
+FETCH_STREAMS = 4
+# Files smaller than this are fetched over a single channel.
+FETCH_RANGE_THRESHOLD = 8 * 1048576
+# Once the hash cache has this many entries, entries of files that changed or were removed are dropped.
+HASH_CACHE_MAX_ENTRIES = 1000
+# Unreferenced blobs used by stage_files within this many minutes are kept by prune_blobs (they may be linked soon).
+BLOB_PRUNE_MIN_AGE = 60
+
+
+def format_throughput(nbytes, seconds):
+    """ Returns a human readable "<size> in <time> (<rate>)" string. """
+    seconds = max(seconds, 0.001)
+    return "{0:.1f} MB in {1:.1f}s ({2:.2f} MB/s)".format(nbytes / 1048576.0, seconds,
+                                                          nbytes / 1048576.0 / seconds)
+
+
+def local_checksum(path, length=None):
+    """ md5 of the first 'length' bytes of a local file, or of the whole file if length is None. Returns the hashlib
+    object so the caller can keep feeding it. """
+    md5 = hashlib.md5()
+    remaining = length
+    with open(path, "rb") as fh:
+        while remaining is None or remaining > 0:
+            size = CHUNK_SIZE * 32
+            if remaining is not None:
+                size = min(size, remaining)
+            data = fh.read(size)
+            if not data:
+                break
+            md5.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return md5
+
+
+def remote_checksum(ssh, path, length=None):
+    """ md5 of the first 'length' bytes of a remote file, or of the whole file if length is None. """
+    if length is None:
+        # Read from stdin, md5sum escapes the output line for names with a backslash or newline.
+        command = "md5sum < {0}".format(pipes.quote(path))
+    else:
+        command = "head -c {1} {0} | md5sum".format(pipes.quote(path), int(length))
+    output = ssh.exec_command(command, verbose=False)
+    return output[0].split()[0]
+
+
+def _remote_size(sftp, path):
+    try:
+        return sftp.stat(path).st_size
+    except (IOError, OSError):
+        return None
+
+
+def upload_file(ssh, local_path, remote_path, resume=True, verbose=True):
+    """ Stream a local file to 'remote_path' on the host 'ssh' is connected to.
+
+    The file is read and sent CHUNK_SIZE bytes at a time with pipelined SFTP writes, so memory use does not depend
+    on the file size. Data goes to '<remote_path>.part', which is renamed once its size and md5 checksum match the
+    local file. If 'resume' is set and a '.part' file from an interrupted upload is found whose content matches the
+    start of the local file, only the rest of the file is sent.
+
+    Returns:
+        The number of bytes sent.
+    Raises:
+        TransferException if the uploaded file does not match the local file.
+    """
+    total_size = os.path.getsize(local_path)
+    start_time = time.time()
+    sftp = ssh.open_sftp()
+    try:
+        if isinstance(ssh, DockerSSH):
+            # Containers are written through the docker api, which takes the file as a whole.
+            remote_fh = sftp.file(remote_path, "w")
+            try:
+                with open(local_path, "rb") as fh:
+                    for data in iter(lambda: fh.read(CHUNK_SIZE), ""):
+                        remote_fh.write(data)
+            finally:
+                remote_fh.close()
+            return total_size
+
+        partial_path = remote_path + PARTIAL_SUFFIX
+        offset = 0
+        md5 = hashlib.md5()
+        if resume:
+            partial_size = _remote_size(sftp, partial_path)
+            if partial_size is not None and 0 < partial_size <= total_size:
+                prefix_md5 = local_checksum(local_path, partial_size)
+                if remote_checksum(ssh, partial_path, partial_size) == prefix_md5.hexdigest():
+                    offset = partial_size
+                    md5 = prefix_md5
+                    if verbose:
+                        print "Resuming upload of {0} at byte {1}".format(local_path, offset)
+
+        if offset > 0:
+            remote_fh = sftp.open(partial_path, "ab")
+        else:
+            remote_fh = sftp.open(partial_path, "wb")
+        try:
+            remote_fh.set_pipelined(True)
+            with open(local_path, "rb") as fh:
+                fh.seek(offset)
+                for data in iter(lambda: fh.read(CHUNK_SIZE), ""):
+                    md5.update(data)
+                    remote_fh.write(data)
+        finally:
+            # Waits for the server to acknowledge all outstanding writes.
+            remote_fh.close()
+
+        remote_size = _remote_size(sftp, partial_path)
+        if remote_size != total_size:
+            raise TransferException("Size mismatch after upload of {0}: local {1} bytes, remote {2} bytes".format(
+                local_path, total_size, remote_size))
+        if remote_checksum(ssh, partial_path) != md5.hexdigest():
+            sftp.remove(partial_path)
+            raise TransferException("Checksum mismatch after upload of {0}".format(local_path))
+        sftp.posix_rename(partial_path, remote_path)
+        if verbose:
+            print "Sent {0}".format(format_throughput(total_size - offset, time.time() - start_time))
+        return total_size - offset
+    finally:
+        sftp.close()
+
+
+def put_file(sftp, local_path, remote_path):
+    """ Stream a local file to remote_path with pipelined writes. Returns the number of bytes sent. """
+    sent = 0
+    remote_fh = sftp.open(remote_path, "wb")
+    try:
+        remote_fh.set_pipelined(True)
+        with open(local_path, "rb") as fh:
+            for data in iter(lambda: fh.read(CHUNK_SIZE), ""):
+                remote_fh.write(data)
+                sent += len(data)
+    finally:
+        remote_fh.close()
+    return sent
+
+
+def get_file(sftp, remote_path, local_path):
+    """ Stream a remote file to local_path, with the reads of the whole file requested ahead. Returns the number of
+    bytes received. """
+    received = 0
+    remote_fh = sftp.open(remote_path, "rb")
+    try:
+        remote_fh.prefetch()
+        with open(local_path, "wb") as fh:
+            for data in iter(lambda: remote_fh.read(CHUNK_SIZE), ""):
+                fh.write(data)
+                received += len(data)
+    finally:
+        remote_fh.close()
+    return received
+
+
+def local_manifest(root):
+    """ Returns {relative path: (size, mtime)} of the files below the local directory root. """
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            manifest[os.path.relpath(path, root)] = (st.st_size, int(st.st_mtime))
+    return manifest
+
+
+def remote_manifest(ssh, root):
+    """ Returns {relative path: (size, mtime)} of the files below the remote directory root, in one command. """
+    output = ssh.exec_command("[ ! -d {0} ] || find {0} -type f -printf '%P\\t%s\\t%T@\\n'".format(pipes.quote(root)),
+                              verbose=False)
+    manifest = {}
+    for line in output:
+        fields = line.rsplit("\t", 2)
+        if len(fields) == 3:
+            manifest[fields[0]] = (int(fields[1]), int(float(fields[2])))
+    return manifest
+
+
+def remote_checksums(ssh, root, paths):
+    """ Returns {relative path: md5} for files below the remote directory root. """
+    checksums = {}
+    paths = list(paths)
+    for i in range(0, len(paths), REMOTE_BATCH_SIZE):
+        batch = paths[i:i + REMOTE_BATCH_SIZE]
+        output = ssh.exec_command("cd {0} && md5sum -- {1}".format(
+            pipes.quote(root), " ".join(pipes.quote(p) for p in batch)), verbose=False)
+        for line in output:
+            md5, path = line.split(None, 1)
+            checksums[path.lstrip("*")] = md5
+    return checksums
+
+
+def _run_batched(ssh, command, paths):
+    paths = list(paths)
+    for i in range(0, len(paths), REMOTE_BATCH_SIZE):
+        ssh.exec_command("{0} {1}".format(command, " ".join(pipes.quote(p) for p in paths[i:i + REMOTE_BATCH_SIZE])),
+                         verbose=False)
+
+
+def _changed_files(ssh, source, destination, local_dir, remote_dir):
+    """ Returns (changed, touched): the files of the source manifest that are missing or different at the
+    destination, and those that only differ in mtime. Files with equal size but a different mtime are compared by
+    md5, so touching a file does not cause a transfer. """
+    changed = []
+    touched = []
+    check = []
+    for path, (size, mtime) in source.items():
+        if path not in destination or destination[path][0] != size:
+            changed.append(path)
+        elif destination[path][1] != mtime:
+            check.append(path)
+    if len(check) > 0:
+        remote = remote_checksums(ssh, remote_dir, check)
+        for path in check:
+            if remote.get(path) != local_checksum(os.path.join(local_dir, path)).hexdigest():
+                changed.append(path)
+            else:
+                touched.append(path)
+    return sorted(changed), touched
+
+
+def sync_directory(ssh, local_dir, remote_dir, pull=False, delete=False, streams=SYNC_STREAMS, verbose=True):
+    """ Make remote_dir a copy of local_dir (or local_dir a copy of remote_dir if 'pull' is set), sending only the
+    files that differ.
+
+    Size and mtime manifests of both sides are compared; files whose size matches but mtime does not are compared
+    by md5. Changed files are transferred over 'streams' parallel SFTP channels and get the mtime of their source,
+    so the next sync skips them. If 'delete' is set, files missing from the source are removed at the destination.
+
+    Returns:
+        A dict with the number of files 'transferred', 'deleted' and 'unchanged' and the 'bytes' transferred.
+    """
+    from Utils import parallel_map
+    start_time = time.time()
+    local_dir = os.path.abspath(local_dir)
+    if pull:
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+    elif not os.path.isdir(local_dir):
+        raise TransferException("'{0}' is not a directory".format(local_dir))
+    local = local_manifest(local_dir)
+    remote = remote_manifest(ssh, remote_dir)
+    if pull:
+        source, destination = remote, local
+    else:
+        source, destination = local, remote
+    changed, touched = _changed_files(ssh, source, destination, local_dir, remote_dir)
+    extra = sorted(set(destination) - set(source))
+
+    if pull:
+        for path in changed:
+            directory = os.path.dirname(os.path.join(local_dir, path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+    elif len(changed) > 0:
+        _run_batched(ssh, "mkdir -p", set([os.path.dirname(os.path.join(remote_dir, p)) for p in changed]))
+
+    channels = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def channel():
+        # One SFTP channel per thread, all on the same ssh transport.
+        if getattr(channels, 'sftp', None) is None:
+            channels.sftp = ssh.open_sftp_channel()
+            with opened_lock:
+                opened.append(channels.sftp)
+        return channels.sftp
+
+    def transfer(path):
+        local_path = os.path.join(local_dir, path)
+        remote_path = os.path.join(remote_dir, path)
+        mtime = source[path][1]
+        if pull:
+            nbytes = get_file(channel(), remote_path, local_path)
+            os.utime(local_path, (mtime, mtime))
+        else:
+            nbytes = put_file(channel(), local_path, remote_path)
+            channel().utime(remote_path, (mtime, mtime))
+        if verbose:
+            print "{0}\t{1}".format("GET" if pull else "PUT", path)
+        return nbytes
+
+    def set_mtime(path):
+        mtime = source[path][1]
+        if pull:
+            os.utime(os.path.join(local_dir, path), (mtime, mtime))
+        else:
+            channel().utime(os.path.join(remote_dir, path), (mtime, mtime))
+
+    try:
+        sizes = parallel_map(transfer, changed, max_workers=streams)
+        # Unchanged content, only copy the mtime so the next sync does not hash these again.
+        for path in touched:
+            set_mtime(path)
+    finally:
+        for sftp in opened:
+            sftp.close()
+
+    if delete and len(extra) > 0:
+        if pull:
+            for path in extra:
+                os.remove(os.path.join(local_dir, path))
+        else:
+            _run_batched(ssh, "rm -f --", [os.path.join(remote_dir, p) for p in extra])
+        if verbose:
+            for path in extra:
+                print "DELETE\t{0}".format(path)
+
+    if verbose:
+        print "{0} files transferred, {1} unchanged: {2}".format(
+            len(changed), len(source) - len(changed), format_throughput(sum(sizes), time.time() - start_time))
+    return {'transferred': len(changed), 'deleted': len(extra) if delete else 0,
+            'unchanged': len(source) - len(changed), 'bytes': sum(sizes)}
+
+
+def _fetch_range(sftp, remote_path, local_path, start, end):
+    """ Copy bytes [start, end) of the remote file into the (preallocated) local file, with all reads of the range
+    requested ahead. """
+    chunks = [(offset, min(CHUNK_SIZE, end - offset)) for offset in range(start, end, CHUNK_SIZE)]
+    remote_fh = sftp.open(remote_path, "rb")
+    try:
+        with open(local_path, "r+b") as fh:
+            fh.seek(start)
+            for data in remote_fh.readv(chunks):
+                fh.write(data)
+    finally:
+        remote_fh.close()
+    return end - start
+
+
+def _fetch_compressed(ssh, remote_path, local_path):
+    """ Stream 'gzip -c remote_path' and decompress it while writing local_path. Returns the compressed size. """
+    channel = ssh.open_command_channel("gzip -c -1 {0}".format(pipes.quote(remote_path)))
+    received = 0
+    try:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        with open(local_path, "wb") as fh:
+            for data in iter(lambda: channel.recv(CHUNK_SIZE * 4), ""):
+                received += len(data)
+                fh.write(decompressor.decompress(data))
+            fh.write(decompressor.flush())
+        if channel.recv_exit_status() != 0:
+            raise TransferException("Could not read {0}".format(remote_path))
+    finally:
+        channel.close()
+    return received
+
+
+def fetch_file(ssh, remote_path, local_path, streams=FETCH_STREAMS, compress=False, verify=True, verbose=True):
+    """ Copy a remote file to local_path.
+
+    Files larger than FETCH_RANGE_THRESHOLD are split into 'streams' byte ranges that are read in parallel, each over
+    its own SFTP channel with many outstanding read requests. With 'compress' the file is gzipped on the remote side
+    and decompressed on the fly instead, which helps for text output over slow links. The data is written to
+    '<local_path>.part' and renamed once its size (and md5, if 'verify' is set) matches the remote file.
+
+    Returns:
+        The number of bytes received over the network.
+    """
+    from Utils import parallel_map
+    start_time = time.time()
+    partial_path = local_path + PARTIAL_SUFFIX
+    sftp = ssh.open_sftp()
+    try:
+        size = sftp.stat(remote_path).st_size
+    finally:
+        sftp.close()
+    try:
+        if compress:
+            received = _fetch_compressed(ssh, remote_path, partial_path)
+        else:
+            with open(partial_path, "wb") as fh:
+                fh.truncate(size)
+            if size < FETCH_RANGE_THRESHOLD:
+                streams = 1
+            range_size = -(-size // max(1, streams))
+            ranges = [(start, min(size, start + range_size)) for start in range(0, size, max(1, range_size))]
+
+            def fetch(byte_range):
+                sftp = ssh.open_sftp_channel()
+                try:
+                    return _fetch_range(sftp, remote_path, partial_path, byte_range[0], byte_range[1])
+                finally:
+                    sftp.close()
+
+            received = sum(parallel_map(fetch, ranges, max_workers=len(ranges) or 1))
+        if os.path.getsize(partial_path) != size:
+            raise TransferException("Size mismatch after fetching {0}: remote {1} bytes, local {2} bytes".format(
+                remote_path, size, os.path.getsize(partial_path)))
+        if verify and remote_checksum(ssh, remote_path) != local_checksum(partial_path).hexdigest():
+            raise TransferException("Checksum mismatch after fetching {0}".format(remote_path))
+        os.rename(partial_path, local_path)
+    except Exception:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    if verbose:
+        print "Received {0}".format(format_throughput(received, time.time() - start_time))
+    return received
+
+
+def _quote_glob(pattern):
+    """ Shell-escape a path pattern, leaving the glob characters *?[] for the remote shell to expand. """
+    return re.sub(r"([^\w*?\[\]/.-])", r"\\\1", pattern)
+
+
+def fetch_archive(ssh, remote_dir, patterns, local_dir, compress=True, verbose=True):
+    """ Fetch all files matching the glob 'patterns' (relative to remote_dir) as one tar stream, optionally gzipped,
+    and unpack it into local_dir. The tar and gzip formats carry their own checksums, a corrupt stream fails to
+    unpack.
+
+    Returns:
+        The list of extracted paths.
+    """
+    start_time = time.time()
+    command = "cd {0} && tar -c{1}f - -- {2}".format(pipes.quote(remote_dir), "z" if compress else "",
+                                                     " ".join(_quote_glob(p) for p in patterns))
+    if not os.path.isdir(local_dir):
+        os.makedirs(local_dir)
+    root = os.path.realpath(local_dir)
+
+    def is_inside(path):
+        # Resolves symlinks, including those extracted by earlier members.
+        path = os.path.realpath(path)
+        return path == root or path.startswith(root + os.sep)
+
+    channel = ssh.open_command_channel(command)
+    extracted = []
+    try:
+        stream = channel.makefile("rb")
+        archive = tarfile.open(fileobj=stream, mode="r|gz" if compress else "r|")
+        try:
+            for member in archive:
+                name = os.path.normpath(member.name)
+                path = os.path.join(root, name)
+                if os.path.isabs(name) or not is_inside(path):
+                    raise TransferException("Refusing to extract '{0}' outside of {1}".format(member.name, local_dir))
+                # Symlink targets are relative to the link, hard link targets to the archive root.
+                if (member.issym() and not is_inside(os.path.join(os.path.dirname(path), member.linkname))) or \
+                        (member.islnk() and not is_inside(os.path.join(root, member.linkname))):
+                    raise TransferException("Refusing to extract '{0}', it links to '{1}' outside of {2}".format(
+                        member.name, member.linkname, local_dir))
+                archive.extract(member, root)
+                if member.isfile():
+                    extracted.append(name)
+                    if verbose:
+                        print "GET\t{0}".format(name)
+        finally:
+            archive.close()
+        if channel.recv_exit_status() != 0:
+            raise TransferException("tar failed on the remote host: {0}".format(
+                channel.makefile_stderr("rb").read().strip()))
+    finally:
+        channel.close()
+    if verbose:
+        nbytes = sum(os.path.getsize(os.path.join(local_dir, p)) for p in extracted)
+        print "{0} files, {1}".format(len(extracted), format_throughput(nbytes, time.time() - start_time))
+    return extracted
+
+
+def _load_hash_cache(cache_file):
+    if cache_file is None or not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file) as fh:
+            return json.load(fh)
+    except ValueError:
+        return {}
+
+
+def _hash_cache_key(path, st):
+    return "{0}:{1}:{2}".format(os.path.abspath(path), st.st_size, st.st_mtime)
+
+
+def _prune_hash_cache(cache):
+    """ The entries of the hash cache that are still valid for the file on disk. """
+    pruned = {}
+    for key, digest in cache.items():
+        path = key.rsplit(':', 2)[0]
+        try:
+            if _hash_cache_key(path, os.stat(path)) == key:
+                pruned[key] = digest
+        except OSError:
+            pass
+    return pruned
+
+
+def content_hash(path, cache=None):
+    """ sha256 of a local file. 'cache' is a dict keyed by path, size and mtime that is used and updated so that
+    unchanged files are not read again. """
+    st = os.stat(path)
+    key = _hash_cache_key(path, st)
+    if cache is not None and key in cache:
+        return cache[key]
+    sha = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for data in iter(lambda: fh.read(CHUNK_SIZE * 32), ""):
+            sha.update(data)
+    if cache is not None:
+        cache[key] = sha.hexdigest()
+    return sha.hexdigest()
+
+
+def content_hashes(paths, hash_cache_file=None):
+    """ sha256 of each local file, using and updating the hash cache stored in hash_cache_file. """
+    cache = _load_hash_cache(hash_cache_file)
+    hashes = [content_hash(path, cache) for path in paths]
+    if len(cache) > HASH_CACHE_MAX_ENTRIES:
+        cache = _prune_hash_cache(cache)
+    if hash_cache_file is not None:
+        with open(hash_cache_file, "w") as fh:
+            json.dump(cache, fh)
+    return hashes
+
+
+def stage_files(ssh, local_paths, remote_dir, blob_dir, hash_cache_file=None, verbose=True, link_ssh=None,
+                link_blob_dir=None):
+    """ Place the local files in remote_dir (under their basename) through a content addressed store.
+
+    Every file is stored once on the remote host as blob_dir/<sha256>, read-only. Only blobs that are not there
+    yet are uploaded, then all files are hard linked (or copied, if blob_dir is on another filesystem) into
+    remote_dir in one command, so inputs shared by many jobs are transferred once. Hashes of local files are cached
+    in hash_cache_file by path, size and mtime. Copying rather than symlinking keeps the link count of a blob
+    telling whether a job still uses it, which prune_blobs() relies on.
+
+    If link_ssh is given, remote_dir is on that host instead, which sees the store as link_blob_dir (a worker
+    mounting the controller's shared area); the files are symlinked there, that store is not pruned.
+
+    Blobs that are already stored are touched, so prune_blobs() does not remove them before they are linked.
+
+    Returns:
+        The number of blobs that were uploaded.
+    """
+    if len(local_paths) == 0:
+        return 0
+    hashes = content_hashes(local_paths, hash_cache_file)
+    unique = sorted(set(hashes))
+    output = ssh.exec_command("mkdir -p {0} && cd {0} && for h in {1}; do if [ -f $h ]; then touch $h; else "
+                              "echo $h; fi; done".format(pipes.quote(blob_dir), " ".join(unique)), verbose=False)
+    missing = set(line.strip() for line in output if line.strip())
+    uploaded = set()
+    for path, digest in zip(local_paths, hashes):
+        if digest in missing and digest not in uploaded:
+            uploaded.add(digest)
+            if verbose:
+                print "Uploading {0}".format(path)
+            blob_path = "{0}/{1}".format(blob_dir, digest)
+            upload_file(ssh, path, blob_path, verbose=verbose)
+            ssh.exec_command("chmod 444 {0}".format(pipes.quote(blob_path)), verbose=False)
+        elif verbose and digest not in uploaded:
+            print "Already on the controller: {0}".format(path)
+
+    if link_ssh is None:
+        link_ssh = ssh
+        link_blob_dir = blob_dir
+        fallback = "cp -p"
+    else:
+        fallback = "ln -sf"
+    links = []
+    for path, digest in zip(local_paths, hashes):
+        blob_path = pipes.quote("{0}/{1}".format(link_blob_dir, digest))
+        target = pipes.quote("{0}/{1}".format(remote_dir, os.path.basename(path)))
+        links.append("{{ ln -f {0} {1} 2> /dev/null || {2} {0} {1}; }}".format(blob_path, target, fallback))
+    link_ssh.exec_command(" && ".join(links), verbose=False)
+    return len(uploaded)
+
+
+def prune_blobs(ssh, blob_dir):
+    """ Remove the blobs of a stage_files store that are no longer hard linked into any job directory, except those
+    used in the last BLOB_PRUNE_MIN_AGE minutes. stage_files() only hard links or copies from such a store, so no
+    job reads a pruned blob; not for a store that is symlinked from workers (link_ssh). """
+    ssh.exec_command("[ ! -d {0} ] || find {0} -maxdepth 1 -type f -links 1 -mmin +{1} -delete".format(
+        pipes.quote(blob_dir), BLOB_PRUNE_MIN_AGE), verbose=False)
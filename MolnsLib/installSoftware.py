@@ -4,6 +4,7 @@ import paramiko
 import sys
 import time
 import logging
+from ssh import wait_for_port
 logging.getLogger('paramiko.transport').setLevel(logging.ERROR)
 
 
@@ -76,6 +77,10 @@ class InstallSW:
             "mkdir -p /home/ubuntu/.ssh/",
             "echo 'ServerAliveInterval 60' >> /home/ubuntu/.ssh/config",
         ],
+
+        # So 'molns exec wait' can block on job files instead of polling
+        [   "sudo apt-get -y install inotify-tools",
+        ],
                     
         # IPython
         [   "sudo rm -rf ipython;git clone --recursive https://github.com/Molns/ipython.git",
@@ -153,8 +158,12 @@ class InstallSW:
     MAX_NUMBER_SSH_CONNECT_ATTEMPTS = 100
     # How long (in seconds) to wait between ssh connect attempts.
     SSH_CONNECT_WAITTIME = 5
+    # How long (in seconds) to wait for the ssh port of the server to open.
+    SSH_READY_TIMEOUT = 600
     # Default SSH port
     DEFAULT_SSH_PORT = 22
+    # Seconds after which a remote install command is considered hung
+    COMMAND_TIMEOUT = 3600
 
     def __init__(self, hostname, config=None, ssh_endpoint=None, username=None, password=None):
         if config is not None:
@@ -175,6 +184,10 @@ class InstallSW:
 
     def connect(self):
         print "Connecting to {0}:{1} keyfile={2}".format(self.hostname,self.ssh_endpoint,self.keyfile)
+        if not wait_for_port(self.hostname, self.ssh_endpoint, timeout=self.SSH_READY_TIMEOUT):
+            print "ssh port not reachable!!!\t{0}:{1}".format(self.hostname,self.ssh_endpoint)
+            raise Exception("Can not connect to {0}:{1}".format(self.hostname,self.ssh_endpoint))
+        delay = 1
         for i in range(self.MAX_NUMBER_SSH_CONNECT_ATTEMPTS):
             try:
                 self.ssh.connect(self.hostname, self.ssh_endpoint, username=self.username, 
@@ -183,8 +196,9 @@ class InstallSW:
                 return
             except Exception as e:
                 #logging.exception(e)
-                print "Retry in {0} seconds...\t\t{1}".format(self.SSH_CONNECT_WAITTIME,e)
-                time.sleep(self.SSH_CONNECT_WAITTIME)
+                print "Retry in {0} seconds...\t\t{1}".format(delay,e)
+                time.sleep(delay)
+                delay = min(self.SSH_CONNECT_WAITTIME, delay * 2)
         print "ssh connect Failed!!!\t{0}:{1}".format(self.hostname,self.ssh_endpoint)
         raise Exception("Can not connect to {0}:{1}".format(self.hostname,self.ssh_endpoint))
 
@@ -294,34 +308,20 @@ class InstallSW:
         except InstallSWException:
             return False
 
-    def exec_command(self, command, pretty_command=None, verbose=True):
+    def exec_command(self, command, pretty_command=None, verbose=True, timeout=None):
+        from ssh import read_session
         if pretty_command is None:
             pretty_command = command
+        if timeout is None:
+            timeout = self.COMMAND_TIMEOUT
         try:
-            stdout_data = []
-            stderr_data = []
             self.log_exec('\n\nInstallSW.exec_command({0})\n'.format(command))
             session = self.ssh.get_transport().open_session()
             session.exec_command(command)
-            nbytes = 4096
-            #TODO add a timeout here, don't wait for commands forever.
-            while True:
-                if session.recv_ready():
-                    msg = session.recv(nbytes)
-                    stdout_data.append(msg)
-                    self.log_exec(msg)
-                if session.recv_stderr_ready():
-                    msg = session.recv_stderr(nbytes)
-                    stderr_data.append(msg)
-                    self.log_exec(msg)
-                if session.exit_status_ready():
-                    break
-                time.sleep(0.1) # Sleep breifly to prevent over-polling
-
-            status = session.recv_exit_status()
+            status, stdout_str, stderr_str = read_session(session, timeout=timeout,
+                                                          output_callback=lambda stream, msg: self.log_exec(msg))
             self.log_exec('\nInstallSW.exec_command({0}) Exit Status={1}'.format(command, status))
-            str_return = ''.join(stdout_data).splitlines()
-            stderr_str = ''.join(stderr_data)
+            str_return = stdout_str.splitlines()
             session.close()
             if status != 0:
                 raise paramiko.SSHException("Exit Code: {0}\tSTDOUT: {1}\tSTDERR: {2}\n\n".format(status, "\n".join(str_return), stderr_str))
@@ -1,15 +1,24 @@
 #!/usr/bin/env python
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
-from sqlalchemy import Column, Integer, String, Sequence
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, String, Sequence, ForeignKey
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import NullPool
+from contextlib import contextmanager
 import os
 import logging
 import sys
+import threading
 import uuid
 import datetime
+import json
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 #############################################################
 VALID_PROVIDER_TYPES = ['OpenStack', 'EC2', 'Eucalyptus', 'Docker']
@@ -24,7 +33,7 @@ class Provider(Base):
     __tablename__ = 'providers'
     id = Column(Integer, Sequence('provider_id_seq'), primary_key=True)
     type = Column(String)  # 'EC2', 'Azure', 'OpenStack'
-    name = Column(String)
+    name = Column(String, index=True)
 
     def __str__(self):
         return "Provider({0}): name={1} type={2}".format(self.id, self.name, self.type)
@@ -34,7 +43,7 @@ class ProviderData(Base):
     """ DB object to store the key/value pairs for a service provider. """
     __tablename__ = 'provider_data'
     id = Column(Integer, Sequence('provider_data_id_seq'), primary_key=True)
-    parent_id = Column(Integer)
+    parent_id = Column(Integer, ForeignKey('providers.id', ondelete='CASCADE'), index=True)
     name = Column(String)
     value = Column(String)
 
@@ -48,8 +57,8 @@ class Controller(Base):
     __tablename__ = 'controllers'
     id = Column(Integer, Sequence('controller_id_seq'), primary_key=True)
     type = Column(String)  # 'EC2', 'Azure', 'OpenStack'
-    name = Column(String)
-    provider_id = Column(Integer)
+    name = Column(String, index=True)
+    provider_id = Column(Integer, ForeignKey('providers.id', ondelete='SET NULL'), index=True)
 
     def __str__(self):
         return "Controller({0}): name={1} provider_id={2}".format(self.id, self.name, self.provider_id)
@@ -59,7 +68,7 @@ class ControllerData(Base):
     """ DB object to store the key/value pairs for a controller. """
     __tablename__ = 'controller_data'
     id = Column(Integer, Sequence('controller_data_id_seq'), primary_key=True)
-    parent_id = Column(Integer)
+    parent_id = Column(Integer, ForeignKey('controllers.id', ondelete='CASCADE'), index=True)
     name = Column(String)
     value = Column(String)
 
@@ -73,9 +82,9 @@ class WorkerGroup(Base):
     __tablename__ = 'worker_groups'
     id = Column(Integer, Sequence('worker_group_id_seq'), primary_key=True)
     type = Column(String)  # 'EC2', 'Azure', 'OpenStack'
-    name = Column(String)
-    provider_id = Column(Integer)
-    controller_id = Column(Integer)
+    name = Column(String, index=True)
+    provider_id = Column(Integer, ForeignKey('providers.id', ondelete='SET NULL'), index=True)
+    controller_id = Column(Integer, ForeignKey('controllers.id', ondelete='SET NULL'), index=True)
 
     def __str__(self):
         return "WorkerGroup({0}): name={1} provider_id={2} controller_id={3}".format(self.id, self.name,
@@ -87,7 +96,7 @@ class WorkerGroupData(Base):
     """ DB object to store the key/value pairs for a worker groups. """
     __tablename__ = 'worker_group_data'
     id = Column(Integer, Sequence('worker_group_data_id_seq'), primary_key=True)
-    parent_id = Column(Integer)
+    parent_id = Column(Integer, ForeignKey('worker_groups.id', ondelete='CASCADE'), index=True)
     name = Column(String)
     value = Column(String)
 
@@ -101,11 +110,11 @@ class Instance(Base):
     __tablename__ = 'instances'
     id = Column(Integer, Sequence('instance_id_seq'), primary_key=True)
     type = Column(String)  # 'head-node' or 'worker'
-    controller_id = Column(Integer)
-    worker_group_id = Column(Integer)
-    provider_id = Column(Integer)
+    controller_id = Column(Integer, ForeignKey('controllers.id', ondelete='SET NULL'), index=True)
+    worker_group_id = Column(Integer, ForeignKey('worker_groups.id', ondelete='SET NULL'), index=True)
+    provider_id = Column(Integer, ForeignKey('providers.id', ondelete='SET NULL'), index=True)
     ip_address = Column(String)
-    provider_instance_identifier = Column(String)
+    provider_instance_identifier = Column(String, index=True)
 
     def __str__(self):
         return "Instance({0}): provider_instance_identifier={1} provider_id={2} controller_id={3} worker_group_id={4}".format(
@@ -116,20 +125,138 @@ class ExecJob(Base):
     """ DB object for MOLNS exec jobs. """
     __tablename__ = 'jobs'
     id = Column(Integer, Sequence('instance_id_seq'), primary_key=True)
-    controller_id = Column(Integer)
+    controller_id = Column(Integer, ForeignKey('controllers.id', ondelete='SET NULL'), index=True)
     exec_str = Column(String)
-    jobID = Column(String)
+    jobID = Column(String, index=True)
+    date = Column(String)
+    # Last status seen on the controller (see Datastore.update_job_statuses()).
+    status = Column(String)
+    return_value = Column(Integer)
+    status_date = Column(String)
+    resources = Column(String)  # JSON resource usage recorded by the job runner
+    cache_key = Column(String, index=True)  # Hash of the command and its inputs, for 'exec start --cache'
+    # Set for jobs dispatched to a worker of a worker group, host is the ip address of that worker.
+    worker_group_id = Column(Integer, ForeignKey('worker_groups.id', ondelete='SET NULL'), index=True)
+    host = Column(String)
+
+    def __str__(self):
+        return "ExecJob({0}): jobID={1} controller_id={2}, worker_group_id={3}, host={4}, exec_str={5}".format(
+            self.id, self.jobID, self.controller_id, self.worker_group_id, self.host, self.exec_str)
+
+
+class SchemaVersion(Base):
+    """ DB object recording the schema migrations applied to the datastore. """
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
     date = Column(String)
 
     def __str__(self):
-        return "ExecJob({0}): jobID={1} controller_id={2}, exec_str={3}".format(self.id, self.jobID, self.controller_id,
-                                                                                self.exec_str)
+        return "SchemaVersion({0}): date={1}".format(self.version, self.date)
 
 
 class DatastoreException(Exception):
     pass
 
 
+#############################################################
+# Ordered list of (version, [SQL statements]) applied to datastores created by older versions of
+# MOLNs.  New datastores get the full schema from create_all() and are stamped with the latest version.
+# Index names follow the SQLAlchemy 'ix_<table>_<column>' convention so they match create_all().
+# SQLite can not add foreign keys to existing tables, so migrated datastores only gain the indexes.
+SCHEMA_MIGRATIONS = [
+    (1, [
+        "CREATE INDEX IF NOT EXISTS ix_providers_name ON providers (name)",
+        "CREATE INDEX IF NOT EXISTS ix_provider_data_parent_id ON provider_data (parent_id)",
+        "CREATE INDEX IF NOT EXISTS ix_controllers_name ON controllers (name)",
+        "CREATE INDEX IF NOT EXISTS ix_controllers_provider_id ON controllers (provider_id)",
+        "CREATE INDEX IF NOT EXISTS ix_controller_data_parent_id ON controller_data (parent_id)",
+        "CREATE INDEX IF NOT EXISTS ix_worker_groups_name ON worker_groups (name)",
+        "CREATE INDEX IF NOT EXISTS ix_worker_groups_provider_id ON worker_groups (provider_id)",
+        "CREATE INDEX IF NOT EXISTS ix_worker_groups_controller_id ON worker_groups (controller_id)",
+        "CREATE INDEX IF NOT EXISTS ix_worker_group_data_parent_id ON worker_group_data (parent_id)",
+        "CREATE INDEX IF NOT EXISTS ix_instances_controller_id ON instances (controller_id)",
+        "CREATE INDEX IF NOT EXISTS ix_instances_worker_group_id ON instances (worker_group_id)",
+        "CREATE INDEX IF NOT EXISTS ix_instances_provider_id ON instances (provider_id)",
+        "CREATE INDEX IF NOT EXISTS ix_instances_provider_instance_identifier ON instances (provider_instance_identifier)",
+        "CREATE INDEX IF NOT EXISTS ix_jobs_controller_id ON jobs (controller_id)",
+        "CREATE INDEX IF NOT EXISTS ix_jobs_jobID ON jobs (jobID)",
+    ]),
+    (2, [
+        "ALTER TABLE jobs ADD COLUMN status VARCHAR",
+        "ALTER TABLE jobs ADD COLUMN return_value INTEGER",
+        "ALTER TABLE jobs ADD COLUMN status_date VARCHAR",
+    ]),
+    (3, [
+        "ALTER TABLE jobs ADD COLUMN resources VARCHAR",
+    ]),
+    (4, [
+        "ALTER TABLE jobs ADD COLUMN cache_key VARCHAR",
+        "CREATE INDEX IF NOT EXISTS ix_jobs_cache_key ON jobs (cache_key)",
+    ]),
+    (5, [
+        "ALTER TABLE jobs ADD COLUMN worker_group_id INTEGER",
+        "ALTER TABLE jobs ADD COLUMN host VARCHAR",
+        "CREATE INDEX IF NOT EXISTS ix_jobs_worker_group_id ON jobs (worker_group_id)",
+    ]),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+
+# How long (in seconds) a connection waits on a locked database before failing.
+SQLITE_BUSY_TIMEOUT = 30
+# Largest number of values bound in one 'IN (...)' clause (SQLite limits the number of parameters).
+SQLITE_MAX_IN_PARAMS = 500
+
+
+def _chunks(seq, size=SQLITE_MAX_IN_PARAMS):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _sqlite_on_connect(dbapi_connection, connection_record):
+    """ Per-connection SQLite settings.  WAL lets readers proceed while another process writes. """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout={0}".format(int(SQLITE_BUSY_TIMEOUT * 1000)))
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+class DatastoreLock:
+    """ Re-entrant lock serializing datastore writers across threads and processes (using flock on a
+    file next to the database).  Readers do not take it, WAL mode keeps them unblocked. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                self._fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0600)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except Exception:
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+
 #############################################################
 HANDLE_MAPPING = {
     'Provider': (Provider, ProviderData),
@@ -183,26 +310,86 @@ class Datastore():
     def __init__(self, db_file=None, config_dir=None):
         """ Constructor. """
         if db_file is not None:
-            self.engine = create_engine('sqlite:///{0}'.format(db_file))
             if config_dir is None:
                 self.config_dir = os.path.abspath(os.path.dirname(db_file))
+            else:
+                self.config_dir = config_dir
         elif config_dir is not None:
             if not os.path.exists(config_dir):
                 os.makedirs(config_dir)
-            self.engine = create_engine('sqlite:///{0}/{1}'.format(config_dir, self.MOLNS_DATASTORE))
+            db_file = os.path.join(config_dir, self.MOLNS_DATASTORE)
             self.config_dir = config_dir
         else:
             if not os.path.exists(self.MOLNS_CONFIG_DIR):
                 os.makedirs(self.MOLNS_CONFIG_DIR)
-            self.engine = create_engine('sqlite:///{0}/{1}'.format(self.MOLNS_CONFIG_DIR, self.MOLNS_DATASTORE))
-
-        Base.metadata.create_all(self.engine)  # Create all the tables
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
-
-    def __del__(self):
-        """ Destructor. """
-        self.session.commit()
+            db_file = os.path.join(self.MOLNS_CONFIG_DIR, self.MOLNS_DATASTORE)
+            self.config_dir = self.MOLNS_CONFIG_DIR
+        # Connections are not pooled: each operation opens its own, which is cheap for SQLite and keeps
+        # the datastore safe to use from forked processes.
+        self.engine = create_engine('sqlite:///{0}'.format(db_file), poolclass=NullPool,
+                                    connect_args={'timeout': SQLITE_BUSY_TIMEOUT})
+        event.listen(self.engine, 'connect', _sqlite_on_connect)
+        self.lock = DatastoreLock(db_file + '.lock')
+        # Sessions are thread-local and live for a single operation (see _session_scope()).
+        self._sessions = scoped_session(sessionmaker(bind=self.engine, expire_on_commit=False))
+        self._scope = threading.local()
+        # Identity map of materialized Provider/Controller/WorkerGroup handles, keyed by (kind, id).
+        self._identity_map = {}
+        self._identity_names = {}
+        with self._session_scope(mutating=True) as session:
+            is_new_datastore = not self.engine.dialect.has_table(session.connection(), Provider.__tablename__)
+            Base.metadata.create_all(session.connection())  # Create all the tables
+        self._migrate_schema(is_new_datastore)
+
+    @contextmanager
+    def _session_scope(self, mutating=False):
+        """ Provide a session for one datastore operation.  The outermost scope of a thread commits (or
+        rolls back) and discards the session, nested scopes share it.  Mutating operations hold the
+        cross-process datastore lock for their whole transaction. """
+        if mutating:
+            self.lock.acquire()
+        depth = getattr(self._scope, 'depth', 0)
+        self._scope.depth = depth + 1
+        session = self._sessions()
+        try:
+            yield session
+            if depth == 0:
+                session.commit()
+        except Exception:
+            if depth == 0:
+                session.rollback()
+            raise
+        finally:
+            self._scope.depth = depth
+            if depth == 0:
+                self._sessions.remove()
+            if mutating:
+                self.lock.release()
+
+    def _migrate_schema(self, is_new_datastore=False):
+        """ Bring the datastore schema up to SCHEMA_VERSION, applying each pending migration in its own
+        transaction. """
+        with self._session_scope(mutating=True) as session:
+            current = 0
+            v = session.query(SchemaVersion).order_by(SchemaVersion.version.desc()).first()
+            if v is not None:
+                current = v.version
+            elif is_new_datastore:
+                current = SCHEMA_VERSION
+                session.add(SchemaVersion(version=current, date=str(datetime.datetime.now())))
+        for (version, statements) in SCHEMA_MIGRATIONS:
+            if version <= current:
+                continue
+            logging.debug("Migrating datastore schema to version {0}".format(version))
+            try:
+                with self._session_scope(mutating=True) as session:
+                    if session.query(SchemaVersion).filter_by(version=version).first() is not None:
+                        continue  # Applied by a concurrent molns process.
+                    for stmt in statements:
+                        session.execute(stmt)
+                    session.add(SchemaVersion(version=version, date=str(datetime.datetime.now())))
+            except Exception as e:
+                raise DatastoreException("Schema migration to version {0} failed: {1}".format(version, e))
 
     def list_objects(self, kind):
         """ Get all the currently configured objects of kind (Provider, Controller, WorkerGroup).
@@ -213,7 +400,8 @@ class Datastore():
         if kind not in HANDLE_MAPPING:
             raise DatastoreException("Unknown kind {0}".format(kind))
         (handle, d_handle) = HANDLE_MAPPING[kind]
-        return self.session.query(handle).all()
+        with self._session_scope() as session:
+            return session.query(handle).all()
 
     def create_object(self, ptype, name, kind, **kwargs):
         """ Setup a new objects of kind (Provider, Controller, WorkerGroup).
@@ -227,7 +415,8 @@ class Datastore():
         if kind not in HANDLE_MAPPING:
             raise DatastoreException("Unknown kind {0}".format(kind))
         (handle, d_handle) = HANDLE_MAPPING[kind]
-        p = self.session.query(handle).filter_by(name=name).first()
+        with self._session_scope() as session:
+            p = session.query(handle).filter_by(name=name).first()
         if p is not None:
             raise DatastoreException("{1} {0} already exists with type".format(name, kind, p.type))
 
@@ -254,12 +443,18 @@ class Datastore():
         if kind not in HANDLE_MAPPING:
             raise DatastoreException("Unknown kind {0}".format(kind))
         (handle, d_handle) = HANDLE_MAPPING[kind]
-        p = self.session.query(handle).filter_by(name=name).first()
-        if p is None:
-            raise DatastoreException("{0} {1} not found".format(kind, name))
-        logging.debug("Deleting entry: {0}".format(p))
-        self.session.delete(p)
-        self.session.commit()
+        with self._session_scope(mutating=True) as session:
+            p = session.query(handle).filter_by(name=name).first()
+            if p is None:
+                raise DatastoreException("{0} {1} not found".format(kind, name))
+            logging.debug("Deleting entry: {0}".format(p))
+            # Deletes cascade to the data rows and null out references held by other objects, so
+            # drop every materialized object rather than just this one.
+            self._identity_map.clear()
+            self._identity_names.clear()
+            # Datastores migrated from older versions have no foreign keys, delete the data rows explicitly.
+            session.query(d_handle).filter_by(parent_id=p.id).delete()
+            session.delete(p)
 
     def get_object(self, name, kind):
         """ Get a config object of of kind (Provider, Controller, WorkerGroup).
@@ -274,11 +469,13 @@ class Datastore():
         """
         if kind not in HANDLE_MAPPING:
             raise DatastoreException("Unknown kind {0}".format(kind))
+        if (kind, name) in self._identity_names:
+            return self._identity_map[(kind, self._identity_names[(kind, name)])]
         (handle, d_handle) = HANDLE_MAPPING[kind]
-        p = self.session.query(handle).filter_by(name=name).first()
-        if p is None:
+        loaded = self._load_objects(kind, handle.name == name)
+        if len(loaded) == 0:
             raise DatastoreException("{0} {1} not found".format(kind, name))
-        return self._get_object_data(d_handle, kind, p.type, p)
+        return loaded[0]
 
     def get_object_by_id(self, id, kind):
         """ Get a config object of of kind (Provider, Controller, WorkerGroup).
@@ -293,19 +490,86 @@ class Datastore():
         """
         if kind not in HANDLE_MAPPING:
             raise DatastoreException("Unknown kind {0}".format(kind))
+        if (kind, id) in self._identity_map:
+            return self._identity_map[(kind, id)]
         (handle, d_handle) = HANDLE_MAPPING[kind]
-        p = self.session.query(handle).filter_by(id=id).first()
-        if p is None:
+        loaded = self._load_objects(kind, handle.id == id)
+        if len(loaded) == 0:
             raise DatastoreException("{0} {1} not found".format(kind, id))
-        return self._get_object_data(d_handle, kind, p.type, p)
+        return loaded[0]
 
-    def _get_object_data(self, d_handle, kind, ptype, p):
-        data = {}
-        p_data = self.session.query(d_handle).filter_by(parent_id=p.id).all()
-        for d in p_data:
-            data[d.name] = d.value
+    def get_object_names(self, kind):
+        """ Get the names of all objects of kind (Provider, Controller, WorkerGroup) without materializing them,
+        so that listing commands do not import the provider modules (and their cloud SDKs).
 
-        p_handle = get_provider_handle(kind, ptype)
+        Args:
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        Returns:
+            A dict mapping object id to name.
+        """
+        if kind not in HANDLE_MAPPING:
+            raise DatastoreException("Unknown kind {0}".format(kind))
+        (handle, d_handle) = HANDLE_MAPPING[kind]
+        with self._session_scope() as session:
+            return dict(session.query(handle.id, handle.name).all())
+
+    def preload_objects(self, ids, kind):
+        """ Materialize every object of kind (Provider, Controller, WorkerGroup) in 'ids' with a single
+        query, so that later calls to get_object_by_id() are served from the identity map.
+
+        Args:
+            ids: an iterable of int, the ids of the objects (None values are ignored).
+            kind: a str, the kind of object, one of (Provider, Controller, WorkerGroup).
+        """
+        if kind not in HANDLE_MAPPING:
+            raise DatastoreException("Unknown kind {0}".format(kind))
+        (handle, d_handle) = HANDLE_MAPPING[kind]
+        missing = set([i for i in ids if i is not None and (kind, i) not in self._identity_map])
+        for chunk in _chunks(missing):
+            self._load_objects(kind, handle.id.in_(chunk))
+
+    def preload_instance_objects(self, instances):
+        """ Materialize the Provider, Controller and WorkerGroup objects referenced by a list of instances
+        (or jobs), using one query per kind. """
+        self.preload_objects([getattr(i, 'provider_id', None) for i in instances], 'Provider')
+        self.preload_objects([getattr(i, 'controller_id', None) for i in instances], 'Controller')
+        self.preload_objects([getattr(i, 'worker_group_id', None) for i in instances], 'WorkerGroup')
+
+    def _load_objects(self, kind, criterion):
+        """ Load the objects of 'kind' matching 'criterion', eager loading their key/value data rows in
+        the same (outer joined) query.  The provider and controller of each object are resolved in one
+        batch per kind.  Returns the list of loaded objects (None for unknown provider types). """
+        (handle, d_handle) = HANDLE_MAPPING[kind]
+        with self._session_scope() as session:
+            rows = session.query(handle, d_handle).outerjoin(d_handle, d_handle.parent_id == handle.id).filter(
+                criterion).order_by(handle.id).all()
+        records = OrderedDict()
+        for (p, d) in rows:
+            if p.id not in records:
+                records[p.id] = (p, {})
+            if d is not None:
+                records[p.id][1][d.name] = d.value
+        if len(records) == 0:
+            return []
+        if hasattr(handle, 'provider_id'):
+            self.preload_objects([p.provider_id for (p, data) in records.values()], 'Provider')
+        if hasattr(handle, 'controller_id'):
+            self.preload_objects([p.controller_id for (p, data) in records.values()], 'Controller')
+        ret = []
+        for (p, data) in records.values():
+            if (kind, p.id) not in self._identity_map:
+                self._identity_map[(kind, p.id)] = self._get_object_data(kind, p, data)
+                self._identity_names[(kind, p.name)] = p.id
+            ret.append(self._identity_map[(kind, p.id)])
+        return ret
+
+    def _evict_object(self, kind, id, name):
+        """ Remove an object from the identity map. """
+        self._identity_map.pop((kind, id), None)
+        self._identity_names.pop((kind, name), None)
+
+    def _get_object_data(self, kind, p, data):
+        p_handle = get_provider_handle(kind, p.type)
         # logging.debug("{2}(name={0}, data={1})".format(name,data,p_handle))
         if p_handle is None:
             return None
@@ -338,60 +602,92 @@ class Datastore():
         if kind not in HANDLE_MAPPING:
             raise DatastoreException("Unknown kind {0}".format(kind))
         (handle, d_handle) = HANDLE_MAPPING[kind]
-        p = self.session.query(handle).filter_by(name=config.name).first()
-        if p is None:
-            # Add new entry.
-            p = handle(name=config.name, type=config.type)
-            self.session.add(p)
-            # logging.debug("Created new DB entry: {0}".format(p))
-        # print "save_object() config.__dict__={0}".format(config.__dict__)
-        if 'provider_id' in config.__dict__:
-            logging.debug(
-                "provider_id is in config.__dict__ {0} {1}".format(config.provider_id, type(config.provider_id)))
-            p.provider_id = config.provider_id
-        if 'controller_id' in config.__dict__:
-            logging.debug("controller_id is in config.__dict__ {0}".format(config.controller_id))
-            p.controller_id = config.controller_id
-        # logging.debug("Updated DB entry: {0}".format(p))
-        self.session.commit()
-
-        data = config.config.copy()
-        p_data = self.session.query(d_handle).filter_by(parent_id=p.id).all()
-        for d in p_data:
-            if d.name in data:
-                d.value = data[d.name]
-                del data[d.name]
-            else:
-                # logging.debug("Deleting entry: {0}".format(d))
-                self.session.delete(d)
-        for d in data.keys():
-            dd = d_handle(parent_id=p.id, name=d, value=data[d])
-            # logging.debug("Created new entry: {0}".format(dd))
-            self.session.add(dd)
-        self.session.commit()
+        with self._session_scope(mutating=True) as session:
+            p = session.query(handle).filter_by(name=config.name).first()
+            if p is not None and self._identity_map.get((kind, p.id)) is not config:
+                # A different handle for this object was materialized earlier; drop it so it is reloaded.
+                self._evict_object(kind, p.id, p.name)
+            if p is None:
+                # Add new entry.
+                p = handle(name=config.name, type=config.type)
+                session.add(p)
+                # logging.debug("Created new DB entry: {0}".format(p))
+            # print "save_object() config.__dict__={0}".format(config.__dict__)
+            if 'provider_id' in config.__dict__:
+                logging.debug(
+                    "provider_id is in config.__dict__ {0} {1}".format(config.provider_id, type(config.provider_id)))
+                p.provider_id = config.provider_id
+            if 'controller_id' in config.__dict__:
+                logging.debug("controller_id is in config.__dict__ {0}".format(config.controller_id))
+                p.controller_id = config.controller_id
+            # logging.debug("Updated DB entry: {0}".format(p))
+            session.flush()
+
+            data = config.config.copy()
+            p_data = session.query(d_handle).filter_by(parent_id=p.id).all()
+            for d in p_data:
+                if d.name in data:
+                    d.value = data[d.name]
+                    del data[d.name]
+                else:
+                    # logging.debug("Deleting entry: {0}".format(d))
+                    session.delete(d)
+            for d in data.keys():
+                dd = d_handle(parent_id=p.id, name=d, value=data[d])
+                # logging.debug("Created new entry: {0}".format(dd))
+                session.add(dd)
 
     def get_instance_by_id(self, id):
         """ Create or get the value for an instance. """
-        return self.session.query(Instance).filter_by(id=id).first()
+        with self._session_scope() as session:
+            return session.query(Instance).filter_by(id=id).first()
 
     def get_instance(self, provider_instance_identifier, ip_address, provider_id=None, controller_id=None,
                      worker_group_id=None, provider_type=None):
         """ Create or get the value for an instance. """
-        p = self.session.query(Instance).filter_by(provider_instance_identifier=provider_instance_identifier).first()
-        if p is None:
-            p = Instance(provider_instance_identifier=provider_instance_identifier, ip_address=ip_address,
-                         provider_id=provider_id, controller_id=controller_id, worker_group_id=worker_group_id)
-            self.session.add(p)
-            self.session.commit()
-            # logging.debug("Creating instance: {0}".format(p))
-        else:
-            # logging.debug("Fetching instance: {0}".format(p))
-            pass
-        return p
+        return self.register_instances([(provider_instance_identifier, ip_address)], provider_id=provider_id,
+                                       controller_id=controller_id, worker_group_id=worker_group_id)[0]
+
+    def register_instances(self, instances, provider_id=None, controller_id=None, worker_group_id=None):
+        """ Create or get the values for many instances in a single transaction.
+
+        Args:
+            instances: a list of (provider_instance_identifier, ip_address) tuples.
+            provider_id, controller_id, worker_group_id: set on the newly created instances.
+        Returns:
+            A list of Instance objects, in the same order as 'instances'.
+        """
+        identifiers = [pid for (pid, ip) in instances]
+        with self._session_scope(mutating=True) as session:
+            existing = {}
+            for chunk in _chunks(identifiers):
+                for p in session.query(Instance).filter(Instance.provider_instance_identifier.in_(chunk)):
+                    existing[p.provider_instance_identifier] = p
+            ret = []
+            for (provider_instance_identifier, ip_address) in instances:
+                p = existing.get(provider_instance_identifier)
+                if p is None:
+                    p = Instance(provider_instance_identifier=provider_instance_identifier, ip_address=ip_address,
+                                 provider_id=provider_id, controller_id=controller_id,
+                                 worker_group_id=worker_group_id)
+                    session.add(p)
+                    existing[provider_instance_identifier] = p
+                    # logging.debug("Creating instance: {0}".format(p))
+                ret.append(p)
+        return ret
+
+    def update_instances(self, instances):
+        """ Persist changes made to instance objects (e.g. a new ip_address after a resume). """
+        if not isinstance(instances, list):
+            instances = [instances]
+        with self._session_scope(mutating=True) as session:
+            for instance in instances:
+                session.merge(instance)
 
     def get_controller_instances(self, controller_id=None):
         logging.debug("get_controller_instances by controller_id={0}".format(controller_id))
-        ret = self.session.query(Instance).filter_by(controller_id=controller_id, worker_group_id=None).all()
+        with self._session_scope() as session:
+            ret = session.query(Instance).filter_by(controller_id=controller_id, worker_group_id=None).all()
         if ret is None:
             return []
         else:
@@ -399,25 +695,27 @@ class Datastore():
 
     def get_worker_instances(self, controller_id=None):
         # logging.debug("get_worker_instances by controller_id={0}".format(controller_id))
-        ret = self.session.query(Instance).filter_by(controller_id=controller_id).filter(
-            Instance.worker_group_id != None).all()
+        with self._session_scope() as session:
+            ret = session.query(Instance).filter_by(controller_id=controller_id).filter(
+                Instance.worker_group_id != None).all()
         if ret is None:
             return []
         else:
             return ret
 
     def get_all_instances(self, provider_id=None, controller_id=None, worker_group_id=None):
-        if provider_id is not None:
-            # logging.debug("get_all_instances by provider_id={0}".format(provider_id))
-            ret = self.session.query(Instance).filter_by(provider_id=provider_id).all()
-        elif controller_id is not None:
-            # logging.debug("get_all_instances by controller_id={0}".format(controller_id))
-            ret = self.session.query(Instance).filter_by(controller_id=controller_id).all()
-        elif worker_group_id is not None:
-            # logging.debug("get_all_instances by worker_group_id={0}".format(worker_group_id))
-            ret = self.session.query(Instance).filter_by(worker_group_id=worker_group_id).all()
-        else:
-            ret = self.session.query(Instance).all()
+        with self._session_scope() as session:
+            if provider_id is not None:
+                # logging.debug("get_all_instances by provider_id={0}".format(provider_id))
+                ret = session.query(Instance).filter_by(provider_id=provider_id).all()
+            elif controller_id is not None:
+                # logging.debug("get_all_instances by controller_id={0}".format(controller_id))
+                ret = session.query(Instance).filter_by(controller_id=controller_id).all()
+            elif worker_group_id is not None:
+                # logging.debug("get_all_instances by worker_group_id={0}".format(worker_group_id))
+                ret = session.query(Instance).filter_by(worker_group_id=worker_group_id).all()
+            else:
+                ret = session.query(Instance).all()
         if ret is None:
             return []
         else:
@@ -426,15 +724,24 @@ class Datastore():
     def delete_instance(self, instance):
         """ Delete an instance. """
         # logging.debug("Deleting instance: {0}".format(instance))
-        self.session.delete(instance)
-        self.session.commit()
+        self.delete_instances([instance])
+
+    def delete_instances(self, instances):
+        """ Delete many instances in a single transaction. """
+        ids = [i.id for i in instances]
+        if len(ids) == 0:
+            return
+        with self._session_scope(mutating=True) as session:
+            for chunk in _chunks(ids):
+                session.query(Instance).filter(Instance.id.in_(chunk)).delete(synchronize_session=False)
 
     def get_all_jobs(self, controller_id=None):
-        if controller_id is not None:
-            # logging.debug("get_all_instances by controller_id={0}".format(controller_id))
-            ret = self.session.query(ExecJob).filter_by(controller_id=controller_id).all()
-        else:
-            ret = self.session.query(ExecJob).all()
+        with self._session_scope() as session:
+            if controller_id is not None:
+                # logging.debug("get_all_instances by controller_id={0}".format(controller_id))
+                ret = session.query(ExecJob).filter_by(controller_id=controller_id).all()
+            else:
+                ret = session.query(ExecJob).all()
         if ret is None:
             return []
         else:
@@ -443,25 +750,49 @@ class Datastore():
     def get_job(self, jobID):
         """ Get the objet for a job. """
         # logging.debug("get_job(jobID={0})".format(jobID))
-        try:
-            id = int(jobID)
-            j = self.session.query(ExecJob).filter_by(id=id).first()
-        except Exception:
-            j = self.session.query(ExecJob).filter_by(jobID=jobID).first()
+        with self._session_scope() as session:
+            try:
+                id = int(jobID)
+                j = session.query(ExecJob).filter_by(id=id).first()
+            except Exception:
+                j = session.query(ExecJob).filter_by(jobID=jobID).first()
         if j is None:
             raise DatastoreException("Job {0} not found".format(jobID))
         return j
 
-    def start_job(self, controller_id=None, exec_str=None):
+    def get_jobs_by_cache_key(self, controller_id, cache_key):
+        """ Jobs on the controller with the given cache key, most recent first. """
+        with self._session_scope() as session:
+            return session.query(ExecJob).filter_by(controller_id=controller_id, cache_key=cache_key).order_by(
+                ExecJob.id.desc()).all()
+
+    def start_job(self, controller_id=None, exec_str=None, cache_key=None, worker_group_id=None, host=None):
         """ Create the objet for a job. """
         date_str = str(datetime.datetime.now())
         jobID = str(uuid.uuid4())
-        j = ExecJob(jobID=jobID, controller_id=controller_id, exec_str=exec_str, date=date_str)
-        self.session.add(j)
-        self.session.commit()
+        j = ExecJob(jobID=jobID, controller_id=controller_id, exec_str=exec_str, date=date_str, cache_key=cache_key,
+                    worker_group_id=worker_group_id, host=host)
+        with self._session_scope(mutating=True) as session:
+            session.add(j)
         logging.debug("Creating ExecJob: {0}".format(j))
         return j
 
+    def update_job_statuses(self, statuses):
+        """ Record the status of many jobs in a single transaction.
+        Args:
+            statuses: a dict {jobID: (status str, return value int or None, resource usage dict or None)}.
+        """
+        if len(statuses) == 0:
+            return
+        date_str = str(datetime.datetime.now())
+        with self._session_scope(mutating=True) as session:
+            for chunk in _chunks(statuses.keys()):
+                for j in session.query(ExecJob).filter(ExecJob.jobID.in_(chunk)).all():
+                    j.status, j.return_value, resources = statuses[j.jobID]
+                    if resources is not None:
+                        j.resources = json.dumps(resources)
+                    j.status_date = date_str
+
     def delete_job(self, job):
-        self.session.delete(job)
-        self.session.commit()
+        with self._session_scope(mutating=True) as session:
+            session.query(ExecJob).filter_by(id=job.id).delete()
@@ -1,40 +1,467 @@
 #!/usr/bin/env python
+""" Controller side runner for 'molns exec' jobs.
+
+Every job has a directory under the job root (REMOTE_EXEC_JOB_PATH) with its command in .molns/cmd. Starting this
+script in a job directory queues that job (.molns/state = 'queued') and, unless another runner is already active,
+runs the queue: jobs are started by priority, then submission time, with at most 'slots' running at a time. The
+queue is persistent, a job stays queued in its directory until a runner starts it.
+
+Files in a job's .molns directory:
+    cmd             the command line
+    priority        an int, higher runs first (optional, default 0)
+    state           'queued', 'running' or 'finished'
+    pid             pid of the running command
+    return_value    exit code of the command
+    resources.json  wall time, cpu time, max rss and i/o counters of the command (written before return_value)
+    stdout          output (stdout and stderr) of the command
+    collect         a directory the job directory is copied to once the job has finished (optional, used for jobs
+                    run on workers, to bring the results back to the controller's shared area)
+
+Array jobs also have .molns/array, a command template, and .molns/array_params, the name of a parameter file in the
+job directory. When the runner starts an array job it expands it into one task per line of the parameter file, in
+.molns/tasks/<n>/ (with the same files as above, the command is run in the job directory). A line is either a json
+object, whose keys are used as named fields of the template, or whitespace separated values used as positional
+fields; {task} is the task number. Tasks share the slots with other jobs. The output of every finished task is
+appended to the job's stdout, and once all tasks have finished the job's return_value is the number of failed
+tasks. An array job has no pid file of its own, runner_pid holds the pid of the runner running its tasks (to tell if
+the job is still being run, never to signal it). Creating .molns/cancel, or removing the job directory, makes the
+runner stop the job's running tasks and start no more of them.
+
+The number of slots is read from <job root>/.slots if it exists, otherwise it is the number of cpus minus the number
+of IPython engines running on the host (at least 1).
+"""
+import errno
+import fcntl
+import multiprocessing
 import os
+import shutil
 import subprocess
 import shlex
 import json
+import select
+import signal
+import time
 import traceback
-import sys
 
+# Seconds between checks of the queue, the runner also wakes up as soon as a job exits.
+POLL_INTERVAL = 1
+# Lock held by the active runner.
+RUNNER_LOCK_FILE = ".runner.lock"
+# Optional file with the number of slots.
+SLOTS_FILE = ".slots"
+
+
+def read_file(path, default=None):
+    try:
+        with open(path) as fd:
+            return fd.read().strip()
+    except IOError:
+        return default
+
+
+def write_file(path, value):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as fd:
+        fd.write(str(value))
+    os.rename(tmp_path, path)
+
+
+def count_engines():
+    """ Number of IPython engines running on this host. """
+    count = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        cmdline = read_file('/proc/{0}/cmdline'.format(pid), '')
+        if 'ipengine' in cmdline:
+            count += 1
+    return count
+
+
+def get_slots(job_root):
+    slots = read_file(os.path.join(job_root, SLOTS_FILE))
+    if slots is not None:
+        try:
+            return max(1, int(slots))
+        except ValueError:
+            pass
+    return max(1, multiprocessing.cpu_count() - count_engines())
+
+
+def enqueue(job_dir):
+    """ Mark the job in job_dir as queued (once). """
+    state_file = os.path.join(job_dir, ".molns", "state")
+    if not os.path.exists(state_file):
+        write_file(state_file, "queued")
+
+
+def list_queued(job_root):
+    """ (-priority, submission time, directory) of the queued jobs, in the order they should run. """
+    queued = []
+    for name in os.listdir(job_root):
+        job_dir = os.path.join(job_root, name)
+        if name.startswith('.') or not os.path.isdir(job_dir):
+            continue
+        state_file = os.path.join(job_dir, ".molns", "state")
+        if read_file(state_file) != "queued":
+            continue
+        try:
+            priority = int(read_file(os.path.join(job_dir, ".molns", "priority"), 0))
+        except ValueError:
+            priority = 0
+        try:
+            submitted = os.path.getmtime(state_file)
+        except OSError:
+            continue
+        queued.append((-priority, submitted, job_dir))
+    return sorted(queued)
+
+
+def read_proc_io(pid):
+    """ The i/o counters of a process from /proc/<pid>/io (also readable while it is a zombie), {} if unavailable. """
+    counters = {}
+    for line in read_file('/proc/{0}/io'.format(pid), '').splitlines():
+        name, _, value = line.partition(':')
+        try:
+            counters[name.strip()] = int(value)
+        except ValueError:
+            pass
+    return counters
+
+
+def resource_usage(started, finished, rusage, io):
+    """ The accounting record of a finished job, from its wait4() rusage and last /proc i/o counters. """
+    return {
+        'started': started,
+        'finished': finished,
+        'wall_time': finished - started,
+        'user_time': rusage.ru_utime,
+        'system_time': rusage.ru_stime,
+        'max_rss_kb': rusage.ru_maxrss,
+        'read_bytes': io.get('read_bytes'),
+        'write_bytes': io.get('write_bytes'),
+        'rchar': io.get('rchar'),
+        'wchar': io.get('wchar'),
+    }
+
+
+def start_job(job_dir, meta_dir=None):
+    """ Start the command in meta_dir/cmd (default the job's .molns directory) in job_dir, returns (Popen, stdout
+    file, start time) or None if it could not be started. """
+    if meta_dir is None:
+        meta_dir = os.path.join(job_dir, ".molns")
+    try:
+        stdout_fh = open(os.path.join(meta_dir, "stdout"), 'w')
+    except IOError:
+        return None  # The job was removed by 'molns exec cleanup'
+    try:
+        exec_str = read_file(os.path.join(meta_dir, "cmd"), '')
+        p = subprocess.Popen(
+            shlex.split(exec_str),
+            stdout=stdout_fh,
+            stderr=stdout_fh,
+            cwd=job_dir,
+        )
+    except Exception as e:
+        stdout_fh.write('Error: {}'.format(str(e)))
+        stdout_fh.write(traceback.format_exc())
+        stdout_fh.close()
+        write_file(os.path.join(meta_dir, "return_value"), -1)
+        write_file(os.path.join(meta_dir, "state"), "finished")
+        return None
+    write_file(os.path.join(meta_dir, "pid"), p.pid)
+    write_file(os.path.join(meta_dir, "state"), "running")
+    return p, stdout_fh, time.time()
+
+
+def finish_job(meta_dir, return_code, resources=None):
+    print "Return code:", meta_dir, return_code
+    if not os.path.isdir(meta_dir):
+        return  # The job was removed by 'molns exec cleanup'
+    if resources is not None:
+        write_file(os.path.join(meta_dir, "resources.json"), json.dumps(resources))
+    write_file(os.path.join(meta_dir, "return_value"), return_code)
+    write_file(os.path.join(meta_dir, "state"), "finished")
+
+
+class ArrayJob:
+    """ Bookkeeping of the runner for an array job it is running. """
+
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        self.tasks_dir = os.path.join(job_dir, ".molns", "tasks")
+        try:
+            self.priority = int(read_file(os.path.join(job_dir, ".molns", "priority"), 0))
+        except ValueError:
+            self.priority = 0
+        self.submitted = os.path.getmtime(os.path.join(job_dir, ".molns", "state"))
+        self.started = time.time()
+        self.pending = []
+        self.running = 0
+        self.failed = 0
+        self.user_time = 0.0
+        self.system_time = 0.0
+        self.max_rss_kb = 0
 
-def run_job(exec_str, stdout_file):
-        with open(stdout_file, 'w') as stdout_fh:
+    def task_dir(self, task):
+        return os.path.join(self.tasks_dir, str(task))
+
+    def is_cancelled(self):
+        meta_dir = os.path.join(self.job_dir, ".molns")
+        return not os.path.isdir(meta_dir) or os.path.exists(os.path.join(meta_dir, "cancel"))
+
+    def expand(self):
+        """ Create the task directories from the template and the parameter file. """
+        template = read_file(os.path.join(self.job_dir, ".molns", "array"), '')
+        params_file = os.path.join(self.job_dir, read_file(os.path.join(self.job_dir, ".molns", "array_params"), ''))
+        task = 0
+        with open(params_file) as fd:
+            for line in fd:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                if line.startswith('{'):
+                    cmd = template.format(task=task, **json.loads(line))
+                else:
+                    cmd = template.format(*shlex.split(line), task=task)
+                os.makedirs(self.task_dir(task))
+                write_file(os.path.join(self.task_dir(task), "cmd"), cmd)
+                write_file(os.path.join(self.task_dir(task), "state"), "queued")
+                self.pending.append(task)
+                task += 1
+
+    def resume(self):
+        """ Pick up an array job left running by a runner that exited; its unfinished tasks are run again. """
+        for name in os.listdir(self.tasks_dir):
+            if read_file(os.path.join(self.tasks_dir, name, "state")) == "finished":
+                try:
+                    if int(read_file(os.path.join(self.tasks_dir, name, "return_value"), 0)) != 0:
+                        self.failed += 1
+                except ValueError:
+                    self.failed += 1
+            else:
+                self.pending.append(int(name))
+        self.pending.sort()
+
+    def finish_task(self, task, return_code, resources):
+        self.running -= 1
+        if return_code != 0:
+            self.failed += 1
+        self.user_time += resources['user_time']
+        self.system_time += resources['system_time']
+        self.max_rss_kb = max(self.max_rss_kb, resources['max_rss_kb'])
+        # Aggregated log of all tasks.
+        try:
+            with open(os.path.join(self.job_dir, ".molns", "stdout"), 'a') as out_fh:
+                out_fh.write("==== task {0} (return value {1}) ====\n".format(task, return_code))
+                with open(os.path.join(self.task_dir(task), "stdout")) as task_fh:
+                    shutil.copyfileobj(task_fh, out_fh)
+        except IOError:
+            pass  # The job was removed by 'molns exec cleanup'
+
+    def is_done(self):
+        return len(self.pending) == 0 and self.running == 0
+
+    def finish(self):
+        finished = time.time()
+        finish_job(os.path.join(self.job_dir, ".molns"), self.failed, {
+            'started': self.started,
+            'finished': finished,
+            'wall_time': finished - self.started,
+            'user_time': self.user_time,
+            'system_time': self.system_time,
+            'max_rss_kb': self.max_rss_kb,
+            'read_bytes': None,
+            'write_bytes': None,
+            'rchar': None,
+            'wchar': None,
+        })
+
+
+def collect_results(job_dir):
+    """ Start copying a finished job to the directory in .molns/collect, returns the copy's Popen or None. """
+    collect_dir = read_file(os.path.join(job_dir, ".molns", "collect"))
+    if collect_dir is None:
+        return None
+    dest = os.path.join(collect_dir, os.path.basename(job_dir))
+    # Copy to a temporary name first, so a directory under the final name is always complete.
+    return subprocess.Popen(['sh', '-c', 'mkdir -p "$1" && rm -rf "$2.tmp" "$2" && cp -r "$3" "$2.tmp" && '
+                                         'mv "$2.tmp" "$2"', 'collect', collect_dir, dest, job_dir])
+
+
+def is_array_job(job_dir):
+    return os.path.exists(os.path.join(job_dir, ".molns", "array"))
+
+
+def start_array_job(job_dir):
+    """ Expand a queued array job into its tasks, returns its ArrayJob or None if it could not be expanded. """
+    meta_dir = os.path.join(job_dir, ".molns")
+    try:
+        array = ArrayJob(job_dir)
+        array.expand()
+    except Exception as e:
+        with open(os.path.join(meta_dir, "stdout"), 'a') as stdout_fh:
+            stdout_fh.write('Error: {}'.format(str(e)))
+            stdout_fh.write(traceback.format_exc())
+        finish_job(meta_dir, -1)
+        return None
+    # Not written to 'pid', 'molns exec cleanup' kills that process and the runner is shared by all jobs.
+    write_file(os.path.join(meta_dir, "runner_pid"), os.getpid())
+    write_file(os.path.join(meta_dir, "state"), "running")
+    return array
+
+
+def find_orphaned_arrays(job_root):
+    """ Array jobs left in the 'running' state by a runner that exited. """
+    arrays = {}
+    for name in os.listdir(job_root):
+        job_dir = os.path.join(job_root, name)
+        if name.startswith('.') or not is_array_job(job_dir):
+            continue
+        if read_file(os.path.join(job_dir, ".molns", "state")) == "running":
+            array = ArrayJob(job_dir)
+            array.resume()
+            write_file(os.path.join(job_dir, ".molns", "runner_pid"), os.getpid())
+            arrays[job_dir] = array
+    return arrays
+
+
+def watch_children():
+    """ Make SIGCHLD write to a pipe, returns its (non blocking) read end for wait_for_children(). """
+    wakeup_r, wakeup_w = os.pipe()
+    for fd in (wakeup_r, wakeup_w):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    # set_wakeup_fd() only works with a Python handler installed, restart other system calls it interrupts.
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.siginterrupt(signal.SIGCHLD, False)
+    signal.set_wakeup_fd(wakeup_w)
+    return wakeup_r, wakeup_w
+
+
+def unwatch_children(wakeup_fds):
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    for fd in wakeup_fds:
+        os.close(fd)
+
+
+def wait_for_children(wakeup_fd, timeout):
+    """ Sleep until a child process exits or for at most timeout seconds. A child that exited since the last call
+    ends the wait at once, its SIGCHLD is still in the pipe. """
+    try:
+        select.select([wakeup_fd], [], [], timeout)
+    except select.error as e:
+        if e.args[0] != errno.EINTR:
+            raise
+    try:
+        while os.read(wakeup_fd, 4096):
+            pass
+    except OSError as e:
+        if e.errno != errno.EAGAIN:
+            raise
+
+
+def run_queue(job_root):
+    """ Run queued jobs until the queue is empty and all started jobs have finished. """
+    wakeup_fds = watch_children()
+    try:
+        running = {}
+        arrays = find_orphaned_arrays(job_root)
+        collecting = []
+        while True:
+            collecting = [p for p in collecting if p is not None and p.poll() is None]
+            for (job_dir, task), (p, stdout_fh, started) in running.items():
+                # Read the i/o counters first, they are gone once the process is reaped.
+                io = read_proc_io(p.pid)
+                pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+                if pid != 0:
+                    finished = time.time()
+                    if os.WIFSIGNALED(status):
+                        p.returncode = -os.WTERMSIG(status)
+                    else:
+                        p.returncode = os.WEXITSTATUS(status)
+                    stdout_fh.close()
+                    resources = resource_usage(started, finished, rusage, io)
+                    del running[(job_dir, task)]
+                    if task is None:
+                        finish_job(os.path.join(job_dir, ".molns"), p.returncode, resources)
+                        collecting.append(collect_results(job_dir))
+                    else:
+                        finish_job(arrays[job_dir].task_dir(task), p.returncode, resources)
+                        arrays[job_dir].finish_task(task, p.returncode, resources)
+            for job_dir, array in arrays.items():
+                if array.is_cancelled() and (len(array.pending) > 0 or array.running > 0):
+                    array.pending = []
+                    for (running_dir, task), (p, _, _) in running.items():
+                        if running_dir == job_dir:
+                            p.terminate()
+                if array.is_done():
+                    array.finish()
+                    if os.path.isdir(job_dir):
+                        collecting.append(collect_results(job_dir))
+                    del arrays[job_dir]
+
+            # Array jobs are expanded as soon as they are seen, their tasks then queue with the plain jobs.
+            queued = []
+            for (priority, submitted, job_dir) in list_queued(job_root):
+                if is_array_job(job_dir):
+                    array = start_array_job(job_dir)
+                    if array is not None:
+                        arrays[job_dir] = array
+                    else:
+                        collecting.append(collect_results(job_dir))
+                else:
+                    queued.append((priority, submitted, 0, job_dir, None))
+            slots = get_slots(job_root)
+            for job_dir, array in arrays.items():
+                # Only the next few tasks of each array can get a slot in this round.
+                for task in array.pending[:slots]:
+                    queued.append((-array.priority, array.submitted, task, job_dir, task))
+            queued.sort()
+
+            while len(queued) > 0 and len(running) < slots:
+                (_, _, _, job_dir, task) = queued.pop(0)
+                if task is None:
+                    started = start_job(job_dir)
+                    if started is None:
+                        collecting.append(collect_results(job_dir))
+                else:
+                    arrays[job_dir].pending.remove(task)
+                    started = start_job(job_dir, arrays[job_dir].task_dir(task))
+                    if started is None:
+                        arrays[job_dir].failed += 1
+                    else:
+                        arrays[job_dir].running += 1
+                if started is not None:
+                    running[(job_dir, task)] = started
+            if len(running) == 0 and len(queued) == 0 and len(arrays) == 0 and len(collecting) == 0:
+                return
+            wait_for_children(wakeup_fds[0], POLL_INTERVAL)
+    finally:
+        unwatch_children(wakeup_fds)
+
+
+def run_queue_if_idle(job_root):
+    """ Become the runner for job_root unless another runner process is active. """
+    with open(os.path.join(job_root, RUNNER_LOCK_FILE), 'a') as lock_fh:
+        while True:
+            try:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return  # The active runner will pick up the job.
+                raise
             try:
-                p = subprocess.Popen(
-                    shlex.split(exec_str),
-                    stdout=stdout_fh,
-                    stderr=stdout_fh,
-                )
-                pid = p.pid
-                # create pid file
-                pid_file = ".molns/pid"
-                return_code_file = ".molns/return_value"
-                with open(pid_file, 'w+') as fd:
-                    fd.write(str(pid))
-                # Wait on program execution...
-                return_code = p.wait()
-                print "Return code:", return_code
-                if return_code_file is not None:
-                    with open(return_code_file, 'w+') as fd:
-                        fd.write(str(return_code))
-            except Exception as e:
-                stdout_fh.write('Error: {}'.format(str(e)))
-                stdout_fh.write(traceback.format_exc())
-                raise sys.exc_info()[1], None, sys.exc_info()[2]
+                run_queue(job_root)
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+            # A job queued while this runner was exiting would have seen the lock held, check again.
+            if len(list_queued(job_root)) == 0:
+                return
 
 
 if __name__ == "__main__":
-    with open(".molns/cmd",'r') as fd:
-        exec_str = fd.read()
-    print "exec_str", exec_str
-    run_job(exec_str, ".molns/stdout")
+    job_dir = os.getcwd()
+    enqueue(job_dir)
+    print "queued", job_dir
+    run_queue_if_idle(os.path.dirname(job_dir))
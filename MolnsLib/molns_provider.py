@@ -1,12 +1,68 @@
 import os
 import collections
-from ssh import SSH
+import logging
+import random
+import threading
+import time
 
 
 class ProviderException(Exception):
     pass
 
 
+# Default number of seconds to wait for instances to change state.
+INSTANCE_WAIT_TIMEOUT = 1800
+
+
+def wait_for_instance_states(ids, get_states, target_states, fail_states=(), timeout=INSTANCE_WAIT_TIMEOUT,
+                             initial_delay=2, max_delay=30):
+    """ Wait until every instance in 'ids' has reached one of 'target_states'.
+
+    Args:
+        ids: the provider identifiers of the instances.
+        get_states: a callable that takes a list of ids and returns a dict mapping each id to its current state.
+            It is called once per poll with only the instances that are not ready yet, so providers should
+            answer it with a single API call.
+        target_states: the states that end the wait for an instance.
+        fail_states: states from which an instance will never reach 'target_states'.
+        timeout: seconds to wait in total.
+        initial_delay, max_delay: bounds, in seconds, of the exponential backoff between polls (with jitter).
+    Returns:
+        A dict mapping id to its final state.
+    Raises:
+        ProviderException if an instance reaches one of 'fail_states' or on timeout.
+    """
+    pending = list(ids)
+    reached = {}
+    deadline = time.time() + timeout
+    delay = initial_delay
+    while len(pending) > 0:
+        states = get_states(pending)
+        for instance_id in pending:
+            state = states.get(instance_id)
+            if state in target_states:
+                reached[instance_id] = state
+            elif state in fail_states:
+                raise ProviderException("Instance {0} is in state '{1}', expected {2}".format(instance_id, state,
+                                                                                             list(target_states)))
+        pending = [instance_id for instance_id in pending if instance_id not in reached]
+        if len(pending) == 0:
+            break
+        logging.debug("Waiting for {0} instance(s) to reach {1}".format(len(pending), list(target_states)))
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ProviderException("Timed out after {0} seconds waiting for instance(s) {1} to reach {2}".format(
+                timeout, pending, list(target_states)))
+        time.sleep(min(random.uniform(delay / 2.0, delay), remaining))
+        delay = min(delay * 2, max_delay)
+    return reached
+
+
+# Semaphores bounding the status requests in flight per provider, shared by its controller and all worker groups.
+_status_poll_semaphores = {}
+_status_poll_lock = threading.Lock()
+
+
 class ProviderBase:
     """ Abstract class. """
     
@@ -14,6 +70,9 @@ class ProviderBase:
     STATUS_STOPPED = 'stopped'
     STATUS_TERMINATED = 'terminated'
 
+    # Maximum number of concurrent status requests sent to the provider's API, across all of its groups.
+    STATUS_POLL_CONCURRENCY = 8
+
     SecurityGroupRule = collections.namedtuple("SecurityGroupRule", ["ip_protocol", "from_port", "to_port", "cidr_ip",
                                                                      "src_group_name"])
 
@@ -40,7 +99,16 @@ class ProviderBase:
                 self.config[k] = v
         for k,v in kwargs.iteritems():
             self.__dict__[k] = v
-        self.ssh = SSH()
+
+    def _get_ssh(self):
+        """ SSH helper, created on first use so that paramiko is only imported by commands that need it. This is an
+        old-style class: assigning self.ssh (e.g. DockerProvider) sets an instance attribute that hides the getter. """
+        if '_ssh' not in self.__dict__:
+            from ssh import SSH
+            self._ssh = SSH()
+        return self._ssh
+
+    ssh = property(_get_ssh)
 
     def __getitem__(self, key):
         if key not in self.CONFIG_VARS.keys():
@@ -72,3 +140,31 @@ class ProviderBase:
         ssh_key_dir = os.path.join(self.config_dir, self.name)
         ssh_key_file = os.path.join(ssh_key_dir,self.config['key_name']+self.SSH_KEY_EXTENSION)
         return ssh_key_file
+
+    def get_instance_statuses(self, instances):
+        """ Get the status of many instances; returns a list of statuses in the order of 'instances'.
+        Providers that can describe several instances in one API call should override this. """
+        from Utils import parallel_map
+        instances = list(instances)
+        if len(instances) == 0:
+            return []
+        semaphore = self._status_poll_semaphore()
+
+        def get_status(instance):
+            with semaphore:
+                return self.get_instance_status(instance)
+
+        # Query the first instance alone so that the provider connection is established only once.
+        statuses = [get_status(instances[0])]
+        return statuses + parallel_map(get_status, instances[1:], max_workers=self.STATUS_POLL_CONCURRENCY)
+
+    def _status_poll_semaphore(self):
+        """ The semaphore of the provider this controller or worker group runs on (of this object, for a provider),
+        so that polling several groups at once (see MOLNSbase._get_instance_statuses) stays within
+        STATUS_POLL_CONCURRENCY requests. """
+        provider = getattr(self, 'provider', None) or self
+        key = (self.PROVIDER_TYPE, provider.name)
+        with _status_poll_lock:
+            if key not in _status_poll_semaphores:
+                _status_poll_semaphores[key] = threading.BoundedSemaphore(self.STATUS_POLL_CONCURRENCY)
+            return _status_poll_semaphores[key]
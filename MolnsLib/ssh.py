@@ -1,4 +1,11 @@
+import atexit
+import errno
+import os
 import paramiko
+import random
+import select
+import socket
+import threading
 import time
 
 
@@ -6,33 +13,276 @@ class SSHException(Exception):
     pass
 
 
+def read_session(session, timeout=None, output_callback=None, nbytes=4096):
+    """ Collect the output of a command started with session.exec_command() until it exits.
+
+    Blocks in select() on the channel, so it wakes up as soon as output arrives or the command finishes instead of
+    polling.
+
+    Args:
+        session: a paramiko Channel on which exec_command() has been called.
+        timeout: seconds to wait for the command to finish, None to wait forever.
+        output_callback: if given, called as output_callback(stream, data) for every chunk of output received, where
+            stream is 'stdout' or 'stderr'.
+    Returns:
+        A tuple (exit status, stdout str, stderr str).
+    Raises:
+        paramiko.SSHException if the command does not finish within 'timeout' seconds.
+    """
+    stdout_data = []
+    stderr_data = []
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    while True:
+        while session.recv_ready():
+            msg = session.recv(nbytes)
+            stdout_data.append(msg)
+            if output_callback is not None:
+                output_callback('stdout', msg)
+        while session.recv_stderr_ready():
+            msg = session.recv_stderr(nbytes)
+            stderr_data.append(msg)
+            if output_callback is not None:
+                output_callback('stderr', msg)
+        if (session.exit_status_ready() or session.closed) and not session.recv_ready() \
+                and not session.recv_stderr_ready():
+            break
+        # The channel becomes readable on output and when it is closed after the exit status; the wait is
+        # bounded in case the server sends the exit status without closing the channel.
+        wait = 1.0
+        if deadline is not None:
+            wait = min(wait, deadline - time.time())
+            if wait <= 0:
+                session.close()
+                raise paramiko.SSHException("Timed out after {0} seconds".format(timeout))
+        select.select([session], [], [], wait)
+    return session.recv_exit_status(), ''.join(stdout_data), ''.join(stderr_data)
+
+
+def probe_ports(addresses, port=22, timeout=600, initial_delay=1, max_delay=15, connect_timeout=5):
+    """ Wait for 'port' to accept TCP connections on many hosts at once.
+
+    Connects are started with non-blocking sockets and all pending ones are waited on in a single select(), so a
+    slow or unreachable host does not hold up the others. A host that refuses or does not answer within
+    'connect_timeout' seconds is retried after an exponentially growing, jittered delay (capped at 'max_delay').
+
+    Args:
+        addresses: host names or ip addresses to probe.
+        port: the TCP port to probe.
+        timeout: seconds after which the hosts that are still not reachable are given up on.
+    Yields:
+        (address, True) as soon as the port on address accepts a connection, then (address, False) for every
+        address that was not reachable within 'timeout' seconds.
+    """
+    deadline = time.time() + timeout
+    pending = {}
+    for address in addresses:
+        pending[address] = {'socket': None, 'started': None, 'next_attempt': 0, 'delay': initial_delay}
+
+    def retry_later(address, state, now):
+        if state['socket'] is not None:
+            state['socket'].close()
+            state['socket'] = None
+        state['next_attempt'] = now + random.uniform(state['delay'] / 2.0, state['delay'])
+        state['delay'] = min(max_delay, state['delay'] * 2)
+
+    try:
+        while len(pending) > 0:
+            now = time.time()
+            if now >= deadline:
+                break
+            for address, state in pending.items():
+                if state['socket'] is None and state['next_attempt'] <= now:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(0)
+                    try:
+                        rc = sock.connect_ex((address, port))
+                    except (socket.error, socket.gaierror):
+                        sock.close()
+                        retry_later(address, state, now)
+                        continue
+                    state['socket'] = sock
+                    state['started'] = now
+                    if rc not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                        retry_later(address, state, now)
+                elif state['socket'] is not None and now - state['started'] > connect_timeout:
+                    retry_later(address, state, now)
+            connecting = dict((state['socket'], address) for address, state in pending.items()
+                              if state['socket'] is not None)
+            wakeups = [state['next_attempt'] for state in pending.values() if state['socket'] is None]
+            wakeups.extend(state['started'] + connect_timeout for state in pending.values()
+                           if state['socket'] is not None)
+            wait = max(0, min(wakeups + [deadline]) - time.time())
+            if len(connecting) == 0:
+                time.sleep(wait)
+                continue
+            _, writable, _ = select.select([], connecting.keys(), [], wait)
+            now = time.time()
+            for sock in writable:
+                address = connecting[sock]
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    sock.close()
+                    del pending[address]
+                    yield address, True
+                else:
+                    retry_later(address, pending[address], now)
+        for address in pending.keys():
+            yield address, False
+    finally:
+        for state in pending.values():
+            if state['socket'] is not None:
+                state['socket'].close()
+
+
+def wait_for_port(address, port=22, timeout=600):
+    """ Returns True once 'port' on 'address' accepts TCP connections, False if it did not within 'timeout'. """
+    for _, ready in probe_ports([address], port=port, timeout=timeout):
+        return ready
+    return False
+
+
+class PooledSFTPClient:
+    """ SFTP session shared by all users of a pooled connection; close() leaves it open for the next caller. """
+
+    def __init__(self, sftp):
+        self.sftp = sftp
+
+    def __getattr__(self, name):
+        return getattr(self.sftp, name)
+
+    def close(self):
+        pass
+
+
+class PooledConnection:
+    """ An SSH connection (paramiko client and its SFTP session) held by the SSHConnectionPool. """
+
+    def __init__(self, client):
+        self.client = client
+        self.sftp = None
+        self.last_used = time.time()
+        # Number of SSH objects using the connection (checked out with get() and not yet released).
+        self.users = 0
+        self.lock = threading.Lock()
+
+    def is_alive(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def open_sftp(self):
+        with self.lock:
+            if self.sftp is None or self.sftp.get_channel().closed:
+                self.sftp = PooledSFTPClient(self.client.open_sftp())
+            return self.sftp
+
+    def close(self):
+        try:
+            if self.sftp is not None:
+                self.sftp.sftp.close()
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SSHConnectionPool:
+    """ Process wide cache of SSH connections keyed by (host, port, username, key file), so that consecutive
+    commands to the same machine reuse one transport instead of doing a new SSH handshake each time. """
+
+    # Seconds between keepalive packets on pooled transports.
+    KEEPALIVE_INTERVAL = 30
+    # Connections released for this many seconds are closed, connections in use are never closed.
+    MAX_IDLE_TIME = 300
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.pid = os.getpid()
+
+    def get(self, hostname, port, username=None, key_filename=None):
+        key = (hostname, port, username, key_filename)
+        with self.lock:
+            self._check_pid()
+            self._evict()
+            conn = self.connections.get(key)
+            if conn is not None and conn.is_alive():
+                conn.users += 1
+                conn.last_used = time.time()
+                return conn
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname, port, username, key_filename=key_filename)
+        client.get_transport().set_keepalive(self.KEEPALIVE_INTERVAL)
+        conn = PooledConnection(client)
+        with self.lock:
+            existing = self.connections.get(key)
+            if existing is not None and existing.is_alive():
+                # Another thread connected to the same host meanwhile, its connection may already be in use.
+                existing.users += 1
+                existing.last_used = time.time()
+            else:
+                conn.users += 1
+                self.connections[key] = conn
+                existing = None
+        if existing is not None:
+            conn.close()
+            return existing
+        return conn
+
+    def has_connection(self, hostname, port, username=None, key_filename=None):
+        """ True if get() would reuse an open transport instead of connecting. """
+        with self.lock:
+            self._check_pid()
+            conn = self.connections.get((hostname, port, username, key_filename))
+            return conn is not None and conn.is_alive()
+
+    def release(self, conn):
+        """ Called when an SSH object stops using a connection returned by get(). """
+        with self.lock:
+            conn.users = max(0, conn.users - 1)
+            conn.last_used = time.time()
+
+    def close_all(self):
+        with self.lock:
+            self._check_pid()
+            connections = self.connections.values()
+            self.connections = {}
+        for conn in connections:
+            conn.close()
+
+    def _check_pid(self):
+        # Transports inherited through fork() belong to the parent process, start over with an empty pool.
+        if os.getpid() != self.pid:
+            self.connections = {}
+            self.pid = os.getpid()
+
+    def _evict(self):
+        now = time.time()
+        for key, conn in self.connections.items():
+            if not conn.is_alive() or (conn.users == 0 and now - conn.last_used > self.MAX_IDLE_TIME):
+                del self.connections[key]
+                conn.close()
+
+
+connection_pool = SSHConnectionPool()
+atexit.register(connection_pool.close_all)
+
+
 class SSH:
     def __init__(self):
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh = None
+        self.connection = None
+
+    def __copy__(self):
+        # A copy (see SSHDeploy.clone()) checks out its own connection, it must not release this one.
+        return self.__class__()
 
-    def exec_command(self, command, verbose=True):
+    def exec_command(self, command, verbose=True, timeout=None, output_callback=None):
         try:
-            stdout_data = []
-            stderr_data = []
             session = self.ssh.get_transport().open_session()
             session.exec_command(command)
-            nbytes = 4096
-            # TODO add a timeout here, don't wait for commands forever.
-            while True:
-                if session.recv_ready():
-                    msg = session.recv(nbytes)
-                    stdout_data.append(msg)
-                if session.recv_stderr_ready():
-                    msg = session.recv_stderr(nbytes)
-                    stderr_data.append(msg)
-                if session.exit_status_ready():
-                    break
-                time.sleep(0.1)  # Sleep briefly to prevent over-polling
-
-            status = session.recv_exit_status()
-            str_return = ''.join(stdout_data).splitlines()
-            stderr_str = ''.join(stderr_data)
+            status, stdout_str, stderr_str = read_session(session, timeout=timeout, output_callback=output_callback)
+            str_return = stdout_str.splitlines()
             session.close()
             if status != 0:
                 raise paramiko.SSHException(
@@ -59,13 +309,32 @@ class SSH:
             raise e
 
     def open_sftp(self):
+        return self.connection.open_sftp()
+
+    def open_sftp_channel(self):
+        """ A new SFTP session on the connected transport, not shared with other callers; for parallel transfers.
+        The caller must close it. """
         return self.ssh.open_sftp()
 
+    def open_command_channel(self, command):
+        """ Start 'command' and return its channel, for streaming large output with channel.makefile('rb'). The
+        caller must check channel.recv_exit_status() and close the channel. """
+        channel = self.ssh.get_transport().open_session()
+        channel.exec_command(command)
+        return channel
+
     def connect(self, instance, port, username=None, key_filename=None):
-        return self.ssh.connect(instance.ip_address, port, username, key_filename=key_filename)
+        return self.connect_cluster_node(instance.ip_address, port, username, key_filename)
 
     def connect_cluster_node(self, ip_address, port, username, key_filename):
-        return self.ssh.connect(ip_address, port, username, key_filename=key_filename)
+        connection = connection_pool.get(ip_address, port, username, key_filename)
+        self.close()
+        self.connection = connection
+        self.ssh = self.connection.client
 
     def close(self):
-        self.ssh.close()
\ No newline at end of file
+        """ Release the connection; it stays open in the pool for the next command to this host. """
+        if self.connection is not None:
+            connection_pool.release(self.connection)
+        self.connection = None
+        self.ssh = None
\ No newline at end of file
@@ -12,7 +12,7 @@ import urllib2
 from constants import Constants
 
 from DockerProxy import DockerProxy
-from ssh import SSH
+from ssh import SSH, connection_pool, wait_for_port
 from DockerSSH import DockerSSH
 
 
@@ -20,6 +20,46 @@ class SSHDeployException(Exception):
     pass
 
 
+class ProvisioningScript:
+    """ Shell steps that are uploaded to a host and run there in a single channel. After each step the script
+    prints a 'MOLNS_STEP <n> <exit status>' line, so the caller gets the status and output of every step. The script
+    stops at the first failing step unless that step was added with allow_failure=True. Steps should be idempotent,
+    so a failed deployment can simply be run again. """
+
+    STEP_MARKER = "MOLNS_STEP"
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+
+    def add(self, command, allow_failure=False):
+        self.steps.append((command, allow_failure))
+
+    def render(self):
+        lines = ["#!/bin/bash"]
+        for n, (command, allow_failure) in enumerate(self.steps):
+            lines.append("( {0} ) < /dev/null 2>&1".format(command))
+            lines.append("rc=$?")
+            lines.append('echo "{0} {1} $rc"'.format(self.STEP_MARKER, n))
+            if not allow_failure:
+                lines.append("[ $rc -eq 0 ] || exit 0")
+        return "\n".join(lines) + "\n"
+
+    def parse_output(self, output_lines):
+        """ Returns a list of (command, exit status, output) for the steps that ran. """
+        results = []
+        step_output = []
+        for line in output_lines:
+            fields = line.split()
+            if len(fields) == 3 and fields[0] == self.STEP_MARKER:
+                n = int(fields[1])
+                results.append((self.steps[n][0], int(fields[2]), "\n".join(step_output)))
+                step_output = []
+            else:
+                step_output.append(line)
+        return results
+
+
 class SSHDeploy:
     '''
     This class is used for deploy IPython
@@ -29,12 +69,29 @@ class SSHDeploy:
     DEFAULT_GAE_ADMIN_PORT = 8000
     SSH_CONNECT_WAITTIME = 5
     MAX_NUMBER_SSH_CONNECT_ATTEMPTS = 25
+    # How long (in seconds) to wait for the ssh port of a new instance to open.
+    SSH_READY_TIMEOUT = 600
     DEFAULT_SSH_PORT = 22
     DEFAULT_IPCONTROLLER_PORT = 9000
 
     DEFAULT_PYURDME_TEMPDIR = "/mnt/pyurdme_tmp"
     
     REMOTE_EXEC_JOB_PATH = "/mnt/molnsexec"
+    # Content addressed store of job input files, shared by all jobs on the controller. Blobs no longer linked into
+    # any job are removed by 'molns exec cleanup'.
+    REMOTE_EXEC_BLOB_PATH = "/mnt/molnsexec/.blobs"
+    # Local cache of the hashes of job input files.
+    INPUT_HASH_CACHE_FILE = "input_hashes.json"
+    # Jobs dispatched to workers: input store and copies of finished jobs in the controller's shared area, as seen
+    # from the controller and from the workers (which mount it with sshfs). Workers symlink the blobs, so the link
+    # count does not tell if a blob is still used and this store is not pruned: it grows until the shared area is
+    # cleared (rm -rf /home/ubuntu/shared/.molnsexec/blobs when no worker jobs are queued or running).
+    SHARED_EXEC_BLOB_PATH = "/mnt/molnsshared/.molnsexec/blobs"
+    SHARED_EXEC_RESULTS_PATH = "/mnt/molnsshared/.molnsexec/results"
+    WORKER_SHARED_EXEC_BLOB_PATH = "/home/ubuntu/shared/.molnsexec/blobs"
+    WORKER_SHARED_EXEC_RESULTS_PATH = "/home/ubuntu/shared/.molnsexec/results"
+
+    NUMBER_PROCESSORS_COMMAND = 'python -c "import multiprocessing;print multiprocessing.cpu_count()"'
 
     def __init__(self, ssh, config=None, config_dir=None):
         if config is None:
@@ -59,6 +116,13 @@ class SSHDeploy:
         self.profile_dir_client = self.profile_dir
         self.ipython_port = self.DEFAULT_IPCONTROLLER_PORT
 
+    def clone(self):
+        """ A new SSHDeploy with the same settings and its own ssh helper, for use from another thread. """
+        import copy
+        clone = SSHDeploy(copy.copy(self.ssh), config=self.config, config_dir=self.config_dir)
+        clone.REMOTE_EXEC_JOB_PATH = self.REMOTE_EXEC_JOB_PATH
+        return clone
+
     def scp_command(self, hostname):
         return "scp -o 'StrictHostKeyChecking no' \
                 %s@%s:%ssecurity/ipcontroller-engine.json %ssecurity/" \
@@ -226,27 +290,85 @@ class SSHDeploy:
         engine_file.close()
         sftp.close()
 
+    def run_provisioning_script(self, script):
+        """ Upload 'script' (a ProvisioningScript) to the connected host and run it in one channel.
+        Returns a list of (command, exit status, output), one per step that ran.
+        Raises SSHDeployException if a required step failed. """
+        if isinstance(self.ssh, DockerSSH):
+            # Containers have no sftp to a scratch location, run the steps one by one.
+            for command, allow_failure in script.steps:
+                try:
+                    self.ssh.exec_command(command)
+                except Exception:
+                    if not allow_failure:
+                        raise
+            return [(command, 0, '') for command, _ in script.steps]
+        remote_file_name = "/tmp/molns_provision_{0}_{1}.sh".format(script.name, uuid.uuid4().hex)
+        sftp = self.ssh.open_sftp()
+        script_file = sftp.file(remote_file_name, 'w')
+        script_file.write(script.render())
+        script_file.close()
+        sftp.close()
+        output = self.ssh.exec_command("bash {0}; rm -f {0}".format(remote_file_name), verbose=False)
+        results = script.parse_output(output)
+        for n, (command, status, step_output) in enumerate(results):
+            logging.debug("{0} step {1}: exit status {2}\n{3}".format(script.name, n, status, step_output))
+            if status == 0:
+                print "EXECUTING...\t{0}".format(command)
+            else:
+                print "FAILED......\t{0}\tExit Code: {1}\t{2}".format(command, status, step_output)
+                if not script.steps[n][1]:
+                    raise SSHDeployException("{0} failed at '{1}' (exit code {2}): {3}".format(
+                        script.name, command, status, step_output))
+        if len(results) < len(script.steps):
+            raise SSHDeployException("{0} stopped after {1} of {2} steps".format(script.name, len(results),
+                                                                                 len(script.steps)))
+        return results
+
+    def _add_scratch_space_steps(self, script):
+        """ Steps shared by the controller and the engines: local scratch space and the pyurdme temp directory. """
+        script.add("sudo mkdir -p /mnt/molnsarea/cache && sudo chown ubuntu /mnt/molnsarea /mnt/molnsarea/cache")
+        script.add("sudo ln -sfn /mnt/molnsarea {0}".format('/home/ubuntu/localarea'))
+        script.add("sudo mkdir -p {0} && sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
+
+    def _add_iptables_redirect_step(self, script, public_port, private_port):
+        rule = "PREROUTING -i eth0 -p tcp --dport {0} -j REDIRECT --to-port {1}".format(public_port, private_port)
+        script.add("sudo iptables -t nat -C {0} 2> /dev/null || sudo iptables -t nat -A {0}".format(rule))
+
     def exec_command_list_switch(self, command_list):
         for command in command_list:
             self.ssh.exec_command(command)
 
     def connect(self, instance, port=None):
+        """ Connect to an instance, or to a cluster node given by its ip address. Connections are pooled, so
+        connecting again to the same host reuses the open transport. """
         if port is None:
             port = self.ssh_endpoint
-        print "Connecting to {0}:{1} keyfile={2}".format(instance.ip_address, port, self.keyfile)
+        ip_address = getattr(instance, 'ip_address', instance)
+        print "Connecting to {0}:{1} keyfile={2}".format(ip_address, port, self.keyfile)
+        if not isinstance(self.ssh, DockerSSH) and \
+                not connection_pool.has_connection(ip_address, port, self.username, self.keyfile):
+            # Only attempt the ssh handshake once sshd is listening, a pooled transport needs no handshake.
+            if not wait_for_port(ip_address, port, timeout=self.SSH_READY_TIMEOUT):
+                raise SSHDeployException("ssh port not reachable\t{0}:{1}".format(ip_address, port))
+        delay = 1
         for i in range(self.MAX_NUMBER_SSH_CONNECT_ATTEMPTS):
             try:
-                self.ssh.connect(instance, self.ssh_endpoint, username=self.username,
-                                 key_filename=self.keyfile)
+                if isinstance(instance, basestring):
+                    self.ssh.connect_cluster_node(instance, port, self.username, self.keyfile)
+                else:
+                    self.ssh.connect(instance, port, username=self.username, key_filename=self.keyfile)
                 if not isinstance(self.ssh, DockerSSH):
                     print "SSH connection established"
                 else:
                     print "Ready to execute commands in local container."
                 return
             except Exception as e:
-                print "Retry in {0} seconds...\t\t{1}".format(self.SSH_CONNECT_WAITTIME, e)
-                time.sleep(self.SSH_CONNECT_WAITTIME)
-        raise SSHDeployException("ssh connect Failed!!!\t{0}:{1}".format(instance.ip_address, self.ssh_endpoint))
+                # The port is open, sshd or the instance's keys are usually only a few seconds away.
+                print "Retry in {0} seconds...\t\t{1}".format(delay, e)
+                time.sleep(delay)
+                delay = min(self.SSH_CONNECT_WAITTIME, delay * 2)
+        raise SSHDeployException("ssh connect Failed!!!\t{0}:{1}".format(ip_address, port))
 
     def deploy_molns_webserver(self, instance, controller_obj, openWebBrowser=True):
         ip_address = instance.ip_address
@@ -298,40 +420,50 @@ class SSHDeploy:
             raise sys.exc_info()[1], None, sys.exc_info()[2]
 
     def get_number_processors(self):
-        cmd = 'python -c "import multiprocessing;print multiprocessing.cpu_count()"'
         try:
-            output = self.ssh.exec_command(cmd)[0].strip()
+            output = self.ssh.exec_command(self.NUMBER_PROCESSORS_COMMAND)[0].strip()
             return int(output)
         except Exception as e:
             raise SSHDeployException("Could not determine the number of processors on the remote system: {0}".format(e))
 
-    def deploy_remote_execution_job(self, ip_address, jobID, exec_str):
+    def deploy_remote_execution_job(self, ip_address, jobID, exec_str, priority=0, slots=None, array_params=None,
+                                    shared_via=None):
+        """ Queue 'exec_str' as job 'jobID' on the controller. The job runner (molns_exec_helper.py) runs queued jobs
+        by 'priority' (higher first) on at most 'slots' concurrent slots; passing 'slots' changes the number of slots
+        for all jobs on the controller. With 'array_params' (a local file), exec_str is a template that the runner
+        expands into one task per line of that file.
+
+        To run the job on a worker instead, ip_address is the worker's and 'shared_via' is (SSHDeploy, ip address)
+        of its controller: the input files are staged in the controller's shared area and the job directory is
+        copied back there (SHARED_EXEC_RESULTS_PATH) when the job finishes. """
+        from file_transfer import stage_files
         base_path = "{0}/{1}".format(self.REMOTE_EXEC_JOB_PATH,jobID)
         EXEC_HELPER_FILENAME = 'molns_exec_helper.py'
         try:
             self.connect(ip_address, self.ssh_endpoint)
             # parse command, retreive files to upload (iff they are in the local directory)
             # create remote direct=ory
-            self.ssh.exec_command("sudo mkdir -p {0}".format(base_path))
-            self.ssh.exec_command("sudo chown ubuntu {0}".format(base_path))
-            self.ssh.exec_command("mkdir -p {0}/.molns/".format(base_path))
+            self.ssh.exec_command("sudo mkdir -p {0} && sudo chown ubuntu {1} {0} && mkdir -p {0}/.molns/".format(
+                base_path, self.REMOTE_EXEC_JOB_PATH))
             sftp = self.ssh.open_sftp()
             # Parse exec_str to get job files
-            files_to_transfer = []
-            remote_command_list = []
-            for c in exec_str.split():
-                c2 = c
-                if c.startswith('~'):
-                    c2 = os.path.expanduser(c)
-                if os.path.isfile(c2):
-                    files_to_transfer.append(c2)
-                    remote_command_list.append(os.path.basename(c2))
-                else:
-                    remote_command_list.append(c)
-            # Transfer job files
-            for f in files_to_transfer:
-                logging.debug('Uploading file {0}'.format(f))
-                sftp.put(f, "{0}/{1}".format(base_path, os.path.basename(f)))
+            files_to_transfer, remote_command_list = self._parse_exec_command(exec_str)
+            if array_params is not None:
+                files_to_transfer.append(array_params)
+            # Transfer job files, only those not already in the controller's input store are uploaded
+            logging.debug('Staging files {0}'.format(files_to_transfer))
+            if shared_via is None:
+                stage_files(self.ssh, files_to_transfer, base_path, self.REMOTE_EXEC_BLOB_PATH,
+                            hash_cache_file=self._input_hash_cache_file())
+            else:
+                (controller_deploy, controller_ip) = shared_via
+                controller_deploy.connect(controller_ip, controller_deploy.ssh_endpoint)
+                controller_deploy.ssh.exec_command("mkdir -p {0} {1}".format(self.SHARED_EXEC_BLOB_PATH,
+                                                                             self.SHARED_EXEC_RESULTS_PATH))
+                stage_files(controller_deploy.ssh, files_to_transfer, base_path, self.SHARED_EXEC_BLOB_PATH,
+                            hash_cache_file=self._input_hash_cache_file(), link_ssh=self.ssh,
+                            link_blob_dir=self.WORKER_SHARED_EXEC_BLOB_PATH)
+                controller_deploy.ssh.close()
             # Transfer helper file (to .molns subdirectory)
             logging.debug('Uploading file {0}'.format(EXEC_HELPER_FILENAME))
             sftp.put(
@@ -344,31 +476,141 @@ class SSHDeploy:
             cmd_file = sftp.file("{0}/.molns/{1}".format(base_path,'cmd'), 'w')
             cmd_file.write(remote_command)
             cmd_file.close()
-            # execute command
+            if array_params is not None:
+                array_file = sftp.file("{0}/.molns/{1}".format(base_path,'array'), 'w')
+                array_file.write(remote_command)
+                array_file.close()
+                array_params_file = sftp.file("{0}/.molns/{1}".format(base_path,'array_params'), 'w')
+                array_params_file.write(os.path.basename(array_params))
+                array_params_file.close()
+            if shared_via is not None:
+                collect_file = sftp.file("{0}/.molns/{1}".format(base_path,'collect'), 'w')
+                collect_file.write(self.WORKER_SHARED_EXEC_RESULTS_PATH)
+                collect_file.close()
+            priority_file = sftp.file("{0}/.molns/{1}".format(base_path,'priority'), 'w')
+            priority_file.write(str(priority))
+            priority_file.close()
+            if slots is not None:
+                slots_file = sftp.file("{0}/.slots".format(self.REMOTE_EXEC_JOB_PATH), 'w')
+                slots_file.write(str(slots))
+                slots_file.close()
+            # queue the job, the helper becomes the job runner if none is active
             logging.debug("Executing command")
-            self.ssh.exec_command("cd {0};python {0}/.molns/{1} &".format(base_path, EXEC_HELPER_FILENAME))
+            self.ssh.exec_command("cd {0};nohup python {0}/.molns/{1} > {0}/.molns/helper.log 2>&1 &".format(
+                base_path, EXEC_HELPER_FILENAME))
+            self.ssh.close()
+        except Exception as e:
+            print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
+            raise sys.exc_info()[1], None, sys.exc_info()[2]
+
+    def remote_execution_load(self, ip_address):
+        """ Returns (number of cpus, 1 minute load average, number of queued or running jobs, slots or None) of a
+        host, used to place jobs on the least loaded worker. """
+        command = "nproc; cut -d ' ' -f 1 /proc/loadavg; " \
+                  "grep -l -x -E 'queued|running' {0}/*/.molns/state 2> /dev/null | wc -l; " \
+                  "cat {0}/.slots 2> /dev/null; true".format(self.REMOTE_EXEC_JOB_PATH)
+        try:
+            self.connect(ip_address, self.ssh_endpoint)
+            output = self.ssh.exec_command(command, verbose=False)
+            self.ssh.close()
+        except Exception as e:
+            print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
+            raise sys.exc_info()[1], None, sys.exc_info()[2]
+        lines = [line.strip() for line in output if line.strip() != '']
+        try:
+            slots = int(lines[3]) if len(lines) > 3 else None
+            return int(lines[0]), float(lines[1]), int(lines[2]), slots
+        except (IndexError, ValueError):
+            raise SSHDeployException("Could not read the load of {0}: {1}".format(ip_address, output))
+
+    def _parse_exec_command(self, exec_str):
+        """ Returns (local files referenced by exec_str, the words of the command to run on the controller). """
+        files_to_transfer = []
+        remote_command_list = []
+        for c in exec_str.split():
+            c2 = c
+            if c.startswith('~'):
+                c2 = os.path.expanduser(c)
+            if os.path.isfile(c2):
+                files_to_transfer.append(c2)
+                remote_command_list.append(os.path.basename(c2))
+            else:
+                remote_command_list.append(c)
+        return files_to_transfer, remote_command_list
+
+    def _input_hash_cache_file(self):
+        if os.path.isdir(self.config_dir):
+            return os.path.join(self.config_dir, self.INPUT_HASH_CACHE_FILE)
+        return None
+
+    def remote_execution_cache_key(self, exec_str, array_params=None):
+        """ Hash identifying the result of exec_str: the command as run on the controller plus the names and contents
+        of the local files it references (and of the parameter file of an array job). """
+        import hashlib
+        from file_transfer import content_hashes
+        files, remote_command_list = self._parse_exec_command(exec_str)
+        key = hashlib.sha256(" ".join(remote_command_list))
+        if array_params is not None:
+            key.update("\0array")
+            files.append(array_params)
+        for f, digest in zip(files, content_hashes(files, self._input_hash_cache_file())):
+            key.update("\0{0}\0{1}".format(os.path.basename(f), digest))
+        return key.hexdigest()
+
+    def remote_execution_reuse_job(self, ip_address, jobIDs, new_jobID):
+        """ Make new_jobID a copy (hard linked) of the first job in jobIDs that finished with return value 0 and
+        still exists on the controller. Returns the jobID that was copied, or None. A candidate that can not be
+        copied (e.g. removed by 'molns exec cleanup' meanwhile) is removed from new_jobID and the next one is tried,
+        failing to remove it raises. """
+        if len(jobIDs) == 0:
+            return None
+        command = "cd {0} && for j in {1}; do if [ \"$(cat $j/.molns/return_value 2> /dev/null)\" = 0 ]; then " \
+                  "if cp -al $j {2}; then echo $j; exit 0; fi; rm -rf {2} || exit 1; fi; done".format(
+                      self.REMOTE_EXEC_JOB_PATH, " ".join(jobIDs), new_jobID)
+        try:
+            self.connect(ip_address, self.ssh_endpoint)
+            output = self.ssh.exec_command(command, verbose=False)
             self.ssh.close()
         except Exception as e:
             print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
+        if len(output) > 0 and output[0].strip() in jobIDs:
+            return output[0].strip()
+        return None
 
     def remote_execution_job_status(self, ip_address, jobID):
         ''' Check the status of a remote process.
         
         Returns: Tuple with two elements: (Is_Running, Message)
-            Is_Running: bool    True if the process is running
+            Is_Running: bool    True if the process is running, or queued to run
             Message: str        Description of the status
         '''
         base_path = "{0}/{1}".format(self.REMOTE_EXEC_JOB_PATH,jobID)
         try:
             self.connect(ip_address, self.ssh_endpoint)
             sftp = self.ssh.open_sftp()
-            # Does the 'pid' file exists remotely?
+            # Is it waiting for a slot?
+            try:
+                state_file = sftp.file("{0}/.molns/state".format(base_path), 'r')
+                try:
+                    if state_file.read().strip() == 'queued':
+                        self.ssh.close()
+                        return (True, "Remote process queued")
+                finally:
+                    state_file.close()
+            except (IOError, OSError) as e:
+                pass
+            # Does the 'pid' file exists remotely? (array jobs have the pid of the job runner running their tasks)
+            pid_file = "pid"
             try:
                 sftp.stat("{0}/.molns/pid".format(base_path))
             except (IOError, OSError) as e:
-                self.ssh.close()
-                raise SSHDeployException("Remote process not started (pid file not found")
+                try:
+                    sftp.stat("{0}/.molns/runner_pid".format(base_path))
+                    pid_file = "runner_pid"
+                except (IOError, OSError) as e:
+                    self.ssh.close()
+                    raise SSHDeployException("Remote process not started (pid file not found")
             # Does the 'return_value' file exist?
             try:
                 sftp.stat("{0}/.molns/return_value".format(base_path))
@@ -378,7 +620,7 @@ class SSHDeploy:
                 pass
             # is the process running?
             try:
-                self.ssh.exec_command("kill -0 `cat {0}/.molns/pid` > /dev/null 2&>1".format(base_path))
+                self.ssh.exec_command("kill -0 `cat {0}/.molns/{1}` > /dev/null 2&>1".format(base_path, pid_file))
                 return (True, "Remote process running")
             except SSHDeployException as e:
                 raise SSHDeployException("Remote process not running (process not found)")
@@ -388,48 +630,250 @@ class SSHDeploy:
             print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
 
-    def remote_execution_get_job_logs(self, ip_address, jobID, seek):
+    def remote_execution_all_jobs_status(self, ip_address):
+        """ Status of every job directory on the controller, gathered with a single remote command.
+
+        Returns: dict {jobID: (status, return_value, resources)} where status is one of 'queued', 'not started',
+            'running', 'finished' or 'lost' (the process is gone without a return value), return_value is an int or
+            None and resources is the resource usage dict recorded by the job runner or None.
+        """
+        command = "cd {0} 2> /dev/null || exit 0; for d in */; do j=${{d%/}}; [ -d \"$j\" ] || continue; " \
+                  "p=$(cat $j/.molns/pid 2> /dev/null || cat $j/.molns/runner_pid 2> /dev/null); r=$(cat $j/.molns/return_value 2> /dev/null); a=0; " \
+                  "s=$(cat $j/.molns/state 2> /dev/null); [ -n \"$p\" ] && kill -0 $p 2> /dev/null && a=1; " \
+                  "u=$(cat $j/.molns/resources.json 2> /dev/null); " \
+                  "printf '%s\\t%s\\t%s\\t%s\\t%s\\t%s\\n' \"$j\" \"$p\" \"$r\" $a \"$s\" \"$u\"; done".format(
+                      self.REMOTE_EXEC_JOB_PATH)
+        try:
+            self.connect(ip_address, self.ssh_endpoint)
+            output = self.ssh.exec_command(command, verbose=False)
+            self.ssh.close()
+        except Exception as e:
+            print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
+            raise sys.exc_info()[1], None, sys.exc_info()[2]
+        statuses = {}
+        for line in output:
+            fields = line.split("\t")
+            if len(fields) != 6:
+                continue
+            (jobID, pid, return_value, alive, state, resources) = fields
+            try:
+                resources = json.loads(resources)
+            except ValueError:
+                resources = None
+            if return_value.strip() != '':
+                try:
+                    statuses[jobID] = ('finished', int(return_value), resources)
+                except ValueError:
+                    statuses[jobID] = ('finished', None, resources)
+            elif state == 'queued':
+                statuses[jobID] = ('queued', None, None)
+            elif pid.strip() == '':
+                statuses[jobID] = ('not started', None, None)
+            elif alive == '1':
+                statuses[jobID] = ('running', None, None)
+            else:
+                statuses[jobID] = ('lost', None, None)
+        return statuses
+
+    def remote_execution_array_status(self, ip_address, jobID):
+        """ Status of the tasks of an array job, gathered with a single remote command.
+
+        Returns: list of (task, status, return_value, command) sorted by task, status is 'queued', 'running' or
+            'finished'. The list is empty until the job runner has expanded the job.
+        """
+        command = "cd {0}/{1}/.molns/tasks 2> /dev/null || exit 0; for t in *; do [ -d \"$t\" ] || continue; " \
+                  "printf '%s\\t%s\\t%s\\t%s\\n' \"$t\" \"$(cat $t/state 2> /dev/null)\" " \
+                  "\"$(cat $t/return_value 2> /dev/null)\" \"$(cat $t/cmd 2> /dev/null)\"; done".format(
+                      self.REMOTE_EXEC_JOB_PATH, jobID)
+        try:
+            self.connect(ip_address, self.ssh_endpoint)
+            output = self.ssh.exec_command(command, verbose=False)
+            self.ssh.close()
+        except Exception as e:
+            print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
+            raise sys.exc_info()[1], None, sys.exc_info()[2]
+        tasks = []
+        for line in output:
+            fields = line.rstrip("\n").split("\t", 3)
+            if len(fields) != 4:
+                continue
+            (task, state, return_value, cmd) = fields
+            try:
+                return_value = int(return_value)
+            except ValueError:
+                return_value = None
+            tasks.append((int(task), state, return_value, cmd))
+        return sorted(tasks)
+
+    def remote_execution_wait_jobs(self, ip_address, jobIDs, timeout=None):
+        """ Block until the jobs have finished, or for at most 'timeout' seconds, with one remote command. The waiting
+        is done on the host: with inotifywait if it is installed, else by checking once a second.
+
+        Returns: dict {jobID: (status, return_value, resources)} where status is 'finished', 'lost' (the process is
+            gone without a return value), 'missing' (no such job directory) or 'timeout'.
+        """
+        command = "cd {0} || exit 1; end=$(( $(date +%s) + {1} )); " \
+                  "for j in {2}; do s=finished; m=$j/.molns; " \
+                  "while [ ! -f $m/return_value ]; do " \
+                  "if [ ! -d $m ]; then s=missing; break; fi; " \
+                  "if [ \"$(cat $m/state 2> /dev/null)\" = running ] && ! kill -0 $(cat $m/pid 2> /dev/null || cat $m/runner_pid 2> /dev/null) 2> /dev/null && " \
+                  "[ ! -f $m/return_value ]; then s=lost; break; fi; " \
+                  "if [ {1} -ge 0 ] && [ $(date +%s) -ge $end ]; then s=timeout; break; fi; " \
+                  "if command -v inotifywait > /dev/null; then " \
+                  "inotifywait -qq -t 5 -e create -e moved_to $m > /dev/null 2>&1; else sleep 1; fi; done; " \
+                  "printf '%s\\t%s\\t%s\\t%s\\n' $j $s \"$(cat $m/return_value 2> /dev/null)\" " \
+                  "\"$(cat $m/resources.json 2> /dev/null)\"; done".format(
+                      self.REMOTE_EXEC_JOB_PATH, int(timeout) if timeout is not None else -1, " ".join(jobIDs))
+        try:
+            self.connect(ip_address, self.ssh_endpoint)
+            output = self.ssh.exec_command(command, verbose=False)
+            self.ssh.close()
+        except Exception as e:
+            print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
+            raise sys.exc_info()[1], None, sys.exc_info()[2]
+        results = {}
+        for line in output:
+            fields = line.split("\t")
+            if len(fields) != 4:
+                continue
+            (jobID, status, return_value, resources) = fields
+            try:
+                return_value = int(return_value)
+            except ValueError:
+                return_value = None
+            try:
+                resources = json.loads(resources)
+            except ValueError:
+                resources = None
+            results[jobID] = (status, return_value, resources)
+        return results
+
+    def remote_execution_job_resources(self, ip_address, jobID):
+        """ The resource usage (wall/cpu time, max rss, i/o) recorded by the job runner for a finished job, or None. """
+        base_path = "{0}/{1}".format(self.REMOTE_EXEC_JOB_PATH,jobID)
+        try:
+            self.connect(ip_address, self.ssh_endpoint)
+            sftp = self.ssh.open_sftp()
+            try:
+                fh = sftp.file("{0}/.molns/resources.json".format(base_path), 'r')
+                try:
+                    return json.loads(fh.read())
+                finally:
+                    fh.close()
+            except (IOError, OSError, ValueError):
+                return None
+            finally:
+                self.ssh.close()
+        except Exception as e:
+            print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
+            raise sys.exc_info()[1], None, sys.exc_info()[2]
+
+    def remote_execution_get_job_logs(self, ip_address, jobID, seek, max_bytes=None):
+        """ Read the output of a job from byte 'seek', at most 'max_bytes' bytes if given. """
         base_path = "{0}/{1}".format(self.REMOTE_EXEC_JOB_PATH,jobID)
         try:
             self.connect(ip_address, self.ssh_endpoint)
             sftp = self.ssh.open_sftp()
             log = sftp.file("{0}/.molns/stdout".format(base_path), 'r')
-            log.seek(seek)
-            output = log.read()
+            try:
+                log.seek(seek)
+                if max_bytes is None:
+                    output = log.read()
+                else:
+                    output = log.read(max_bytes)
+            finally:
+                log.close()
             self.ssh.close()
             return output
         except Exception as e:
             print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
 
+    def remote_execution_follow_job_logs(self, ip_address, jobID, seek, output=None):
+        """ Write the output of a job from byte 'seek' to 'output' (default stdout) as it is produced, over a single
+        channel, until the job exits. Returns the number of bytes written. """
+        if output is None:
+            output = sys.stdout
+        base_path = "{0}/{1}".format(self.REMOTE_EXEC_JOB_PATH,jobID)
+        # Wait while the job is queued and then (up to a minute) for the helper to start it, then tail the log until
+        # the job's pid exits. An array job is followed until its return value is written (or its runner is gone).
+        command = "cd {0}/.molns && n=0; while [ \"$(cat state 2> /dev/null)\" = queued ] || " \
+                  "( [ ! -f pid ] && [ ! -f runner_pid ] && [ ! -f return_value ] && [ $n -lt 60 ] ); do " \
+                  "sleep 1; n=$((n+1)); done; touch stdout; if [ -f pid ] && [ ! -f return_value ]; then " \
+                  "exec tail -c +{1} --pid=$(cat pid) -f stdout; elif [ -f runner_pid ] && [ ! -f return_value ]; " \
+                  "then tail -c +{1} -f stdout & t=$!; while [ ! -f return_value ] && kill -0 $(cat runner_pid) " \
+                  "2> /dev/null; do sleep 1; done; sleep 1; kill $t; else exec tail -c +{1} stdout; fi".format(
+                      base_path, seek + 1)
+        written = 0
+        try:
+            self.connect(ip_address, self.ssh_endpoint)
+            channel = self.ssh.open_command_channel(command)
+            try:
+                for data in iter(lambda: channel.recv(4096), ""):
+                    output.write(data)
+                    output.flush()
+                    written += len(data)
+            finally:
+                channel.close()
+            self.ssh.close()
+            return written
+        except Exception as e:
+            print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
+            raise sys.exc_info()[1], None, sys.exc_info()[2]
+
     def remote_execution_delete_job(self, ip_address, jobID):
+        from file_transfer import prune_blobs
         base_path = "{0}/{1}".format(self.REMOTE_EXEC_JOB_PATH,jobID)
         try:
             self.connect(ip_address, self.ssh_endpoint)
-            ### If process is still running, terminate it
+            ### If process is still running, terminate it (for an array job: cancel it and terminate its running tasks,
+            ### the job runner's pid in runner_pid is shared by all jobs and is left alone)
             try:
-                self.ssh.exec_command("kill -TERM `cat {0}/.molns/pid` > /dev/null 2&>1".format(base_path))
+                self.ssh.exec_command("cd {0}/.molns && {{ [ ! -f array ] || touch cancel; "
+                                      "if [ \"$(cat state 2> /dev/null)\" = running ] && [ -f pid ]; then "
+                                      "kill -TERM $(cat pid) 2> /dev/null; fi; for t in tasks/*; do "
+                                      "if [ \"$(cat $t/state 2> /dev/null)\" = running ]; then "
+                                      "kill -TERM $(cat $t/pid) 2> /dev/null; fi; done; true; }}".format(base_path),
+                                      verbose=False)
             except Exception as e:
                 pass
             ### Remove the filess on the remote server
-            self.ssh.exec_command("rm -rf {0}/* {0}/.molns*".format(base_path))
+            # (and the copy of a job run on a worker, in the shared area)
+            self.ssh.exec_command("rm -rf {0}/* {0}/.molns* {1}/{2}".format(base_path,
+                                                                           self.WORKER_SHARED_EXEC_RESULTS_PATH, jobID))
             self.ssh.exec_command("sudo rmdir {0}".format(base_path))
+            # Input files only this job used
+            prune_blobs(self.ssh, self.REMOTE_EXEC_BLOB_PATH)
             self.ssh.close()
         except Exception as e:
             print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
 
-    def remote_execution_fetch_file(self, ip_address, jobID, filename, localfilename):
+    def remote_execution_fetch_file(self, ip_address, jobID, filename, localfilename, compress=False):
+        """ Fetch one file of a job, over several parallel streams if it is large (see file_transfer.fetch_file). """
+        from file_transfer import fetch_file
         base_path = "{0}/{1}".format(self.REMOTE_EXEC_JOB_PATH,jobID)
         try:
             self.connect(ip_address, self.ssh_endpoint)
-            sftp = self.ssh.open_sftp()
-            sftp.get("{0}/{1}".format(base_path, filename), localfilename)
+            fetch_file(self.ssh, "{0}/{1}".format(base_path, filename), localfilename, compress=compress)
             self.ssh.close()
         except Exception as e:
             print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
 
+    def remote_execution_fetch_files(self, ip_address, jobID, patterns, local_dir, compress=True):
+        """ Fetch all files of a job matching the glob patterns as one streamed tar archive into local_dir. """
+        from file_transfer import fetch_archive
+        base_path = "{0}/{1}".format(self.REMOTE_EXEC_JOB_PATH,jobID)
+        try:
+            self.connect(ip_address, self.ssh_endpoint)
+            extracted = fetch_archive(self.ssh, base_path, patterns, local_dir, compress=compress)
+            self.ssh.close()
+            return extracted
+        except Exception as e:
+            print "Remote execution failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
+            raise sys.exc_info()[1], None, sys.exc_info()[2]
+
 
 
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
@@ -520,35 +964,24 @@ class SSHDeploy:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(instance, self.ssh_endpoint)
 
-            # Set up the symlink to local scratch space
-            self.ssh.exec_command("sudo mkdir -p /mnt/molnsarea")
-            self.ssh.exec_command("sudo chown ubuntu /mnt/molnsarea")
-            self.ssh.exec_command("sudo mkdir -p /mnt/molnsarea/cache")
-            self.ssh.exec_command("sudo chown ubuntu /mnt/molnsarea/cache")
-
-            self.ssh.exec_command(
-                "test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsarea {0}".format('/home/ubuntu/localarea'))
-
-            # Setup symlink to the shared scratch space
-            self.ssh.exec_command("sudo mkdir -p /mnt/molnsshared")
-            self.ssh.exec_command("sudo chown ubuntu /mnt/molnsshared")
-            self.ssh.exec_command(
-                "test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsshared {0}".format('/home/ubuntu/shared'))
-            #
-            self.ssh.exec_command("sudo mkdir -p {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
-            self.ssh.exec_command("sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
-            #
-            # self.exec_command("cd /usr/local/molns_util && git pull && sudo python setup.py install")
-
             home_dir = ""
             if controller_obj.provider.type == Constants.DockerProvider:
                 home_dir = "/home/ubuntu/"
+            create_config = not (controller_obj.provider.type == Constants.DockerProvider and resume is True)
+
+            # Set up the symlinks to the local and shared scratch space
+            script = ProvisioningScript("controller_setup")
+            self._add_scratch_space_steps(script)
+            script.add("sudo mkdir -p /mnt/molnsshared && sudo chown ubuntu /mnt/molnsshared")
+            script.add("sudo ln -sfn /mnt/molnsshared {0}".format('/home/ubuntu/shared'))
+            if create_config:
+                script.add("mkdir -p {0}.molns".format(home_dir))
+                script.add("ipython profile create {0}".format(self.profile))
+            self.run_provisioning_script(script)
+            # self.exec_command("cd /usr/local/molns_util && git pull && sudo python setup.py install")
 
             # If its not a DockerController being resumed, then create config files and move sample notebooks to volume.
-            if not (controller_obj.provider.type == Constants.DockerProvider and resume is True):
-                self.ssh.exec_command("mkdir -p {0}.molns".format(home_dir))
-                self.create_s3_config()
-                self.ssh.exec_command("ipython profile create {0}".format(self.profile))
+            if create_config:
                 self.create_ipython_config(ip_address, notebook_password)
                 self.create_engine_config()
                 self.__transfer_cluster_ssh_key_file(remote_target_dir=home_dir, controller_obj=controller_obj)
@@ -558,32 +991,24 @@ class SSHDeploy:
                                                                          controller_obj.config["working_directory"])))
 
             # If provider is Docker, then ipython controller and ipengines aren't started
-
+            script = ProvisioningScript("controller_start")
             if controller_obj.provider.type != Constants.DockerProvider:
-                self.ssh.exec_command(
+                script.add(
                     "source /usr/local/pyurdme/pyurdme_init; screen -d -m ipcontroller --profile={1} --ip='*' --location={0} "
-                    "--port={2}--log-to-file".format(
-                        ip_address, self.profile, self.ipython_port), '\n')
+                    "--port={2} --log-to-file".format(
+                        ip_address, self.profile, self.ipython_port))
                 # Give the controller time to startup
-                import time
-                logging.debug('Waiting 5 seconds for the IPython controller to start.')
-                time.sleep(5)
-
-                # Start one ipengine per processor
-                num_procs = self.get_number_processors()
-                num_engines = num_procs - reserved_cpus
-                logging.debug(
-                    'Starting {0} engines (#cpu={1}, reserved_cpus={2})'.format(num_engines, num_procs, reserved_cpus))
-
-                for _ in range(num_engines):
-                    self.ssh.exec_command(
-                        "{1}source /usr/local/pyurdme/; screen -d -m ipengine --profile={0} --debug".format(
-                            self.profile, self.ipengine_env))
-                self.ssh.exec_command(
+                script.add("sleep 5")
+                # Start one ipengine per processor, leaving 'reserved_cpus' for the controller and notebook
+                script.add(
+                    "num_engines=$(( $({2}) - {3} )); for i in $(seq 1 $num_engines); do "
+                    "{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipengine --profile={0} --debug; done".format(
+                        self.profile, self.ipengine_env, self.NUMBER_PROCESSORS_COMMAND, reserved_cpus))
+                script.add(
                     "{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipython notebook --profile={0}".format(
                         self.profile, self.ipengine_env))
             else:
-                self.ssh.exec_command(
+                script.add(
                     "sudo pip install /usr/local/pyurdme/; screen -d -m ipython notebook --profile={0}".format(
                         self.profile))
 
@@ -592,9 +1017,9 @@ class SSHDeploy:
             # self.ssh.exec_command("git clone https://github.com/aviral26/molns.git")
             # self.ssh.exec_command("cd /usr/local/molnsutil; git checkout qsub_support; git pull")
 
-            self.ssh.exec_command(
-                "sudo iptables -t nat -A PREROUTING -i eth0 -p tcp --dport {0} -j REDIRECT --to-port {1}".format(
-                    Constants.DEFAULT_PUBLIC_NOTEBOOK_PORT, Constants.DEFAULT_PRIVATE_NOTEBOOK_PORT))
+            self._add_iptables_redirect_step(script, Constants.DEFAULT_PUBLIC_NOTEBOOK_PORT,
+                                             Constants.DEFAULT_PRIVATE_NOTEBOOK_PORT)
+            self.run_provisioning_script(script)
         except Exception as e:
             print "Failed: {0}\t{1}:{2}".format(e, ip_address, self.ssh_endpoint)
             raise sys.exc_info()[1], None, sys.exc_info()[2]
@@ -632,20 +1057,12 @@ class SSHDeploy:
             print "{0}:{1}".format(ip_address, self.ssh_endpoint)
             self.connect(ip_address, self.ssh_endpoint)
 
-            # Setup the symlink to local scratch space
-            self.ssh.exec_command("sudo mkdir -p /mnt/molnsarea")
-            self.ssh.exec_command("sudo chown ubuntu /mnt/molnsarea")
-            self.ssh.exec_command("sudo mkdir -p /mnt/molnsarea/cache")
-            self.ssh.exec_command("sudo chown ubuntu /mnt/molnsarea/cache")
-
-            self.ssh.exec_command(
-                "test -e {0} && sudo rm {0} ; sudo ln -s /mnt/molnsarea {0}".format('/home/ubuntu/localarea'))
-            #
-            self.ssh.exec_command("sudo mkdir -p {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
-            self.ssh.exec_command("sudo chown ubuntu {0}".format(self.DEFAULT_PYURDME_TEMPDIR))
-            # Setup config for object store
-            self.ssh.exec_command("mkdir -p .molns")
-            self.create_s3_config()
+            # Setup the symlink to local scratch space, the directory for the object store config and the profile
+            script = ProvisioningScript("engine_setup")
+            self._add_scratch_space_steps(script)
+            script.add("mkdir -p .molns")
+            script.add("ipython profile create {0}".format(self.profile))
+            self.run_provisioning_script(script)
 
             # SSH mount the controller on each engine
             remote_file_name='/home/ubuntu/.ssh/controller_ssh_key'
@@ -658,23 +1075,26 @@ class SSHDeploy:
                 controller_keyfile.close()
                 print "Remote file {0} has {1} bytes".format(remote_file_name, sftp.stat(remote_file_name).st_size)
                 sftp.close()
-            self.exec_command("chmod 0600 {0}".format(remote_file_name))
-            self.exec_command("sudo rm -rf {0}".format('/home/ubuntu/shared'))
-            self.exec_command("mkdir -p /home/ubuntu/shared")
-            self.exec_command("sshfs -o IdentityFile={1} -o Ciphers=arcfour -o Compression=no -o reconnect -o idmap=user -o StrictHostKeyChecking=no ubuntu@{0}:/mnt/molnsshared /home/ubuntu/shared".format(controler_ip,remote_file_name))
 
             # Update the Molnsutil package: TODO remove when molns_util is stable
             # self.exec_command("cd /usr/local/molns_util && git pull && sudo python setup.py install")
 
-            self.ssh.exec_command("ipython profile create {0}".format(self.profile))
+            # Object store config and engine config
             self.create_engine_config()
             # Just write the engine_file to the engine
             self._put_ipython_engine_file(engine_file_data)
+
+            script = ProvisioningScript("engine_start")
+            script.add("chmod 0600 {0}".format(remote_file_name))
+            # Do not remove the shared directory while the controller is mounted on it.
+            script.add("mountpoint -q /home/ubuntu/shared || (sudo rm -rf /home/ubuntu/shared && mkdir -p /home/ubuntu/shared && "
+                       "sshfs -o IdentityFile={1} -o Ciphers=arcfour -o Compression=no -o reconnect -o idmap=user -o StrictHostKeyChecking=no ubuntu@{0}:/mnt/molnsshared /home/ubuntu/shared)".format(controler_ip,remote_file_name))
             # Start one ipengine per processor
-            for _ in range(self.get_number_processors()):
-                self.ssh.exec_command(
-                    "{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipengine --profile={0} --debug".format(
-                        self.profile, self.ipengine_env))
+            script.add(
+                "for i in $(seq 1 $({2})); do "
+                "{1}source /usr/local/pyurdme/pyurdme_init; screen -d -m ipengine --profile={0} --debug; done".format(
+                    self.profile, self.ipengine_env, self.NUMBER_PROCESSORS_COMMAND))
+            self.run_provisioning_script(script)
 
             self.ssh.close()
 
@@ -6,8 +6,6 @@ from MolnsLib.Utils import Log
 from MolnsLib.molns_datastore import Datastore, DatastoreException, VALID_PROVIDER_TYPES, get_provider_handle
 from MolnsLib.molns_provider import ProviderException
 import subprocess
-from MolnsLib.ssh_deploy import SSHDeploy
-import multiprocessing
 import json
 import logging
 
@@ -58,6 +56,25 @@ class MOLNSbase():
             else:
                 obj.config[key] = config[key]
 
+    @classmethod
+    def _get_instance_statuses(cls, obj_instances):
+        """ Get the status of many instances at once. 'obj_instances' is a list of (controller or worker group
+        object, instance) pairs; returns a dict mapping instance.id to status. Instances handled by the same
+        object are queried as one batch and the batches run concurrently. """
+        from MolnsLib.Utils import parallel_map
+        groups = OrderedDict()
+        for obj, inst in obj_instances:
+            groups.setdefault(id(obj), (obj, []))[1].append(inst)
+
+        def batch_status(group):
+            obj, instances = group
+            return zip([i.id for i in instances], obj.get_instance_statuses(instances))
+
+        statuses = {}
+        for batch in parallel_map(batch_status, groups.values(), max_workers=len(groups) or 1):
+            statuses.update(batch)
+        return statuses
+
     @classmethod
     def _get_workerobj(cls, args, config):
         # Name
@@ -258,13 +275,10 @@ class MOLNSController(MOLNSbase):
         if len(controllers) == 0:
             return {'msg': "No controllers configured"}
         else:
+            provider_names = config.get_object_names('Provider')
             table_data = []
             for c in controllers:
-                try:
-                    p = config.get_object_by_id(c.provider_id, 'Provider')
-                    provider_name = p.name
-                except DatastoreException as e:
-                    provider_name = 'ERROR: {0}'.format(e)
+                provider_name = provider_names.get(c.provider_id, 'ERROR: Provider {0} not found'.format(c.provider_id))
                 table_data.append([c.name, provider_name])
             return {'type': 'table', 'column_names': ['name', 'provider'], 'data': table_data}
 
@@ -314,6 +328,13 @@ class MOLNSController(MOLNSbase):
     def upload_controller(cls, args, config):
         """ Copy a local file to the controller's home directory. """
         logging.debug("MOLNSController.upload_controller(args={0})".format(args))
+        cls._upload_to_controller(args, config, "/home/ubuntu/")
+
+    @classmethod
+    def _upload_to_controller(cls, args, config, remote_dir):
+        """ Stream the local file args[1] to 'remote_dir' on the controller, resuming an interrupted upload. """
+        from MolnsLib.ssh_deploy import SSHDeploy
+        from MolnsLib.file_transfer import upload_file
         controller_obj = cls._get_controllerobj(args, config)
         if controller_obj is None:
             return
@@ -331,21 +352,20 @@ class MOLNSController(MOLNSbase):
         if inst is None:
             raise MOLNSException("No active instance for this controller")
 
+        if len(args) < 2:
+            raise MOLNSException("USAGE: molns put/upload name file")
         file_to_transfer = args[1]
         logging.debug("File to transfer: {0}".format(file_to_transfer))
+        if not os.path.isfile(file_to_transfer):
+            raise MOLNSException("'{0}' is not a file".format(file_to_transfer))
 
-        remote_file_path = os.path.join("/home/ubuntu/", os.path.basename(file_to_transfer))
+        remote_file_path = os.path.join(remote_dir, os.path.basename(file_to_transfer))
 
         controller_obj.ssh.connect(inst, SSHDeploy.DEFAULT_SSH_PORT, "ubuntu", controller_obj.provider.sshkeyfilename())
-
-        sftp = controller_obj.ssh.open_sftp()
-        remote_fh = sftp.file(remote_file_path, "w")
         try:
-            with open(file_to_transfer, "r") as fh:
-                remote_fh.write(fh.read())
+            upload_file(controller_obj.ssh, file_to_transfer, remote_file_path)
         finally:
-            remote_fh.close()
-            sftp.close()
+            controller_obj.ssh.close()
 
         print "Transferred {0} to {1}@{2}:{3}".format(file_to_transfer, inst.ip_address, "ubuntu", remote_file_path)
 
@@ -384,10 +404,26 @@ class MOLNSController(MOLNSbase):
     def put_controller(cls, args, config):
         """ Copy a local file to the controller's and workers' shared area. """
         logging.debug("MOLNSController.put_controller(args={0})".format(args))
+        cls._upload_to_controller(args, config, "/home/ubuntu/shared")
+
+    @classmethod
+    def sync_controller(cls, args, config):
+        """ Push (or pull) a local directory to (from) the controller, transferring only changed files. Relative remote
+        paths are under the controller's home, use 'shared/...' for the area shared with the workers. """
+        from MolnsLib.ssh_deploy import SSHDeploy
+        from MolnsLib.file_transfer import sync_directory
+        logging.debug("MOLNSController.sync_controller(args={0})".format(args))
+        delete = '--delete' in args
+        args = [a for a in args if a != '--delete']
+        if len(args) < 3 or args[1] not in ['push', 'pull']:
+            raise MOLNSException("USAGE: molns sync name push|pull local_dir [remote_dir] [--delete]")
         controller_obj = cls._get_controllerobj(args, config)
         if controller_obj is None:
             return
 
+        if controller_obj.provider.type == constants.Constants.DockerProvider:
+            raise NotImplementedError("DockerController does not support this feature yet.")
+
         # Check if any instances are assigned to this controller
         instance_list = config.get_controller_instances(controller_id=controller_obj.id)
 
@@ -402,23 +438,18 @@ class MOLNSController(MOLNSbase):
         if inst is None:
             raise MOLNSException("No active instance for this controller")
 
-        file_to_transfer = args[1]
-        logging.debug("File to transfer: {0}".format(file_to_transfer))
-
-        remote_file_path = os.path.join("/home/ubuntu/shared", os.path.basename(file_to_transfer))
+        local_dir = args[2]
+        if len(args) > 3:
+            remote_dir = args[3]
+        else:
+            remote_dir = os.path.basename(os.path.abspath(local_dir))
+        remote_dir = os.path.join("/home/ubuntu/", remote_dir)
 
         controller_obj.ssh.connect(inst, SSHDeploy.DEFAULT_SSH_PORT, "ubuntu", controller_obj.provider.sshkeyfilename())
-
-        sftp = controller_obj.ssh.open_sftp()
-        remote_fh = sftp.file(remote_file_path, "w")
         try:
-            with open(file_to_transfer, "r") as fh:
-                remote_fh.write(fh.read())
+            sync_directory(controller_obj.ssh, local_dir, remote_dir, pull=(args[1] == 'pull'), delete=delete)
         finally:
-            remote_fh.close()
-            sftp.close()
-
-        print "Transferred {0} to {1}@{2}:{3}".format(file_to_transfer, inst.ip_address, "ubuntu", remote_file_path)
+            controller_obj.ssh.close()
 
     @classmethod
     def is_controller_running(cls, args, config):
@@ -454,6 +485,8 @@ class MOLNSController(MOLNSbase):
             instance_list = config.get_controller_instances(controller_id=controller_obj.id)
             table_data = []
             if len(instance_list) > 0:
+                config.preload_instance_objects(instance_list)
+                statuses = cls._get_instance_statuses([(controller_obj, i) for i in instance_list])
                 for i in instance_list:
                     # provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
                     try:
@@ -462,7 +495,7 @@ class MOLNSController(MOLNSbase):
                     except DatastoreException as e:
                         provider_name = 'ERROR: {0}'.format(e)
                     controller_name = config.get_object_by_id(i.controller_id, 'Controller').name
-                    status = controller_obj.get_instance_status(i)
+                    status = statuses[i.id]
                     table_data.append(
                         [controller_name, status, 'controller', provider_name, i.provider_instance_identifier,
                          i.ip_address])
@@ -472,16 +505,21 @@ class MOLNSController(MOLNSbase):
             # Check if any worker instances are assigned to this controller
             instance_list = config.get_worker_instances(controller_id=controller_obj.id)
             if len(instance_list) > 0:
+                config.preload_instance_objects(instance_list)
+                worker_objs = {}
                 for i in instance_list:
                     worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
-                    worker_obj = cls._get_workerobj([worker_name], config)
+                    worker_objs[i.id] = cls._get_workerobj([worker_name], config)
+                statuses = cls._get_instance_statuses([(worker_objs[i.id], i) for i in instance_list])
+                for i in instance_list:
+                    worker_name = worker_objs[i.id].name
                     # provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
                     try:
                         p = config.get_object_by_id(i.provider_id, 'Provider')
                         provider_name = p.name
                     except DatastoreException as e:
                         provider_name = 'ERROR: {0}'.format(e)
-                    status = worker_obj.get_instance_status(i)
+                    status = statuses[i.id]
                     table_data.append(
                         [worker_name, status, 'worker', provider_name, i.provider_instance_identifier, i.ip_address])
             # table_print(['name','status','type','provider','instance id', 'IP address'],table_data)
@@ -491,6 +529,7 @@ class MOLNSController(MOLNSbase):
         else:
             instance_list = config.get_all_instances()
             if len(instance_list) > 0:
+                config.preload_instance_objects(instance_list)
                 table_data = []
                 for i in instance_list:
                     provider_obj = config.get_object_by_id(i.provider_id, 'Provider')
@@ -514,6 +553,7 @@ class MOLNSController(MOLNSbase):
     @classmethod
     def start_controller(cls, args, config, password=None, openWebBrowser=True, reserved_cpus=2):
         """ Start the MOLNs controller. """
+        from MolnsLib.ssh_deploy import SSHDeploy
         resume = False
         logging.debug("MOLNSController.start_controller(args={0})".format(args))
         controller_obj = cls._get_controllerobj(args, config)
@@ -557,16 +597,24 @@ class MOLNSController(MOLNSbase):
         instance_list = config.get_all_instances(controller_id=controller_obj.id)
         # Check if they are running
         if len(instance_list) > 0:
+            config.preload_instance_objects(instance_list)
+            instance_objs = {}
             for i in instance_list:
                 if i.worker_group_id is None:
-                    status = controller_obj.get_instance_status(i)
+                    instance_objs[i.id] = controller_obj
+                else:
+                    worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
+                    instance_objs[i.id] = cls._get_workerobj([worker_name], config)
+            statuses = cls._get_instance_statuses([(instance_objs[i.id], i) for i in instance_list])
+            for i in instance_list:
+                status = statuses[i.id]
+                if i.worker_group_id is None:
                     if status == controller_obj.STATUS_RUNNING:
                         print "Stopping controller running at {0}".format(i.ip_address)
                         controller_obj.stop_instance(i)
                 else:
-                    worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
-                    worker_obj = cls._get_workerobj([worker_name], config)
-                    status = worker_obj.get_instance_status(i)
+                    worker_obj = instance_objs[i.id]
+                    worker_name = worker_obj.name
                     if status == worker_obj.STATUS_RUNNING or status == worker_obj.STATUS_STOPPED:
                         print "Terminating worker '{1}' running at {0}".format(i.ip_address, worker_name)
                         worker_obj.terminate_instance(i)
@@ -585,16 +633,24 @@ class MOLNSController(MOLNSbase):
         print("\tinstance_list={0}".format([str(i) for i in instance_list]))
         # Check if they are running or stopped
         if len(instance_list) > 0:
+            config.preload_instance_objects(instance_list)
+            instance_objs = {}
             for i in instance_list:
                 if i.worker_group_id is None:
-                    status = controller_obj.get_instance_status(i)
+                    instance_objs[i.id] = controller_obj
+                else:
+                    worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
+                    instance_objs[i.id] = cls._get_workerobj([worker_name], config)
+            statuses = cls._get_instance_statuses([(instance_objs[i.id], i) for i in instance_list])
+            for i in instance_list:
+                status = statuses[i.id]
+                if i.worker_group_id is None:
                     if status == controller_obj.STATUS_RUNNING or status == controller_obj.STATUS_STOPPED:
                         print "Terminating controller running at {0}".format(i.ip_address)
                         controller_obj.terminate_instance(i)
                 else:
-                    worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
-                    worker_obj = cls._get_workerobj([worker_name], config)
-                    status = worker_obj.get_instance_status(i)
+                    worker_obj = instance_objs[i.id]
+                    worker_name = worker_obj.name
                     if status == worker_obj.STATUS_RUNNING or status == worker_obj.STATUS_STOPPED:
                         print "Terminating worker '{1}' running at {0}".format(i.ip_address, worker_name)
                         worker_obj.terminate_instance(i)
@@ -604,6 +660,7 @@ class MOLNSController(MOLNSbase):
     @classmethod
     def connect_controller_to_local(cls, args, config):
         """ Connect a local iPython installation to the controller. """
+        from MolnsLib.ssh_deploy import SSHDeploy
         logging.debug("MOLNSController.connect_controller_to_local(args={0})".format(args))
         if len(args) != 2:
             print "USAGE: molns local-connect controller_name profile_name"
@@ -628,7 +685,7 @@ class MOLNSController(MOLNSbase):
             print "No instance running for this controller"
             return
         # deploying
-        sshdeploy = SSHDeploy(config=controller_obj.provider, config_dir=config.config_dir)
+        sshdeploy = SSHDeploy(controller_obj.ssh, config=controller_obj.provider, config_dir=config.config_dir)
         client_file_data = sshdeploy.get_ipython_client_file(inst.ip_address)
         home_dir = os.environ.get('HOME')
         ipython_client_filename = os.path.join(home_dir, '.ipython/profile_{0}/'.format(profile_name),
@@ -642,6 +699,11 @@ class MOLNSController(MOLNSbase):
 ###############################################
 
 class MOLNSWorkerGroup(MOLNSbase):
+    # Maximum number of workers deployed concurrently (set with --parallel=N).
+    ENGINE_DEPLOY_PARALLELISM = 10
+    # How many times to retry deploying a worker before giving up on it.
+    ENGINE_DEPLOY_RETRIES = 2
+
     @classmethod
     def worker_group_export(cls, args, config):
         """ Export the configuration of a worker group. """
@@ -819,19 +881,13 @@ class MOLNSWorkerGroup(MOLNSbase):
         if len(groups) == 0:
             raise MOLNSException("No worker groups configured")
         else:
+            provider_names = config.get_object_names('Provider')
+            controller_names = config.get_object_names('Controller')
             table_data = []
             for g in groups:
-                # provider_name = config.get_object_by_id(g.provider_id, 'Provider').name
-                try:
-                    p = config.get_object_by_id(g.provider_id, 'Provider')
-                    provider_name = p.name
-                except DatastoreException as e:
-                    provider_name = 'ERROR: {0}'.format(e)
-                try:
-                    c = config.get_object_by_id(g.controller_id, 'Controller')
-                    controller_name = c.name
-                except DatastoreException as e:
-                    controller_name = 'ERROR: {0}'.format(e)
+                provider_name = provider_names.get(g.provider_id, 'ERROR: Provider {0} not found'.format(g.provider_id))
+                controller_name = controller_names.get(g.controller_id,
+                                                       'ERROR: Controller {0} not found'.format(g.controller_id))
                 table_data.append([g.name, provider_name, controller_name])
             return {'type': 'table', 'column_names': ['name', 'provider', 'controller'], 'data': table_data}
 
@@ -863,12 +919,12 @@ class MOLNSWorkerGroup(MOLNSbase):
             # Check if they are running or stopped
             if len(instance_list) > 0:
                 table_data = []
+                statuses = cls._get_instance_statuses([(worker_obj, i) for i in instance_list])
                 for i in instance_list:
-                    status = worker_obj.get_instance_status(i)
+                    status = statuses[i.id]
                     # print "{0} type={3} ip={1} id={2}".format(status, i.ip_address, i.provider_instance_identifier, worker_obj.PROVIDER_TYPE)
                     worker_name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
                     provider_name = config.get_object_by_id(i.provider_id, 'Provider').name
-                    status = worker_obj.get_instance_status(i)
                     table_data.append(
                         [worker_name, status, 'worker', provider_name, i.provider_instance_identifier, i.ip_address])
                 return {'type': 'table',
@@ -947,8 +1003,9 @@ class MOLNSWorkerGroup(MOLNSbase):
         inst_to_resume = []
         inst_to_deploy = []
         if len(instance_list) > 0:
+            statuses = cls._get_instance_statuses([(worker_obj, i) for i in instance_list])
             for i in instance_list:
-                status = worker_obj.get_instance_status(i)
+                status = statuses[i.id]
                 if status == worker_obj.STATUS_RUNNING:
                     print "Worker running at {0}".format(i.ip_address)
                     num_vms_to_start -= 1
@@ -978,35 +1035,63 @@ class MOLNSWorkerGroup(MOLNSbase):
 
     @classmethod
     def __launch_worker__deploy_engines(cls, worker_obj, controller_ip, inst_to_deploy, config):
+        """ Deploy IPython engines on 'inst_to_deploy' using at most ENGINE_DEPLOY_PARALLELISM concurrent SSH
+        sessions, retrying each host ENGINE_DEPLOY_RETRIES times. Hosts that fail are reported and skipped, the
+        others keep running. Returns the list of instances that were deployed. """
+        from MolnsLib.ssh_deploy import SSHDeploy, SSHDeployException
+        from MolnsLib.ssh import probe_ports
+        from MolnsLib.DockerSSH import DockerSSH
+        from MolnsLib.Utils import parallel_map
         print "Deploying on {0} workers".format(len(inst_to_deploy))
-        if len(inst_to_deploy) > 0:
-            # deploying
-            controller_ssh = SSHDeploy(config=worker_obj.controller.provider, config_dir=config.config_dir)
-            engine_ssh = SSHDeploy(config=worker_obj.provider, config_dir=config.config_dir)
-            engine_file = controller_ssh.get_ipython_engine_file(controller_ip)
-            controller_ssh_keyfile = worker_obj.controller.provider.sshkeyfilename()
-            if len(inst_to_deploy) > 1:
-                logging.debug("__launch_worker__deploy_engines() workpool(size={0})".format(len(inst_to_deploy)))
-                jobs = []
-                for i in inst_to_deploy:
-                    logging.debug(
-                        "multiprocessing.Process(target=engine_ssh.deploy_ipython_engine({0}, engine_file)".format(
-                            i.ip_address))
-                    p = multiprocessing.Process(target=engine_ssh.deploy_ipython_engine, args=(
-                    i.ip_address, controller_ip, engine_file, controller_ssh_keyfile,))
-                    jobs.append(p)
-                    p.start()
-                    logging.debug("__launch_worker__deploy_engines() joining processes.")
-                for p in jobs:
-                    p.join()
-                logging.debug("__launch_worker__deploy_engines() joined processes.")
-            else:
-                for i in inst_to_deploy:
-                    logging.debug("starting engine on {0}".format(i.ip_address))
-                    engine_ssh.deploy_ipython_engine(i.ip_address, controller_ip, engine_file, controller_ssh_keyfile)
+        if len(inst_to_deploy) == 0:
+            return []
+        controller_ssh = SSHDeploy(worker_obj.controller.ssh, config=worker_obj.controller.provider,
+                                   config_dir=config.config_dir)
+        engine_ssh = SSHDeploy(worker_obj.ssh, config=worker_obj.provider, config_dir=config.config_dir)
+        engine_file = controller_ssh.get_ipython_engine_file(controller_ip)
+        controller_ssh_keyfile = worker_obj.controller.provider.sshkeyfilename()
+
+        # Hand the workers to the deploy threads in the order their ssh port opens.
+        waiting = {}
+        for inst in inst_to_deploy:
+            waiting.setdefault(inst.ip_address, []).append(inst)
+        if isinstance(worker_obj.ssh, DockerSSH):
+            ready_hosts = [(ip, True) for ip in waiting.keys()]
         else:
-            return
-        print "Success"
+            ready_hosts = probe_ports(waiting.keys(), port=SSHDeploy.DEFAULT_SSH_PORT,
+                                      timeout=SSHDeploy.SSH_READY_TIMEOUT)
+        ready_instances = ((waiting[ip].pop(), reachable) for ip, reachable in ready_hosts for _ in list(waiting[ip]))
+
+        def deploy(item):
+            inst, reachable = item
+            if not reachable:
+                return inst, SSHDeployException("ssh port not reachable")
+            # Each thread needs its own ssh helper, they share the pooled transports.
+            host_ssh = engine_ssh.clone()
+            error = None
+            for attempt in range(1 + cls.ENGINE_DEPLOY_RETRIES):
+                if attempt > 0:
+                    print "RETRY {0}.....\tdeploying engines on {1}".format(attempt, inst.ip_address)
+                try:
+                    host_ssh.deploy_ipython_engine(inst.ip_address, controller_ip, engine_file, controller_ssh_keyfile)
+                    return inst, None
+                except Exception as e:
+                    logging.debug("deploying engines on {0} failed: {1}".format(inst.ip_address, e))
+                    error = e
+            return inst, error
+
+        logging.debug("__launch_worker__deploy_engines() pool(size={0})".format(cls.ENGINE_DEPLOY_PARALLELISM))
+        results = parallel_map(deploy, ready_instances, max_workers=cls.ENGINE_DEPLOY_PARALLELISM)
+        deployed = [i for i, e in results if e is None]
+        failed = [(i, e) for i, e in results if e is not None]
+        print "Deployed engines on {0} of {1} workers".format(len(deployed), len(inst_to_deploy))
+        if len(failed) > 0:
+            table_print(['instance id', 'IP address', 'error'],
+                        [[i.provider_instance_identifier, i.ip_address, str(e)] for i, e in failed])
+            print "Continuing with the {0} workers that deployed.".format(len(deployed))
+        else:
+            print "Success"
+        return deployed
 
     @classmethod
     def stop_worker_groups(cls, args, config):
@@ -1019,8 +1104,9 @@ class MOLNSWorkerGroup(MOLNSbase):
         # Check if they are running or stopped (if so, resume them)
         inst_to_stop = []
         if len(instance_list) > 0:
+            statuses = cls._get_instance_statuses([(worker_obj, i) for i in instance_list])
             for i in instance_list:
-                status = worker_obj.get_instance_status(i)
+                status = statuses[i.id]
                 if status == worker_obj.STATUS_RUNNING:
                     print "Stopping worker at {0}".format(i.ip_address)
                     inst_to_stop.append(i)
@@ -1040,8 +1126,9 @@ class MOLNSWorkerGroup(MOLNSbase):
         # Check if they are running or stopped (if so, resume them)
         inst_to_stop = []
         if len(instance_list) > 0:
+            statuses = cls._get_instance_statuses([(worker_obj, i) for i in instance_list])
             for i in instance_list:
-                status = worker_obj.get_instance_status(i)
+                status = statuses[i.id]
                 if status == worker_obj.STATUS_RUNNING or status == worker_obj.STATUS_STOPPED:
                     print "Terminating worker at {0}".format(i.ip_address)
                     inst_to_stop.append(i)
@@ -1308,18 +1395,19 @@ class MOLNSInstances(MOLNSbase):
         """ List all instances in the db """
         instance_list = config.get_all_instances()
         if len(instance_list) > 0:
+            provider_names = config.get_object_names('Provider')
+            controller_names = config.get_object_names('Controller')
+            worker_group_names = config.get_object_names('WorkerGroup')
             table_data = []
             for i in instance_list:
-                provider_obj = config.get_object_by_id(i.provider_id, 'Provider')
-                if provider_obj is None:
+                if i.provider_id not in provider_names:
                     continue
-                provider_name = provider_obj.name
-                #print "provider_obj.type",provider_obj.type
+                provider_name = provider_names[i.provider_id]
                 if i.worker_group_id is not None:
-                    name = config.get_object_by_id(i.worker_group_id, 'WorkerGroup').name
+                    name = worker_group_names.get(i.worker_group_id)
                     itype = 'worker'
                 else:
-                    name = config.get_object_by_id(i.controller_id, 'Controller').name
+                    name = controller_names.get(i.controller_id)
                     itype = 'controller'
                 table_data.append([i.id, provider_name, i.provider_instance_identifier, itype, name])
             table_print(['ID', 'provider', 'instance id', 'type', 'name'], table_data)
@@ -1349,9 +1437,9 @@ class MOLNSInstances(MOLNSbase):
         """ delete all instances in the db """
         instance_list = config.get_all_instances()
         if len(instance_list) > 0:
+            config.delete_instances(instance_list)
             for i in instance_list:
                 print i
-                config.delete_instance(i)
                 print "instance {0} deleted".format(i.id)
         else:
             print "No instance found"
@@ -1359,6 +1447,18 @@ class MOLNSInstances(MOLNSbase):
 ###############################################
 
 class MOLNSExec(MOLNSbase):
+    # Resource usage shown by 'exec status --all' and 'exec list' (see _resource_columns()).
+    RESOURCE_COLUMNS = ['Wall time', 'CPU time', 'Max RSS']
+    # How many earlier jobs with the same cache key 'exec start --cache' tries to reuse.
+    CACHE_CANDIDATES = 5
+
+    @classmethod
+    def _get_job(cls, jobID, config):
+        try:
+            return config.get_job(jobID=jobID)
+        except DatastoreException:
+            raise MOLNSException("Job {0} not found".format(jobID))
+
     @classmethod
     def _get_ip_for_job(cls, job, config):
         instance_list = config.get_controller_instances(controller_id=job.controller_id)
@@ -1368,101 +1468,357 @@ class MOLNSExec(MOLNSbase):
         # Check if they are running
         ip = None
         if len(instance_list) > 0:
+            statuses = cls._get_instance_statuses([(controller_obj, i) for i in instance_list])
             for i in instance_list:
-                status = controller_obj.get_instance_status(i)
-                logging.debug("instance={0} has status={1}".format(i, status))
-                if status == controller_obj.STATUS_RUNNING:
+                logging.debug("instance={0} has status={1}".format(i, statuses[i.id]))
+                if statuses[i.id] == controller_obj.STATUS_RUNNING:
                     ip = i.ip_address
         return ip, controller_obj
 
+    @classmethod
+    def _get_sshdeploy_for_job(cls, job, config):
+        """ Returns (ip address, SSHDeploy) of the host that has the job's directory, (None, None) if it is not running.
+        A job dispatched to a worker is read from the worker while it runs, and from the copy in the controller's
+        shared area once the worker is gone. """
+        from MolnsLib.ssh_deploy import SSHDeploy
+        if job.host is not None and job.worker_group_id is not None:
+            try:
+                worker_obj = config.get_object_by_id(job.worker_group_id, 'WorkerGroup')
+            except DatastoreException:
+                worker_obj = None
+            if worker_obj is not None:
+                instance_list = [i for i in config.get_all_instances(worker_group_id=worker_obj.id)
+                                 if i.ip_address == job.host]
+                statuses = cls._get_instance_statuses([(worker_obj, i) for i in instance_list])
+                for i in instance_list:
+                    if statuses[i.id] == worker_obj.STATUS_RUNNING:
+                        return i.ip_address, SSHDeploy(worker_obj.ssh, config=worker_obj.provider,
+                                                       config_dir=config.config_dir)
+        ip, controller_obj = cls._get_ip_for_job(job, config)
+        if ip is None:
+            return None, None
+        sshdeploy = SSHDeploy(controller_obj.ssh, config=controller_obj.provider, config_dir=config.config_dir)
+        if job.host is not None:
+            sshdeploy.REMOTE_EXEC_JOB_PATH = SSHDeploy.SHARED_EXEC_RESULTS_PATH
+        return ip, sshdeploy
+
+    @classmethod
+    def _least_loaded_worker(cls, worker_obj, config):
+        """ The running instance of the worker group with the most free slots (cpus not used by the load average or
+        by queued and running jobs), the lowest load average breaks ties. """
+        from MolnsLib.ssh_deploy import SSHDeploy
+        from MolnsLib.Utils import parallel_map
+        instance_list = config.get_all_instances(worker_group_id=worker_obj.id)
+        statuses = cls._get_instance_statuses([(worker_obj, i) for i in instance_list])
+        instances = [i for i in instance_list if statuses[i.id] == worker_obj.STATUS_RUNNING]
+        if len(instances) == 0:
+            raise MOLNSException("Worker group {0} has no running workers.".format(worker_obj.name))
+        sshdeploy = SSHDeploy(worker_obj.ssh, config=worker_obj.provider, config_dir=config.config_dir)
+
+        def load(inst):
+            try:
+                return inst, sshdeploy.clone().remote_execution_load(inst.ip_address)
+            except Exception as e:
+                logging.debug("Could not read the load of {0}: {1}".format(inst.ip_address, e))
+                return inst, None
+
+        best = None
+        for inst, host_load in parallel_map(load, instances, max_workers=MOLNSWorkerGroup.ENGINE_DEPLOY_PARALLELISM):
+            if host_load is None:
+                continue
+            (cpus, load_avg, active_jobs, slots) = host_load
+            free = min((slots if slots is not None else cpus) - active_jobs, cpus - load_avg)
+            if best is None or (free, -load_avg) > best[0]:
+                best = ((free, -load_avg), inst)
+        if best is None:
+            raise MOLNSException("Could not reach any worker of worker group {0}.".format(worker_obj.name))
+        return best[1]
+
     @classmethod
     def start_job(cls, args, config):
         ''' Execute a process on the controller.'''
+        from MolnsLib.ssh_deploy import SSHDeploy
+        priority = 0
+        slots = None
+        array_params = None
+        workers = None
+        try:
+            for a in [a for a in args if a.startswith('--')]:
+                if a.startswith('--priority='):
+                    priority = int(a.split('=', 1)[1])
+                elif a.startswith('--slots='):
+                    slots = int(a.split('=', 1)[1])
+                elif a.startswith('--array='):
+                    array_params = os.path.expanduser(a.split('=', 1)[1])
+                elif a.startswith('--workers='):
+                    workers = a.split('=', 1)[1]
+        except ValueError:
+            raise MOLNSException("'--priority' and '--slots' must be integers")
+        use_cache = '--cache' in args
+        args = [a for a in args if not (a.startswith('--priority=') or a.startswith('--slots=') or
+                                        a.startswith('--array=') or a.startswith('--workers=') or a == '--cache')]
         # Get Controller
         if len(args) < 2:
-             raise MOLNSException("USAGE: molns exec start name [Command]\n"\
-                "\tExecute 'Command' on the controller with the given name.")
+             raise MOLNSException("USAGE: molns exec start name [Command] [--priority=N] [--slots=N] [--cache] [--array=params_file] [--workers=group]\n"\
+                "\tExecute 'Command' on the controller with the given name. Jobs wait in a queue on the controller\n"\
+                "\tand run by priority (higher first) on a limited number of slots (default: cpus - engines).\n"\
+                "\t'--slots' changes the number of slots for all jobs on the controller. With '--cache', the results\n"\
+                "\tof an earlier successful '--cache' job with the same command and input files are reused.\n"\
+                "\tWith '--array', 'Command' is a template run once for each line of 'params_file', either a json\n"\
+                "\tobject ({key} fields) or whitespace separated values ({0}, {1}, ... fields); {task} is the line's\n"\
+                "\ttask number. The tasks share the slots and are tracked as one job. With '--workers', the job runs on\n"\
+                "\tthe least loaded worker of the controller's worker group 'group' instead of the controller; input\n"\
+                "\tfiles are staged through the shared area and the job's files are copied back there when it ends.")
+        if array_params is not None and not os.path.isfile(array_params):
+            raise MOLNSException("Parameter file {0} not found".format(array_params))
        
         else:
             controller_obj = cls._get_controllerobj(args, config)
             if controller_obj is None:
                 raise Exception("Countroller {0} not found".format(args[0]))
         # Check if controller is running
-        instance_list = config.get_all_instances(controller_id=controller_obj.id)
+        instance_list = config.get_controller_instances(controller_id=controller_obj.id)
         inst = None
         if len(instance_list) > 0:
+            statuses = cls._get_instance_statuses([(controller_obj, i) for i in instance_list])
             for i in instance_list:
-                status = controller_obj.get_instance_status(i)
-                if status == controller_obj.STATUS_RUNNING:
+                if statuses[i.id] == controller_obj.STATUS_RUNNING:
                     inst = i
                     break
         if inst is None:
             raise MOLNSException("Controller {0} is not running.".format(args[0]))
-        # Create Datastore object
         exec_str = args[1]
-        job = config.start_job(controller_id=controller_obj.id, exec_str=exec_str)
+        sshdeploy = SSHDeploy(controller_obj.ssh, config=controller_obj.provider, config_dir=config.config_dir)
+        # Pick the host
+        worker_obj = None
+        host = None
+        job_sshdeploy = sshdeploy
+        shared_via = None
+        if workers is not None:
+            worker_obj = cls._get_workerobj([workers], config)
+            if worker_obj is None:
+                raise MOLNSException("Worker group {0} not found".format(workers))
+            if worker_obj.controller is None or worker_obj.controller.id != controller_obj.id:
+                raise MOLNSException("Worker group {0} does not belong to controller {1}".format(workers, args[0]))
+            host = cls._least_loaded_worker(worker_obj, config).ip_address
+            job_sshdeploy = SSHDeploy(worker_obj.ssh, config=worker_obj.provider, config_dir=config.config_dir)
+            shared_via = (sshdeploy, inst.ip_address)
+        # Create Datastore object
+        cache_key = None
+        if use_cache:
+            cache_key = sshdeploy.remote_execution_cache_key(exec_str, array_params=array_params)
+        job = config.start_job(controller_id=controller_obj.id, exec_str=exec_str, cache_key=cache_key,
+                               worker_group_id=worker_obj.id if worker_obj is not None else None, host=host)
+        if use_cache:
+            # Look at the few most recent runs on the same host, older ones have likely been cleaned up.
+            earlier = [j.jobID for j in config.get_jobs_by_cache_key(controller_obj.id, cache_key)
+                       if j.jobID != job.jobID and j.host == host][:cls.CACHE_CANDIDATES]
+            reused = job_sshdeploy.remote_execution_reuse_job(host or inst.ip_address, earlier, job.jobID)
+            if reused is not None:
+                return {'JobID':job.jobID, 'id':job.id,
+                        'msg':"Job finished (results reused from JobID={2}), ID={1}  JobID={0}".format(
+                            job.jobID, job.id, reused)}
         # execute command
-        sshdeploy = SSHDeploy(config=controller_obj.provider, config_dir=config.config_dir)
-        sshdeploy.deploy_remote_execution_job(inst.ip_address, job.jobID, exec_str)
+        job_sshdeploy.deploy_remote_execution_job(host or inst.ip_address, job.jobID, exec_str, priority=priority,
+                                                  slots=slots, array_params=array_params, shared_via=shared_via)
         #
-        return {'JobID':job.jobID, 'id':job.id, 'msg':"Job started, ID={1}  JobID={0}".format(job.jobID,job.id)}
+        if host is not None:
+            return {'JobID':job.jobID, 'id':job.id,
+                    'msg':"Job queued on worker {2}, ID={1}  JobID={0}".format(job.jobID, job.id, host)}
+        return {'JobID':job.jobID, 'id':job.id, 'msg':"Job queued, ID={1}  JobID={0}".format(job.jobID,job.id)}
 
     @classmethod
     def job_status(cls, args, config):
         ''' Check if a process is still running on the controller.'''
         if len(args) < 1:
-             raise MOLNSException("USAGE: molns exec status [JobID]\n"\
-                "\tCheck if a process is still running on the controller.")
-        j = config.get_job(jobID=args[0])
-        ip, controller_obj = cls._get_ip_for_job(j, config)
+             raise MOLNSException("USAGE: molns exec status [JobID] [--tasks]\n"\
+                "\tCheck if a process is still running on the controller. With '--tasks', show the status of\n"\
+                "\teach task of an array job.\n"\
+                "molns exec status --all [name]\n"\
+                "\tShow the status of all jobs (on the named controller).")
+        if args[0] == '--all':
+            return cls.all_jobs_status(args[1:], config)
+        j = cls._get_job(args[0], config)
+        ip, sshdeploy = cls._get_sshdeploy_for_job(j, config)
         if ip is None:
             return {'running':False, 'msg': "No active instance for this controller"}
-        sshdeploy = SSHDeploy(config=controller_obj.provider, config_dir=config.config_dir)
+        if '--tasks' in args:
+            tasks = sshdeploy.remote_execution_array_status(ip, j.jobID)
+            if len(tasks) == 0:
+                return {'msg': "No tasks (not an array job, or not started yet)"}
+            return {'type': 'table', 'column_names': ['Task', 'Status', 'Return value', 'Command'],
+                    'data': [[task, state, return_value if return_value is not None else '', cmd]
+                             for (task, state, return_value, cmd) in tasks]}
         (running, msg) = sshdeploy.remote_execution_job_status(ip, j.jobID)
-        return {'running':running, 'msg':msg}
+        if running:
+            return {'running':running, 'msg':msg}
+        resources = sshdeploy.remote_execution_job_resources(ip, j.jobID)
+        if resources is not None:
+            msg = "{0}\n{1}".format(msg, cls._format_resources(resources))
+        return {'running':running, 'msg':msg, 'resources':resources}
+
+    @classmethod
+    def _format_resources(cls, resources):
+        """ One line summary of the resource usage recorded for a job. """
+        parts = ["wall time {0:.1f}s".format(resources['wall_time']),
+                 "cpu time {0:.1f}s user + {1:.1f}s system".format(resources['user_time'], resources['system_time']),
+                 "max rss {0:.1f} MB".format(resources['max_rss_kb'] / 1024.0)]
+        if resources.get('read_bytes') is not None:
+            parts.append("disk read {0:.1f} MB, written {1:.1f} MB".format(resources['read_bytes'] / 1048576.0,
+                                                                         resources['write_bytes'] / 1048576.0))
+        return ", ".join(parts)
+
+    @classmethod
+    def all_jobs_status(cls, args, config):
+        ''' Status of all jobs (on the controller 'name'), with one remote command per controller. The statuses are
+        saved to the datastore in one transaction. '''
+        if len(args) > 0:
+            controller_obj = cls._get_controllerobj(args, config)
+            if controller_obj is None:
+                raise MOLNSException("Controller {0} not found".format(args[0]))
+            jobs = config.get_all_jobs(controller_id=controller_obj.id)
+        else:
+            jobs = config.get_all_jobs()
+        if len(jobs) == 0:
+            return {'msg': "No jobs found"}
+        # Jobs dispatched to workers are grouped by worker.
+        jobs_by_host = OrderedDict()
+        for j in jobs:
+            jobs_by_host.setdefault((j.controller_id, j.host), []).append(j)
+
+        statuses = {}
+        for host_jobs in jobs_by_host.values():
+            try:
+                ip, sshdeploy = cls._get_sshdeploy_for_job(host_jobs[0], config)
+            except MOLNSException:
+                continue
+            if ip is None:
+                continue
+            remote = sshdeploy.remote_execution_all_jobs_status(ip)
+            for j in host_jobs:
+                statuses[j.jobID] = remote.get(j.jobID, ('missing', None, None))
+        config.update_job_statuses(statuses)
+
+        controller_names = config.get_object_names('Controller')
+        table_data = []
+        for j in jobs:
+            status, return_value, resources = statuses.get(j.jobID, ('controller not running', None, None))
+            table_data.append([j.id, j.jobID, controller_names.get(j.controller_id, j.controller_id), status,
+                               return_value if return_value is not None else ''] +
+                              cls._resource_columns(resources) + [j.exec_str])
+        return {'type': 'table', 'column_names': ['ID', 'JobID', 'Controller', 'Status', 'Return value'] +
+                cls.RESOURCE_COLUMNS + ['Command'], 'data': table_data}
+
+    @classmethod
+    def _resource_columns(cls, resources):
+        """ Table cells for RESOURCE_COLUMNS. """
+        if resources is None:
+            return ['', '', '']
+        return ["{0:.1f}s".format(resources['wall_time']),
+                "{0:.1f}s".format(resources['user_time'] + resources['system_time']),
+                "{0:.1f} MB".format(resources['max_rss_kb'] / 1024.0)]
 
     @classmethod
     def job_logs(cls, args, config):
         ''' Return the output (stdout/stderr) of the process.'''
+        follow = '--follow' in args
+        args = [a for a in args if a != '--follow']
         if len(args) < 1:
-             raise MOLNSException("USAGE: molns exec logs [JobID] [seek]\n"\
-                "\tReturn the output (stdout/stderr) of the process (starting from 'seek').")
-        j = config.get_job(jobID=args[0])
-        ip, controller_obj = cls._get_ip_for_job(j, config)
+             raise MOLNSException("USAGE: molns exec logs [JobID] [seek] [max_bytes] [--follow]\n"\
+                "\tReturn the output (stdout/stderr) of the process (starting from 'seek', at most 'max_bytes').\n"\
+                "\tWith '--follow', keep printing the output as it is written until the process exits.")
+        j = cls._get_job(args[0], config)
+        ip, sshdeploy = cls._get_sshdeploy_for_job(j, config)
         if ip is None:
             raise MOLNSException("No active instance for this controller")
         seek = 0
-        if len(args) > 1:
-            try:
+        max_bytes = None
+        try:
+            if len(args) > 1:
                 seek = int(args[1])
-            except Exception:
-                raise MOLNSException("'seek' must be an integer")
-        sshdeploy = SSHDeploy(config=controller_obj.provider, config_dir=config.config_dir)
-        logs = sshdeploy.remote_execution_get_job_logs(ip, j.jobID, seek)
+            if len(args) > 2:
+                max_bytes = int(args[2])
+        except ValueError:
+            raise MOLNSException("'seek' and 'max_bytes' must be integers")
+        if follow:
+            sshdeploy.remote_execution_follow_job_logs(ip, j.jobID, seek)
+            return
+        logs = sshdeploy.remote_execution_get_job_logs(ip, j.jobID, seek, max_bytes=max_bytes)
         return {'msg': logs}
 
+    @classmethod
+    def wait_jobs(cls, args, config, timeout=None):
+        ''' Block until the jobs have finished (or for at most 'timeout' seconds), with one ssh command per host that
+        waits on the host. Returns a table with the status and return value of each job, the return values are also
+        in 'return_values' ({jobID: int or None}). '''
+        from MolnsLib.Utils import parallel_map
+        try:
+            for a in [a for a in args if a.startswith('--timeout=')]:
+                timeout = int(a.split('=', 1)[1])
+        except ValueError:
+            raise MOLNSException("'--timeout' must be an integer")
+        args = [a for a in args if not a.startswith('--timeout=')]
+        if len(args) < 1:
+             raise MOLNSException("USAGE: molns exec wait [JobID] [JobID ...] [--timeout=S]\n"\
+                "\tWait until the processes have finished (at most S seconds) and show their return values.")
+        jobs = [cls._get_job(a, config) for a in args]
+        jobs_by_host = OrderedDict()
+        for j in jobs:
+            jobs_by_host.setdefault((j.controller_id, j.host), []).append(j)
+
+        hosts = []
+        for host_jobs in jobs_by_host.values():
+            ip, sshdeploy = cls._get_sshdeploy_for_job(host_jobs[0], config)
+            if ip is not None:
+                # Each thread needs its own ssh helper, the one of a worker group is shared by all its workers.
+                hosts.append((ip, sshdeploy.clone(), [j.jobID for j in host_jobs]))
+
+        def wait(host):
+            (ip, sshdeploy, jobIDs) = host
+            return sshdeploy.remote_execution_wait_jobs(ip, jobIDs, timeout=timeout)
+
+        statuses = {}
+        for remote in parallel_map(wait, hosts, max_workers=max(1, len(hosts))):
+            statuses.update(remote)
+        config.update_job_statuses(dict((jobID, status) for jobID, status in statuses.items()
+                                        if status[0] != 'timeout'))
+        table_data = []
+        return_values = OrderedDict()
+        for j in jobs:
+            status, return_value, resources = statuses.get(j.jobID, ('controller not running', None, None))
+            return_values[j.jobID] = return_value
+            table_data.append([j.id, j.jobID, status, return_value if return_value is not None else ''] +
+                              cls._resource_columns(resources))
+        return {'type': 'table', 'column_names': ['ID', 'JobID', 'Status', 'Return value'] + cls.RESOURCE_COLUMNS,
+                'data': table_data, 'return_values': return_values}
+
 
     @classmethod
     def fetch_job_results(cls, args, config, overwrite=False):
         ''' Transfer files created by the process from the controller to local file system.'''
         if len(args) < 2:
-             raise MOLNSException("USAGE: molns exec fetch [JobID] [filename] (destination filename)\n"\
-                "\tRemove process files from the controller (will kill active processes if running).")
+             raise MOLNSException("USAGE: molns exec fetch [JobID] [filename] (destination filename) [--force] [--compress] [--tar]\n"\
+                "\tTransfer files created by the process from the controller to local file system. With '--tar', or if\n"\
+                "\tfilename is a glob pattern, all matching files are fetched as one archive into the destination directory.")
+        flags = [a for a in args if a.startswith('--')]
+        args = [a for a in args if not a.startswith('--')]
         filename = args[1]
-        j = config.get_job(jobID=args[0])
-        if j is None:
-            raise MOLNSException("Job not found")
-        ip, controller_obj = cls._get_ip_for_job(j, config)
+        j = cls._get_job(args[0], config)
+        ip, sshdeploy = cls._get_sshdeploy_for_job(j, config)
         if ip is None:
             raise MOLNSException("No active instance for this controller")
-        sshdeploy = SSHDeploy(config=controller_obj.provider, config_dir=config.config_dir)
-        if os.path.isfile(filename) and not overwrite and (len(args) < 3 or args[-1] != '--force'):
-            raise MOLNSException("File {0} exists, use '--force' or overwrite=True to ignore.")
-        if len(args) >= 3 and not args[2].startswith('--'):
+        if '--tar' in flags or any(c in filename for c in '*?['):
+            local_dir = args[2] if len(args) >= 3 else '.'
+            extracted = sshdeploy.remote_execution_fetch_files(ip, j.jobID, args[1:2], local_dir,
+                                                               compress='--compress' in flags)
+            return {'msg': "Transferred {0} files to {1}.".format(len(extracted), local_dir)}
+        if len(args) >= 3:
             localfile = args[2]
         else:
             localfile = filename
-        sshdeploy.remote_execution_fetch_file(ip, j.jobID, filename, localfile)
+        if os.path.isfile(localfile) and not overwrite and '--force' not in flags:
+            raise MOLNSException("File {0} exists, use '--force' or overwrite=True to ignore.".format(localfile))
+        sshdeploy.remote_execution_fetch_file(ip, j.jobID, filename, localfile, compress='--compress' in flags)
         return {'msg': "File transfer complete."}
 
 
@@ -1472,13 +1828,13 @@ class MOLNSExec(MOLNSbase):
         if len(args) < 1:
              raise MOLNSException("USAGE: molns exec cleanup [JobID]\n"\
                 "\tRemove process files from the controller (will kill active processes if running).")
-        j = config.get_job(jobID=args[0])
-        if j is None:
+        try:
+            j = config.get_job(jobID=args[0])
+        except DatastoreException:
             return {'msg':"Job not found"}
-        ip, controller_obj = cls._get_ip_for_job(j, config)
+        ip, sshdeploy = cls._get_sshdeploy_for_job(j, config)
         if ip is None:
             raise MOLNSException("No active instance for this controller")
-        sshdeploy = SSHDeploy(config=controller_obj.provider, config_dir=config.config_dir)
         sshdeploy.remote_execution_delete_job(ip, j.jobID)
         config.delete_job(j)
         return {'msg':"Job {0} deleted".format(args[0])}
@@ -1497,15 +1853,18 @@ class MOLNSExec(MOLNSbase):
         if len(jobs) == 0:
             return {'msg':"No jobs found"}
         else:
+            controller_names = config.get_object_names('Controller')
             table_data = []
             for j in jobs:
-                try:
-                    p = config.get_object_by_id(j.controller_id, 'Controller')
-                    controller_name = p.name
-                except DatastoreException as e:
-                    controller_name = 'ERROR: {0}'.format(e)
-                table_data.append([j.id, j.jobID, controller_name, j.exec_str, j.date])
-            return {'type':'table','column_names':['ID', 'JobID', 'Controller', 'Command', 'Date'], 'data':table_data}
+                controller_name = controller_names.get(j.controller_id,
+                                                       'ERROR: Controller {0} not found'.format(j.controller_id))
+                resources = None
+                if j.resources is not None:
+                    resources = json.loads(j.resources)
+                table_data.append([j.id, j.jobID, controller_name, j.exec_str, j.date, j.status or ''] +
+                                  cls._resource_columns(resources))
+            return {'type':'table','column_names':['ID', 'JobID', 'Controller', 'Command', 'Date', 'Status'] +
+                    cls.RESOURCE_COLUMNS, 'data':table_data}
 
 
 ##############################################################################################
@@ -1682,6 +2041,9 @@ COMMAND_LIST = [
             function=MOLNSController.put_controller),
     Command('upload', {'name': None, 'file': None},
             function=MOLNSController.upload_controller),
+    Command('sync', OrderedDict([('name', None), ('push|pull', None), ('local_dir', None),
+                                 ('remote_dir', '<local_dir name>')]),
+            function=MOLNSController.sync_controller),
     # Command('local-connect', {'name':None},
     #    function=MOLNSController.connect_controller_to_local),
     # Commands to interact with controller
@@ -1753,10 +2115,12 @@ COMMAND_LIST = [
         SubCommand('exec',[
             Command('start', OrderedDict([('name',None), ('command',None)]),
                 function=MOLNSExec.start_job),
-            Command('status', {'jobID':None},
+            Command('status', {'jobID [--tasks]|--all [name]':None},
                 function=MOLNSExec.job_status),
-            Command('logs', {'jobID':None},
+            Command('logs', OrderedDict([('jobID',None), ('seek', 0), ('max_bytes', None)]),
                 function=MOLNSExec.job_logs),
+            Command('wait', {'jobID [jobID ...] [--timeout=S]':None},
+                function=MOLNSExec.wait_jobs),
             Command('fetch', OrderedDict([('jobID',None), ('filename', None)]),
                 function=MOLNSExec.fetch_job_results),
             Command('cleanup', {'jobID':None},
@@ -1771,6 +2135,7 @@ def print_help():
     print "molns <command> <command-args>"
     print " --config=[Config Directory=./.molns/]"
     print "\tSpecify an alternate config location.  (Must be first argument.)"
+    print " --parallel=[Number of workers deployed concurrently={0}]".format(MOLNSWorkerGroup.ENGINE_DEPLOY_PARALLELISM)
     for c in COMMAND_LIST:
         print c
 
@@ -1788,6 +2153,13 @@ def parse_args():
         if arg_list[0].startswith('--config='):
             config_dir = sys.argv[1].split('=', 2)[1]
 
+        if arg_list[0].startswith('--parallel='):
+            try:
+                MOLNSWorkerGroup.ENGINE_DEPLOY_PARALLELISM = max(1, int(arg_list[0].split('=', 1)[1]))
+            except ValueError:
+                print "'{0}' is not a valid number of parallel deployments.".format(arg_list[0])
+                return
+
         if arg_list[0].startswith('--debug'):
             print "Turning on Debugging output"
             logger.setLevel(logging.DEBUG)